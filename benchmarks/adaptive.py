@@ -0,0 +1,96 @@
+"""Adaptive sampling benchmark: segments scored until the system ranking is significant against scoring every segment.
+
+    python benchmarks/adaptive.py --systems=15 --segments=2000 --domains=4 --runs=10
+
+A synthetic dataset is written to --workdir and scored by a simulated DA judge. Systems differ in quality by --gap,
+segments and domains differ in difficulty and every answer gets noise of --noise, as integer scores from 0 to 100.
+Every run uses another sampling seed, the reported ranking errors are pairs ordered differently than with all segments.
+"""
+import os
+import shutil
+
+import numpy as np
+from absl import app, flags
+
+from gemba.testset import Testset
+from gemba.scores import Scores
+from gemba.adaptive import AdaptiveSampler
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('systems', 15, 'Number of systems.')
+flags.DEFINE_integer('segments', 2000, 'Number of segments.')
+flags.DEFINE_integer('domains', 4, 'Number of domains.')
+flags.DEFINE_float('gap', 2.0, 'Difference between the true quality of neighbouring systems.')
+flags.DEFINE_float('noise', 15.0, 'Standard deviation of the judge noise.')
+flags.DEFINE_integer('batch_size', 100, 'Segments of every system between two significance checks.')
+flags.DEFINE_float('pval', 0.05, 'p-value of the significance checks.')
+flags.DEFINE_integer('runs', 10, 'Number of adaptive runs with different seeds.')
+flags.DEFINE_string('workdir', "/tmp/gemba_adaptive_benchmark", 'Folder for the synthetic dataset.')
+
+
+def write_dataset(basepath):
+    dataset = f"{basepath}/wmt22"
+    shutil.rmtree(dataset, ignore_errors=True)
+    for folder in ["sources", "documents", "system-outputs/en-de"]:
+        os.makedirs(f"{dataset}/{folder}", exist_ok=True)
+    with open(f"{dataset}/sources/en-de.txt", "w") as f:
+        f.writelines(f"source {i}\n" for i in range(FLAGS.segments))
+    # domains of different sizes
+    domains = np.minimum(np.arange(FLAGS.segments) * FLAGS.domains ** 2 // FLAGS.segments, FLAGS.domains ** 2 - 1)
+    with open(f"{dataset}/documents/en-de.docs", "w") as f:
+        f.writelines(f"domain{int(np.sqrt(d))}\tdoc{i // 10}\n" for i, d in enumerate(domains))
+    for s in range(FLAGS.systems):
+        with open(f"{dataset}/system-outputs/en-de/system{s:02d}.txt", "w") as f:
+            f.writelines(f"hypothesis {s} {i}\n" for i in range(FLAGS.segments))
+
+
+# the answers of the judge for every system and segment, drawn once so that every run sees the same scores
+def simulate_judge(testset, domain_codes):
+    rng = np.random.default_rng(0)
+    quality = 70 + FLAGS.gap * np.arange(len(testset.systems))[::-1]
+    difficulty = rng.normal(scale=10, size=FLAGS.segments) + rng.normal(scale=5, size=FLAGS.domains)[domain_codes]
+    answers = quality[:, None] + difficulty[None, :] + rng.normal(scale=FLAGS.noise, size=(len(testset.systems), FLAGS.segments))
+    return dict(zip(testset.systems, np.clip(np.round(answers), 0, 100)))
+
+
+def ranking_errors(means, reference):
+    systems = list(reference)
+    return sum((means[a] - means[b]) * (reference[a] - reference[b]) <= 0 for i, a in enumerate(systems) for b in systems[i + 1:])
+
+
+def main(argv):
+    basepath = os.path.join(FLAGS.workdir, "data")
+    write_dataset(basepath)
+    testset = Testset(basepath, "wmt22", "en-de", cache_dir=os.path.join(FLAGS.workdir, "index"))
+
+    full = Scores("full", testset, None)
+    answers = simulate_judge(testset, full.domain_codes()[1])
+    reference = {system: scores.mean() for system, scores in answers.items()}
+    pairs = len(reference) * (len(reference) - 1) // 2
+
+    print(f"seed\tstop\tsegments\tfraction of requests\tsignificant pairs\tranking errors of {pairs} pairs")
+    fractions = []
+    for seed in range(FLAGS.runs):
+        name = f"adaptive-{seed}"
+        for path in os.listdir(os.path.dirname(full.prefix)):
+            if path.startswith(f"{name}-"):
+                os.remove(os.path.join(os.path.dirname(full.prefix), path))
+
+        scores = Scores(name, testset, None)
+        sampler = AdaptiveSampler(scores, batch_size=FLAGS.batch_size, pval=FLAGS.pval, seed=seed)
+        for batch in sampler.batches():
+            for system in sampler.systems:
+                for index in batch:
+                    scores.assign_score(system, index, answers[system][index], 0)
+        sampler.save()
+        scores.save()
+
+        means = {row["system"]: row["mean"] for row in sampler.history[-1]["ranking"]}
+        fraction = len(sampler.sampled) / FLAGS.segments
+        fractions.append(fraction)
+        print(f"{seed}\t{sampler.stop_reason}\t{len(sampler.sampled)}\t{fraction:.3f}\t{sampler.history[-1]['significant_pairs']}\t{ranking_errors(means, reference)}")
+    print(f"mean fraction of requests {np.mean(fractions):.3f}, {1 / np.mean(fractions):.1f}x fewer API calls")
+
+
+if __name__ == "__main__":
+    app.run(main)
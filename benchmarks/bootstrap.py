@@ -0,0 +1,106 @@
+"""Bootstrap significance benchmark: one draw and one metric pair at a time with scipy against gemba.bootstrap.
+
+    python benchmarks/bootstrap.py --k=1000 --metrics=10 --items=15,500
+
+Both paths use the same resamples and must produce the same p-value matrix. --items lists sample sizes,
+e.g. the number of systems for system-level and of segments for segment-level correlations.
+When mt-metrics-eval is installed, gemba.bootstrap.compare_metrics is also timed against data.CompareMetrics, which
+gemba.mtme_tools uses with engine='mtme'. It draws its own resamples, so only the correlations and the order of the
+metrics must agree and the largest difference of the p-values is reported.
+"""
+import time
+
+import numpy as np
+from absl import app, flags
+
+from gemba import bootstrap
+
+try:
+    from mt_metrics_eval import data, stats
+except ImportError:
+    data = None
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('k', 1000, 'Number of bootstrap draws.')
+flags.DEFINE_integer('metrics', 10, 'Number of metrics.')
+flags.DEFINE_list('items', "15,500", 'Numbers of scored items.')
+flags.DEFINE_list('corrs', "pearson,kendall", 'Correlation functions.')
+flags.DEFINE_integer('seed', 1234, 'Seed of the synthetic scores and of the draws.')
+
+
+# resamples and recomputes both correlations for every draw and every pair of metrics
+def per_pair_sig_matrix(gold, metrics, counts, corr_fcn):
+    count = len(metrics)
+    items = np.arange(len(gold))
+    not_better = np.zeros((count, count))
+    for draw in counts:
+        indices = np.repeat(items, draw.astype(np.int64))
+        for i in range(count - 1):
+            for j in range(i + 1, count):
+                delta = corr_fcn(gold[indices], metrics[i][indices])[0] - corr_fcn(gold[indices], metrics[j][indices])[0]
+                not_better[i, j] += not delta > 0
+    return not_better / len(counts)
+
+
+def make_scores(items, rng):
+    gold = rng.normal(size=items)
+    # metrics of decreasing quality, rounded to create ties
+    metrics = np.array([np.round(gold + rng.normal(scale=0.5 + m * 0.2, size=items), 1) for m in range(FLAGS.metrics)])
+    return gold, metrics
+
+
+def compare_with_mtme(rng):
+    print(f"items\tcorr\tmtme s\tnumpy s\tspeedup\tmax p-value difference")
+    for items in map(int, FLAGS.items):
+        gold, metrics = make_scores(items, rng)
+        names = [f"metric{m}" for m in range(len(metrics))]
+        for corr in FLAGS.corrs:
+            # every item is a system of its own, without averaging all items are pooled
+            correlations = {name: stats.Correlation(items, gold, scores) for name, scores in zip(names, metrics)}
+            start = time.perf_counter()
+            reference, reference_sig = data.CompareMetrics(correlations, bootstrap.scipy_functions[corr], average_by="none", k=FLAGS.k, pval=0.05)
+            mtme_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            results, sig = bootstrap.compare_metrics(gold, dict(zip(names, metrics)), corr=corr, k=FLAGS.k, pval=0.05, seed=FLAGS.seed)
+            numpy_seconds = time.perf_counter() - start
+
+            assert list(results) == list(reference), f"metric order differs for {corr} with {items} items"
+            assert np.allclose([results[name][0] for name in results], [reference[name][0] for name in results]), f"correlations differ for {corr} with {items} items"
+            difference = np.abs(np.triu(np.asarray(reference_sig), 1) - np.triu(sig, 1)).max()
+            print(f"{items}\t{corr}\t{mtme_seconds:.2f}\t{numpy_seconds:.3f}\t{mtme_seconds / numpy_seconds:.0f}x\t{difference:.3f}")
+
+
+def main(argv):
+    rng = np.random.default_rng(FLAGS.seed)
+    print(f"items\tcorr\tper pair s\tnumpy s\tspeedup")
+    for items in map(int, FLAGS.items):
+        gold, metrics = make_scores(items, rng)
+        for corr in FLAGS.corrs:
+            observed = [bootstrap.scipy_functions[corr](gold, scores)[0] for scores in metrics]
+            ordered = metrics[np.argsort(observed)[::-1]]
+            counts = bootstrap.resample_counts(items, FLAGS.k, np.random.default_rng(FLAGS.seed))
+
+            start = time.perf_counter()
+            reference = per_pair_sig_matrix(gold, ordered, counts, bootstrap.scipy_functions[corr])
+            loop_seconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            sig = bootstrap.sig_matrix(bootstrap.corr_functions[corr](gold, ordered, counts))
+            numpy_seconds = time.perf_counter() - start
+
+            assert np.array_equal(np.triu(sig, 1), np.triu(reference, 1)), f"p-values differ for {corr} with {items} items"
+            print(f"{items}\t{corr}\t{loop_seconds:.2f}\t{numpy_seconds:.3f}\t{loop_seconds / numpy_seconds:.0f}x")
+
+    if data is not None:
+        compare_with_mtme(rng)
+
+    # the same seed draws the same resamples
+    a = bootstrap.compare_metrics(gold, dict(enumerate(metrics)), k=FLAGS.k, seed=FLAGS.seed)
+    b = bootstrap.compare_metrics(gold, dict(enumerate(metrics)), k=FLAGS.k, seed=FLAGS.seed)
+    assert a[0] == b[0] and np.array_equal(a[1], b[1])
+    print("p-values identical, fixed seed reproducible")
+
+
+if __name__ == "__main__":
+    app.run(main)
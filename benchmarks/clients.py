@@ -0,0 +1,85 @@
+"""Per-call overhead of many small scoring calls: a new OpenAI client for every GptApi against the shared clients of gemba.clients.
+
+    python benchmarks/clients.py --batches=200 --batch_size=2 --latency=constant --latency_mean=0.001
+
+Every batch stands for one small get_gemba_scores call. The fake endpoint counts the opened TCP connections
+(TLS handshakes against the real endpoint make every new connection considerably more expensive than here).
+"""
+import os
+import time
+import asyncio
+
+import openai
+from absl import app, flags
+
+from gemba.fake_openai import FakeOpenAI
+from gemba.gpt_api import GptApi
+from gemba.clients import close_async_clients
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('batches', 200, 'Number of small batches, each with its own GptApi.')
+flags.DEFINE_integer('batch_size', 2, 'Number of API calls in a batch.')
+flags.DEFINE_string('model', "gpt-4", 'Model name sent to the fake endpoint.')
+
+prompt = "Score the following translation from English to German: Hallo Welt.\nScore: "
+
+
+def fresh_sync():
+    for _ in range(FLAGS.batches):
+        # what every GptApi did before the shared clients
+        client = openai.OpenAI(api_key="fake", max_retries=0)
+        gptapi = GptApi()
+        for _ in range(FLAGS.batch_size):
+            client.chat.completions.create(**gptapi.api_parameters(prompt, FLAGS.model, 0, 10))
+
+
+def shared_sync():
+    for _ in range(FLAGS.batches):
+        gptapi = GptApi()
+        for _ in range(FLAGS.batch_size):
+            gptapi.call_api(prompt, FLAGS.model, 0, 10)
+
+
+async def fresh_async():
+    for _ in range(FLAGS.batches):
+        client = openai.AsyncOpenAI(api_key="fake", max_retries=0)
+        gptapi = GptApi()
+        await asyncio.gather(*[client.chat.completions.create(**gptapi.api_parameters(prompt, FLAGS.model, 0, 10)) for _ in range(FLAGS.batch_size)])
+        await client.close()
+
+
+async def shared_async():
+    for _ in range(FLAGS.batches):
+        gptapi = GptApi()
+        await asyncio.gather(*[gptapi.call_api_async(prompt, FLAGS.model, 0, 10) for _ in range(FLAGS.batch_size)])
+    await close_async_clients()
+
+
+def main(argv):
+    fake = FakeOpenAI(FLAGS.latency, FLAGS.latency_mean, FLAGS.latency_sigma, seed=FLAGS.seed)
+    fake.start()
+    os.environ.pop("OPENAI_AZURE_ENDPOINT", None)
+    os.environ["OPENAI_API_KEY"] = "fake"
+    os.environ["OPENAI_BASE_URL"] = fake.base_url
+
+    scenarios = {
+        "sync, client per GptApi": fresh_sync,
+        "sync, shared client": shared_sync,
+        "async, client per GptApi": lambda: asyncio.run(fresh_async()),
+        "async, shared client": lambda: asyncio.run(shared_async()),
+    }
+
+    calls = FLAGS.batches * FLAGS.batch_size
+    print(f"scenario\tcalls\tseconds\tms/call\tconnections")
+    for name, scenario in scenarios.items():
+        connections = fake.stats["connections"]
+        start = time.perf_counter()
+        scenario()
+        elapsed = time.perf_counter() - start
+        print(f"{name}\t{calls}\t{elapsed:.2f}\t{elapsed / calls * 1000:.2f}\t{fake.stats['connections'] - connections}")
+
+    fake.stop()
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,174 @@
+"""Answer parsing benchmark: gemba.parsing against the validators in gemba.prompt and gemba.gemba_mqm_utils.
+
+Every answer of the corpus (generated answers, random mixtures of answer fragments and optionally all answers
+in a response cache) is parsed by both implementations, which must return the same value, raise the same
+exception and print the same output; the memoized parsers must return the same values. Afterwards parsing of a
+replayed run is timed, both alone and through GptApi.parse_answers as every cache hit is parsed.
+
+    python benchmarks/parsing.py --answers=200000 --cache=cache/responses
+"""
+import io
+import os
+import json
+import time
+import random
+import contextlib
+
+import numpy as np
+from absl import app, flags
+
+from gemba.cache import ResponseCache
+from gemba.gpt_api import GptApi
+from gemba.prompt import prompts, quality_classes
+from gemba.gemba_mqm_utils import few_shots, parse_mqm_answer, parse_error_class
+from gemba.parsing import get_parser, parse_batch, classify_error
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('answers', 200000, 'Number of answers of the timed replay.')
+flags.DEFINE_integer('fuzz', 20000, 'Number of random answers for the differential check.')
+flags.DEFINE_string('cache', None, 'Response cache whose answers are added to the corpus.')
+flags.DEFINE_integer('seed', 1, 'Random seed.')
+
+methods = ["GEMBA-DA", "GEMBA-SQM", "GEMBA-stars", "GEMBA-classes", "GEMBA-MQM"]
+
+numeric_answers = [
+    "80", "100", "0", "105", "-5", "Score: 85", "85/100", "85/100.", "/100", "['90']", '["75"]', "['']", "[]",
+    "I would score this translation 70 out of 100.", "The score is 75. The translation preserves most meaning.",
+    "Score (0-100): 95", "95\n", " 95", "٣٥", "²", "3.5", "70-80", "I can't score this.", "", "90 90",
+]
+star_answers = [
+    "5", "5 stars", "4 stars", "Four stars: most meaning preserved", "three", "Three stars.", "★★★★", "★★★ (three stars)",
+    "**5**", "***", "1 star", "One star: Nonsense", "two stars mean some meaning", "Stars: 4\nfour", "I'd give it five.",
+    "6 stars", "0", "5 stars out of 5", "two or three stars", "FIVE",
+]
+class_answers = quality_classes + [
+    c.lower() for c in quality_classes] + [
+    "Class: Perfect translation", "Some meaning preserved", "Most meaning preserved, minor issues.\nPerfect translation",
+    "No meaning preserved - the output is empty", "Excellent", "perfect translation!",
+]
+mqm_lines = [
+    "Critical:", "Major:", "Minor:", "no-error", "No error", "", "  ",
+    'accuracy/mistranslation - "involvement"', 'accuracy/omission - "the account holder"', 'accuracy/addition - "ve Vídni"',
+    'accuracy/untranslated text - "Urumqi"', 'fluency/grammar - "wäre"', 'fluency/register - "dir"',
+    'fluency/punctuation - ","', 'fluency/spelling - "teh"', 'fluency/inconsistency - "colour"', 'fluency/character encoding - "Ã¤"',
+    'style/awkward - "etc.,"', 'terminology/inappropriate for context - "partaje"', 'terminology/inconsistent use - "Konto"',
+    'locale convention/date format - "12/01"', 'locale convention/currency - "$"', 'locale convention/time - "5pm"',
+    'non-translation - "the whole sentence"', 'other - "something else"', 'major error in accuracy', 'This is a minor issue',
+    'accuracy/mistranslation - "another date and time"', 'critical: accuracy/omission', "Major: ",
+]
+json_answers = [
+    '{"improved translation": "Das ist gut.", "errors": {"critical": [], "major": [{"class": "accuracy", "reason": "x"}], "minor": []}}',
+    '{"improved translation": "Das ist gut.", "errors": {"major": [{"class": "fluency", broken',
+    '{"improved translation": "Das ist gut", "errors": {"minor": [{"class": "style"}, {"class": "other"}]}}',
+    '{"improved translation": "x',
+]
+
+
+def generated_answers(rng):
+    answers = numeric_answers + star_answers + class_answers + json_answers + [shot["answer"] for shot in few_shots.values()]
+    fragments = numeric_answers + star_answers + class_answers + mqm_lines
+    for _ in range(FLAGS.fuzz // 2):
+        answers.append(" ".join(rng.choice(fragments) for _ in range(rng.randint(1, 4))))
+    for _ in range(FLAGS.fuzz // 2):
+        answers.append("\n".join(rng.choice(mqm_lines) for _ in range(rng.randint(1, 10))))
+    return answers
+
+
+def cached_answers(path):
+    cache = ResponseCache(path)
+    answers = []
+    for key in cache.cache.iterkeys():
+        value = cache.cache.get(key)
+        # other entries (e.g. max_tokens histograms) are not answers
+        if not isinstance(value, str):
+            continue
+        answers += [a["answer"] for a in json.loads(value) if isinstance(a.get("answer"), str)]
+    return answers
+
+
+def outcome(function, answer):
+    printed = io.StringIO()
+    with contextlib.redirect_stdout(printed):
+        try:
+            result = ("value", function(answer))
+        except Exception as e:
+            result = ("error", type(e).__name__)
+    return result, printed.getvalue()
+
+
+def check(name, reference, candidate, answers, compare_output=True):
+    mismatches = 0
+    for answer in answers:
+        expected = outcome(reference, answer)
+        actual = outcome(candidate, answer)
+        if not compare_output:
+            expected, actual = expected[0], actual[0]
+        if expected != actual:
+            mismatches += 1
+            if mismatches <= 5:
+                print(f"MISMATCH {name}: {answer!r}\n  expected {expected}\n  actual   {actual}")
+    print(f"{name}\t{len(answers)} answers\t{mismatches} mismatches")
+    return mismatches
+
+
+def main(argv):
+    rng = random.Random(FLAGS.seed)
+    corpus = generated_answers(rng)
+    if FLAGS.cache is not None:
+        corpus += cached_answers(FLAGS.cache)
+
+    mismatches = 0
+    for method in methods:
+        if method == "GEMBA-MQM":
+            for list_mqm_errors in [False, True]:
+                for full_desc in [True, False]:
+                    reference = lambda x: parse_mqm_answer(x, list_mqm_errors=list_mqm_errors, full_desc=full_desc)
+                    mismatches += check(f"{method} list={list_mqm_errors} full_desc={full_desc}", reference, get_parser(method, list_mqm_errors, full_desc, memoize=False), corpus + [None])
+                    # diagnostics of repeated answers are printed only once
+                    mismatches += check(f"{method} list={list_mqm_errors} full_desc={full_desc} memoized", reference, get_parser(method, list_mqm_errors, full_desc), corpus + [None], compare_output=False)
+        else:
+            mismatches += check(method, prompts[method]["validate_answer"], get_parser(method, memoize=False), corpus)
+            mismatches += check(f"{method} memoized", prompts[method]["validate_answer"], get_parser(method), corpus, compare_output=False)
+    mismatches += check("error classes", parse_error_class, classify_error, [line.lower() for line in mqm_lines + corpus])
+    assert mismatches == 0, f"{mismatches} answers parsed differently"
+
+    # replay of a fully cached run: realistic answers repeat a lot
+    os.environ.setdefault("OPENAI_API_KEY", "unused")
+    gptapi = GptApi()
+    print(f"\nmethod\tparser\tseconds\tanswers/s")
+    for method in methods:
+        pool = {"GEMBA-MQM": [shot["answer"] for shot in few_shots.values()] + ["\n".join(rng.choice(mqm_lines) for _ in range(6)) for _ in range(2000)],
+                "GEMBA-stars": star_answers, "GEMBA-classes": class_answers}.get(method, numeric_answers[:20] + [str(i) for i in range(101)])
+        # only valid answers, as in a replay of a finished run
+        results = [outcome(get_parser(method, memoize=False), a)[0] for a in pool]
+        pool = [a for a, (kind, value) in zip(pool, results) if kind == "value" and value is not None]
+        answers = [rng.choice(pool) for _ in range(FLAGS.answers)]
+        # the cache returns a new string for every hit
+        cached = [[{"answer": json.loads(json.dumps(a)), "finish_reason": "stop"}] for a in answers]
+
+        reference = prompts[method]["validate_answer"] if method != "GEMBA-MQM" else lambda x: parse_mqm_answer(x, full_desc=True)
+        parsers = {"old": reference, "new": get_parser(method, memoize=False), "new memoized": get_parser(method)}
+        timings = {}
+        with contextlib.redirect_stdout(io.StringIO()):
+            expected = [reference(a) for a in answers]
+            for name, parse in parsers.items():
+                start = time.perf_counter()
+                [parse(a) for a in answers]
+                timings[f"per answer ({name})"] = time.perf_counter() - start
+
+            for name, parse in parsers.items():
+                start = time.perf_counter()
+                replayed = [gptapi.parse_answers(c, "prompt", "model", parse, 0, -1)[0][0]["answer"] for c in cached]
+                timings[f"GptApi replay ({name})"] = time.perf_counter() - start
+                assert replayed == expected
+
+            start = time.perf_counter()
+            scores = parse_batch(method, answers)
+            timings["parse_batch"] = time.perf_counter() - start
+
+        assert np.array_equal(scores, np.array([np.nan if e is None else e for e in expected], dtype=np.float64), equal_nan=True)
+        for name, seconds in timings.items():
+            print(f"{method}\t{name}\t{seconds:.3f}\t{len(answers) / seconds:.0f}")
+
+if __name__ == "__main__":
+    app.run(main)
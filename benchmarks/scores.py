@@ -0,0 +1,108 @@
+"""Scores.save benchmark: the previous pandas groupby save against the numpy group codes, the TSV files must be identical.
+
+    python benchmarks/scores.py --systems=100 --segments=20000 --domains=4
+
+A synthetic dataset is written to --workdir and filled with DA-like integer and MQM-like fractional scores,
+some of them missing.
+"""
+import os
+import time
+import shutil
+import filecmp
+
+import numpy as np
+import pandas as pd
+from absl import app, flags
+
+from gemba.testset import Testset
+from gemba.scores import Scores, format_score
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('systems', 100, 'Number of systems.')
+flags.DEFINE_integer('segments', 20000, 'Number of segments.')
+flags.DEFINE_integer('domains', 4, 'Number of domains.')
+flags.DEFINE_float('missing', 0.05, 'Fraction of segments without a score.')
+flags.DEFINE_integer('repeat', 3, 'Number of saves timed for each implementation.')
+flags.DEFINE_string('workdir', "/tmp/gemba_scores_benchmark", 'Folder for the synthetic dataset.')
+
+
+# Scores.save before the numpy group codes
+def pandas_save(scores):
+    systems = np.repeat(np.array(scores.systems, dtype=object), scores.segment_count)
+    seg_scores = pd.DataFrame({"system": systems, "score": scores.scores})
+    temperatures = [format_score(t) for t in np.where(scores.temperatures < 0, np.nan, scores.temperatures)]
+
+    with open(scores.get_seg_path(), "w") as fh:
+        for system, score in zip(systems, scores.scores):
+            fh.write(f"{system}\t{format_score(score)}\n")
+
+    sys_scores_df = seg_scores.groupby(['system'], as_index=False, dropna=True).mean()
+    sys_scores_df.to_csv(scores.get_sys_path(), sep="\t", index=False, header=False, na_rep="None")
+
+    documents = scores.testset.documents
+    seg_scores["domains"] = np.tile(np.array([x.split("\t")[0] for x in documents], dtype=object), len(scores.systems))
+    df = seg_scores.groupby(["domains", 'system'], as_index=False, dropna=True).mean()
+    df.to_csv(scores.get_domain_path(), sep="\t", index=False, header=False, na_rep="None")
+
+    with open(scores.get_meta_path(), "w") as fh:
+        for system, temperature in zip(systems, temperatures):
+            fh.write(f"{system}\t{temperature}\n")
+
+    scores.journal.truncate(0)
+    scores.journal.flush()
+
+
+def write_dataset(basepath):
+    dataset = f"{basepath}/wmt22"
+    shutil.rmtree(dataset, ignore_errors=True)
+    for folder in ["sources", "documents", "system-outputs/en-de"]:
+        os.makedirs(f"{dataset}/{folder}", exist_ok=True)
+    with open(f"{dataset}/sources/en-de.txt", "w") as f:
+        f.writelines(f"source {i}\n" for i in range(FLAGS.segments))
+    with open(f"{dataset}/documents/en-de.docs", "w") as f:
+        f.writelines(f"domain{(i // 100) % FLAGS.domains}\tdoc{i // 10}\n" for i in range(FLAGS.segments))
+    for s in range(FLAGS.systems):
+        with open(f"{dataset}/system-outputs/en-de/system{s}.txt", "w") as f:
+            f.writelines(f"hypothesis {i}\n" for i in range(FLAGS.segments))
+
+
+def fill(scores, kind, rng):
+    size = len(scores.scores)
+    if kind == "DA":
+        scores.scores[:] = rng.integers(0, 101, size)
+    else:
+        # MQM weights, 0.1 for punctuation makes the sums inexact
+        scores.scores[:] = -rng.choice([0, 0, 1, 5, 10, 25, 0.1], (size, 3)).sum(axis=1)
+    scores.scores[rng.random(size) < FLAGS.missing] = np.nan
+    scores.temperatures[:] = np.where(rng.random(size) < 0.01, rng.integers(1, 5, size), 0)
+    scores.temperatures[np.isnan(scores.scores)] = -1
+    # one system with no scores at all
+    scores.scores[:scores.segment_count] = np.nan
+
+
+def main(argv):
+    basepath = os.path.join(FLAGS.workdir, "data")
+    write_dataset(basepath)
+    testset = Testset(basepath, "wmt22", "en-de", cache_dir=os.path.join(FLAGS.workdir, "index"))
+
+    print(f"scores\timplementation\tseconds")
+    for kind in ["DA", "MQM"]:
+        results = {}
+        for name, save in [("pandas", pandas_save), ("numpy", Scores.save)]:
+            scores = Scores(f"{kind}-{name}", testset, None)
+            fill(scores, kind, np.random.default_rng(1))
+            start = time.perf_counter()
+            for _ in range(FLAGS.repeat):
+                save(scores)
+            elapsed = (time.perf_counter() - start) / FLAGS.repeat
+            results[name] = scores
+            print(f"{kind}\t{name}\t{elapsed:.3f}")
+
+        for path in ["get_seg_path", "get_sys_path", "get_domain_path", "get_meta_path"]:
+            old, new = getattr(results["pandas"], path)(), getattr(results["numpy"], path)()
+            assert filecmp.cmp(old, new, shallow=False), f"{os.path.basename(new)} differs from {os.path.basename(old)}"
+    print("all TSV files are identical")
+
+
+if __name__ == "__main__":
+    app.run(main)
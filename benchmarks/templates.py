@@ -0,0 +1,65 @@
+"""Prompt building benchmark: per-row df.apply(apply_template) against compiled templates.
+
+    python benchmarks/templates.py --rows=100000
+"""
+import time
+import tracemalloc
+
+import pandas as pd
+from absl import app, flags
+
+from gemba.gemba_mqm_utils import TEMPLATE_GEMBA_MQM, apply_template
+from gemba.prompt import prompts
+from gemba.template import compile_template
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('rows', 100000, 'Number of segments.')
+flags.DEFINE_list('methods', "GEMBA-DA,GEMBA-MQM", 'Methods whose templates are benchmarked.')
+
+
+def make_df(rows):
+    df = pd.DataFrame({
+        'source_seg': [f"This is source sentence number {i} about the weather in the mountains." for i in range(rows)],
+        'target_seg': [f"Das ist der Quellsatz Nummer {i} über das Wetter in den Bergen." for i in range(rows)],
+    })
+    df['source_lang'] = "English"
+    df['target_lang'] = "German"
+    return df
+
+
+def measure(function):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main(argv):
+    df = make_df(FLAGS.rows)
+
+    print(f"method\tengine\tseconds\trows/s\tpeak MB")
+    for method in FLAGS.methods:
+        template = TEMPLATE_GEMBA_MQM if method == "GEMBA-MQM" else prompts[method]['prompt']
+
+        engines = {
+            "apply_template": lambda: list(df.apply(lambda x: apply_template(template, x), axis=1)),
+            "compiled": lambda: compile_template(template).render_columns(df),
+            # generator consumed without keeping the prompts
+            "compiled lazy": lambda: sum(1 for _ in compile_template(template).iter_render(df)),
+        }
+
+        reference = None
+        for name, engine in engines.items():
+            result, elapsed, peak = measure(engine)
+            if isinstance(result, list):
+                if reference is None:
+                    reference = result
+                assert result == reference, f"{name} produced different prompts"
+            print(f"{method}\t{name}\t{elapsed:.2f}\t{FLAGS.rows / elapsed:.0f}\t{peak / 2 ** 20:.1f}")
+
+
+if __name__ == "__main__":
+    app.run(main)
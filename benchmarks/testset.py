@@ -0,0 +1,94 @@
+"""Testset startup benchmark: the previous eager loading of every file against the lazy memory-mapped SegmentFile.
+
+    python benchmarks/testset.py --systems=200 --segments=20000 --references=4
+
+A synthetic mt-metrics-eval dataset is written to --workdir. Each scenario loads the testset and iterates over
+one system with the main reference, as a run scoring a single system does.
+"""
+import os
+import glob
+import time
+import shutil
+import tracemalloc
+
+from absl import app, flags
+
+from gemba.testset import Testset
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('systems', 200, 'Number of system outputs.')
+flags.DEFINE_integer('segments', 20000, 'Number of segments of every file.')
+flags.DEFINE_integer('references', 4, 'Number of references.')
+flags.DEFINE_string('workdir', "/tmp/gemba_testset_benchmark", 'Folder for the synthetic dataset and the offset index cache.')
+
+
+# Testset.load before the lazy SegmentFile
+class EagerTestset(Testset):
+    def load_segment_files(self, path):
+        segments = []
+        with open(path, "r") as fh:
+            for line in fh:
+                segments.append(line.rstrip())
+        return segments
+
+
+def write_dataset(basepath):
+    dataset = f"{basepath}/wmt22"
+    if os.path.isdir(dataset):
+        return
+    for folder in ["sources", "references", "documents", "system-outputs/en-de"]:
+        os.makedirs(f"{dataset}/{folder}", exist_ok=True)
+
+    def write(path, text):
+        with open(path, "w") as f:
+            f.writelines(f"{text} {i} about the weather in the mountains and the valleys.\n" for i in range(FLAGS.segments))
+
+    write(f"{dataset}/sources/en-de.txt", "This is source sentence number")
+    for r in range(FLAGS.references):
+        write(f"{dataset}/references/en-de.ref{chr(ord('A') + r)}.txt", f"Referenz {r} Satz Nummer")
+    for s in range(FLAGS.systems):
+        write(f"{dataset}/system-outputs/en-de/system{s:04d}.txt", f"System {s} übersetzt Satz Nummer")
+    with open(f"{dataset}/documents/en-de.docs", "w") as f:
+        f.writelines(f"news\tdoc{i // 10}\n" for i in range(FLAGS.segments))
+
+
+def run(testset_class, basepath, cache_dir):
+    kwargs = {} if testset_class is EagerTestset else {"cache_dir": cache_dir}
+    start = time.perf_counter()
+    testset = testset_class(basepath, "wmt22", "en-de", **kwargs)
+    loaded = time.perf_counter() - start
+
+    system = sorted(testset.systems)[0]
+    segments = list(testset.iterate_over_all(testset.main_ref, systems=[system]))
+    return segments, loaded, time.perf_counter() - start
+
+
+def main(argv):
+    basepath = os.path.join(FLAGS.workdir, "data")
+    cache_dir = os.path.join(FLAGS.workdir, "index")
+    write_dataset(basepath)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    size = sum(os.path.getsize(path) for path in glob.glob(f"{basepath}/wmt22/**/*.*", recursive=True))
+    print(f"{FLAGS.systems} systems, {FLAGS.references} references, {FLAGS.segments} segments, {size / 1e6:.0f} MB")
+
+    scenarios = {
+        "eager": EagerTestset,
+        "lazy, building the index": Testset,
+        "lazy, cached index": Testset,
+    }
+
+    print(f"scenario\tload s\tload + one system s\tpeak MB")
+    reference = None
+    for name, testset_class in scenarios.items():
+        tracemalloc.start()
+        segments, loaded, total = run(testset_class, basepath, cache_dir)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if reference is None:
+            reference = segments
+        assert segments == reference, f"{name} read different segments"
+        print(f"{name}\t{loaded:.3f}\t{total:.3f}\t{peak / 1e6:.1f}")
+
+
+if __name__ == "__main__":
+    app.run(main)
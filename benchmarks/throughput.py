@@ -0,0 +1,174 @@
+"""End-to-end throughput benchmark against the local fake OpenAI endpoint.
+
+    python benchmarks/throughput.py --segments=500 --concurrency=32 --latency=lognormal --rate_limit_rate=0.02
+
+The methods_serial and methods_multi scenarios score --methods one after another or all at once with get_gemba_scores_multi.
+
+Server behaviour is configured with the flags of gemba.fake_openai.
+"""
+import os
+import sys
+import time
+import tempfile
+import subprocess
+
+import numpy as np
+import pandas as pd
+from absl import app, flags
+
+import gemba
+from gemba.fake_openai import FakeOpenAI
+from gemba.gpt_api import GptApi
+from gemba.cache import ResponseCache
+from gemba.gemba_mqm_utils import TEMPLATE_GEMBA_MQM, apply_template, parse_mqm_answer
+from gemba.prompt import prompts
+from gemba.utils import get_gemba_scores, get_gemba_scores_multi
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('segments', 200, 'Number of segments to score.')
+flags.DEFINE_integer('sequential_segments', 50, 'Number of segments for the sequential scenarios.')
+flags.DEFINE_integer('concurrency', 16, 'Concurrency of the asynchronous scenarios.')
+flags.DEFINE_string('method', "GEMBA-DA", 'GEMBA-DA or GEMBA-MQM.')
+flags.DEFINE_string('model', "gpt-4", 'Model name sent to the fake endpoint.')
+flags.DEFINE_list('scenarios', "request,bulk_request,bulk_request_async,cli", 'Scenarios to run, also methods_serial and methods_multi.')
+flags.DEFINE_list('methods', "GEMBA-DA,GEMBA-SQM,GEMBA-stars,GEMBA-MQM", 'Methods of the methods_serial and methods_multi scenarios.')
+
+
+# records latency of every API call
+class TimedGptApi(GptApi):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+
+    def call_api(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().call_api(*args, **kwargs)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    async def call_api_async(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().call_api_async(*args, **kwargs)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+
+def make_data(segments):
+    source = [f"This is source sentence number {i} about the weather in the mountains." for i in range(segments)]
+    hypothesis = [f"Das ist der Quellsatz Nummer {i} über das Wetter in den Bergen." for i in range(segments)]
+    return source, hypothesis
+
+
+def make_prompts(source, hypothesis):
+    df = pd.DataFrame({'source_seg': source, 'target_seg': hypothesis})
+    df['source_lang'] = "English"
+    df['target_lang'] = "German"
+    if FLAGS.method == "GEMBA-MQM":
+        df["prompt"] = df.apply(lambda x: apply_template(TEMPLATE_GEMBA_MQM, x), axis=1)
+        parse_answer = lambda x: parse_mqm_answer(x, full_desc=True)
+    else:
+        df["prompt"] = df.apply(lambda x: apply_template(prompts[FLAGS.method]['prompt'], x), axis=1)
+        parse_answer = prompts[FLAGS.method]["validate_answer"]
+    return df, parse_answer
+
+
+def run_in_process(scenario, segments, workdir):
+    source, hypothesis = make_data(segments)
+    df, parse_answer = make_prompts(source, hypothesis)
+    cache = ResponseCache(f"{workdir}/cache_{scenario}")
+    gptapi = TimedGptApi()
+
+    start = time.perf_counter()
+    if scenario == "request":
+        for prompt in df["prompt"]:
+            gptapi.request(prompt, FLAGS.model, parse_answer, cache=cache, max_tokens=500)
+    elif scenario == "bulk_request":
+        gptapi.bulk_request(df, FLAGS.model, parse_answer, cache=cache, max_tokens=500)
+    else:
+        gptapi.bulk_request(df, FLAGS.model, parse_answer, cache=cache, max_tokens=500, concurrency=FLAGS.concurrency)
+    elapsed = time.perf_counter() - start
+
+    return elapsed, gptapi.latencies, gptapi.retries
+
+
+def run_cli(segments, workdir, fake):
+    source, hypothesis = make_data(segments)
+    with open(f"{workdir}/source.txt", "w") as f:
+        f.write("\n".join(source) + "\n")
+    with open(f"{workdir}/hypothesis.txt", "w") as f:
+        f.write("\n".join(hypothesis) + "\n")
+
+    served = len(fake.latencies)
+    errors = fake.stats["rate_limited"] + fake.stats["server_errors"]
+
+    command = [sys.executable, "-m", "gemba", "--source=source.txt", "--hypothesis=hypothesis.txt",
+               "--source_lang=English", "--target_lang=German", f"--method={FLAGS.method}", f"--model={FLAGS.model}",
+               f"--concurrency={FLAGS.concurrency}"]
+    # the CLI runs in workdir, so it is pointed at the same gemba as this script also when it is not installed
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(os.path.abspath(gemba.__file__))), env.get("PYTHONPATH")]))
+    start = time.perf_counter()
+    subprocess.run(command, cwd=workdir, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    elapsed = time.perf_counter() - start
+
+    # the CLI runs in another process so latency and retries are taken from the server side
+    retries = fake.stats["rate_limited"] + fake.stats["server_errors"] - errors
+    return elapsed, fake.latencies[served:], retries
+
+
+def run_methods(scenario, segments, workdir, fake):
+    source, hypothesis = make_data(segments)
+    served = len(fake.latencies)
+    errors = fake.stats["rate_limited"] + fake.stats["server_errors"]
+
+    # the default response cache is relative to the working directory
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    start = time.perf_counter()
+    try:
+        if scenario == "methods_serial":
+            for method in FLAGS.methods:
+                get_gemba_scores(source, hypothesis, "English", "German", method, FLAGS.model, concurrency=FLAGS.concurrency)
+        else:
+            get_gemba_scores_multi(source, hypothesis, "English", "German", [(method, FLAGS.model) for method in FLAGS.methods], concurrency=FLAGS.concurrency)
+    finally:
+        os.chdir(cwd)
+    elapsed = time.perf_counter() - start
+
+    retries = fake.stats["rate_limited"] + fake.stats["server_errors"] - errors
+    return elapsed, fake.latencies[served:], retries
+
+
+def main(argv):
+    fake = FakeOpenAI(FLAGS.latency, FLAGS.latency_mean, FLAGS.latency_sigma, FLAGS.rate_limit_rate, FLAGS.server_error_rate,
+                      FLAGS.truncation_rate, FLAGS.invalid_rate, FLAGS.retry_after, seed=FLAGS.seed)
+    fake.start()
+
+    os.environ.pop("OPENAI_AZURE_ENDPOINT", None)
+    os.environ["OPENAI_API_KEY"] = "fake"
+    os.environ["OPENAI_BASE_URL"] = fake.base_url
+
+    print(f"scenario\tsegments\tseconds\tseg/s\tp50 ms\tp99 ms\tretries")
+    for scenario in FLAGS.scenarios:
+        segments = FLAGS.sequential_segments if scenario in ["request", "bulk_request"] else FLAGS.segments
+        # every scenario starts with a cold cache
+        with tempfile.TemporaryDirectory() as workdir:
+            if scenario == "cli":
+                elapsed, latencies, retries = run_cli(segments, workdir, fake)
+            elif scenario in ["methods_serial", "methods_multi"]:
+                elapsed, latencies, retries = run_methods(scenario, segments, workdir, fake)
+                # every method scores all segments
+                segments *= len(FLAGS.methods)
+            else:
+                elapsed, latencies, retries = run_in_process(scenario, segments, workdir)
+
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000 if len(latencies) > 0 else (float("nan"), float("nan"))
+        print(f"{scenario}\t{segments}\t{elapsed:.2f}\t{segments / elapsed:.1f}\t{p50:.1f}\t{p99:.1f}\t{retries}")
+
+    fake.stop()
+
+
+if __name__ == "__main__":
+    app.run(main)
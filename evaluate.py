@@ -1,3 +1,4 @@
+import os
 import sys
 from mt_metrics_eval import data
 from gemba.mtme_tools import eval_metrics
@@ -16,7 +17,7 @@ for lp in focus_lps:
 appraise_results = eval_metrics(
     eval_sets, focus_lps, ['sys'], primary_only=False, k=0,
     gold_name="mqm", include_domains=False, seg_level_no_avg=True,
-    include_human_with_acc=False)
+    include_human_with_acc=False, workers=os.cpu_count())
 results = appraise_results[list(appraise_results.keys())[0]]
 
 print(f"Accuracy results")
@@ -1,8 +1,8 @@
 """Top-level package for the GEMBA translation evaluation utilities."""
 
-from gemba.utils import get_gemba_scores
+from gemba.utils import get_gemba_scores, get_gemba_scores_multi
 
-__all__ = ["get_gemba_scores"]
+__all__ = ["get_gemba_scores", "get_gemba_scores_multi"]
 
 # Keep version here so it can be queried programmatically and by packaging.
 __version__ = "0.1.0"
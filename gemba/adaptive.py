@@ -0,0 +1,121 @@
+import sys
+import json
+import warnings
+import numpy as np
+from gemba import bootstrap
+from gemba.tracing import span
+
+
+def allocate(sizes, total, minimum=2):
+    """Number of segments of every stratum among the first total segments, proportional to the stratum sizes.
+
+    Every stratum gets at least minimum segments (or all of them) so that its mean can be estimated from the first batch.
+    """
+    quota = sizes * min(total, sizes.sum()) / sizes.sum()
+    counts = np.floor(quota).astype(np.int64)
+    # largest remainders get the segments left after rounding down
+    remainder = int(min(total, sizes.sum()) - counts.sum())
+    counts[np.argsort(-(quota - counts), kind="stable")[:remainder]] += 1
+    return np.minimum(np.maximum(counts, minimum), sizes)
+
+
+# scores segments of a Scores object in randomized batches stratified by domain, for system-level rankings only;
+# every batch takes the same segments for all systems so that system differences are paired, and after every batch
+# the stratified per-system means are bootstrapped until all pairwise orderings are significant or the budget is spent
+class AdaptiveSampler:
+    def __init__(self, scores, systems=None, batch_size=100, budget=None, pval=0.05, k=1000, seed=0):
+        self.scores = scores
+        self.systems = list(scores.testset.systems) if systems is None else [s for s in scores.testset.systems if s in systems]
+        self.batch_size = batch_size
+        self.budget = scores.segment_count if budget is None else min(budget, scores.segment_count)
+        self.pval = pval
+        self.k = k
+        self.seed = seed
+
+        self.domains, self.codes = scores.domain_codes()
+        self.sizes = np.bincount(self.codes, minlength=len(self.domains))
+        rng = np.random.default_rng(seed)
+        # the same seed gives the same order, so that a restarted run continues with the segments already scored
+        self.orders = [rng.permutation(np.flatnonzero(self.codes == d)) for d in range(len(self.domains))]
+        self.rng = np.random.default_rng([seed, 1])
+        self.taken = np.zeros(len(self.domains), dtype=np.int64)
+        # segment indices in the order in which they were sampled
+        self.sampled = []
+        self.history = []
+        self.stop_reason = None
+
+    def batches(self):
+        """Yields arrays of segment indices to be scored for all systems, the ranking is checked before every next batch."""
+        while True:
+            if len(self.sampled) > 0:
+                status = self.check()
+                self.history.append(status)
+                print(f"{status['segments']} segments of {len(self.systems)} systems scored, {status['significant_pairs']}/{status['pairs']} system pairs significant", file=sys.stderr)
+                if status["significant_pairs"] == status["pairs"]:
+                    self.stop_reason = "significant"
+                    return
+            if len(self.sampled) >= self.budget:
+                self.stop_reason = "budget" if self.budget < self.scores.segment_count else "all segments"
+                return
+
+            # cumulative allocation, so that the scored segments stay proportional to the domains
+            targets = np.maximum(allocate(self.sizes, min(len(self.sampled) + self.batch_size, self.budget)), self.taken)
+            batch = np.concatenate([self.orders[d][self.taken[d]:targets[d]] for d in range(len(self.domains))])
+            self.taken = targets
+            self.sampled.extend(batch.tolist())
+            yield batch
+
+    def check(self):
+        """Stratified means of the sampled segments of every system with bootstrap confidence intervals and pairwise p-values."""
+        with span("adaptive_check", segments=len(self.sampled), systems=len(self.systems)):
+            sampled = np.array(self.sampled)
+            values = np.stack([self.scores.scores[self.scores.offsets[system] + sampled] for system in self.systems])
+            strata = self.codes[sampled]
+            weights = self.sizes * (self.taken > 0) / self.sizes[self.taken > 0].sum()
+
+            observed = np.zeros(len(self.systems))
+            draws = np.zeros((self.k, len(self.systems)))
+            for d in np.flatnonzero(self.taken > 0):
+                members = strata == d
+                valid = ~np.isnan(values[:, members])
+                x = np.where(valid, values[:, members], 0)
+                # resampled within the stratum, the same draws for all systems
+                counts = bootstrap.resample_counts(int(members.sum()), self.k, self.rng)
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    observed += weights[d] * x.sum(axis=1) / valid.sum(axis=1)
+                    draws += weights[d] * (counts @ x.T) / (counts @ valid.T)
+
+            # best first, systems without scores in some domain last
+            order = sorted(range(len(self.systems)), key=lambda s: (np.isnan(observed[s]), -np.nan_to_num(observed[s])))
+            sig = bootstrap.sig_matrix(draws[:, order])
+            pairs = len(order) * (len(order) - 1) // 2
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", RuntimeWarning)
+                lower, upper = np.nanpercentile(draws, [50 * self.pval, 100 - 50 * self.pval], axis=0)
+
+            return {
+                "segments": len(self.sampled),
+                "significant_pairs": int((sig[np.triu_indices(len(order), 1)] < self.pval).sum()),
+                "pairs": pairs,
+                "ranking": [{"system": self.systems[s], "mean": none_if_nan(observed[s]), "lower": none_if_nan(lower[s]), "upper": none_if_nan(upper[s])} for s in order],
+            }
+
+    def save(self):
+        """Writes the settings, the sampled segments and the ranking after every batch next to the score files."""
+        record = {
+            "systems": self.systems,
+            "batch_size": self.batch_size,
+            "budget": self.budget,
+            "pval": self.pval,
+            "k": self.k,
+            "seed": self.seed,
+            "stop_reason": self.stop_reason,
+            "segments": self.sampled,
+            "checks": self.history,
+        }
+        with open(self.scores.get_sampling_path(), "w") as fh:
+            json.dump(record, fh, indent=1)
+
+
+def none_if_nan(value):
+    return None if np.isnan(value) else float(value)
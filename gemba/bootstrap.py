@@ -0,0 +1,116 @@
+import numpy as np
+import scipy.stats
+
+
+def resample_counts(n, k, rng):
+    """Draw k bootstrap resamples of n items at once, row b counts how many times every item is in draw b."""
+    indices = rng.integers(0, n, size=(k, n)) + n * np.arange(k)[:, None]
+    return np.bincount(indices.ravel(), minlength=k * n).reshape(k, n).astype(np.float64)
+
+
+def pearson(gold, metrics, counts):
+    """Pearson correlations of every metric (rows of metrics) with gold in every draw, shape (draws, metrics)."""
+    n = counts.sum(axis=1, keepdims=True)
+    # centered on the full sample to keep the sums of squares accurate
+    gold = gold - gold.mean()
+    metrics = metrics - metrics.mean(axis=1, keepdims=True)
+
+    mean_gold = counts @ gold[:, None] / n
+    mean_metrics = counts @ metrics.T / n
+    cov = counts @ (metrics * gold).T / n - mean_metrics * mean_gold
+    var_gold = counts @ (gold * gold)[:, None] / n - mean_gold ** 2
+    var_metrics = counts @ (metrics * metrics).T / n - mean_metrics ** 2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        corr = cov / np.sqrt(var_gold * var_metrics)
+    # draws of constant scores have no correlation, like in scipy, rounding leaves them a tiny variance
+    corr[(var_gold <= 1e-12 * gold.var()) | (var_metrics <= 1e-12 * metrics.var(axis=1))] = np.nan
+    return np.clip(corr, -1, 1)
+
+
+def kendall(gold, metrics, counts, max_items=3000, chunk_size=256):
+    """Kendall tau-b (scipy's default) of every metric with gold in every draw, shape (draws, metrics).
+
+    With pairwise sign matrices S the numerator is c'(Sg*Sm)c and the tie corrections c'|S|c for the counts c of a draw,
+    which also counts repeated items of a resample as pairs tied in both rankings. Above max_items the n x n matrices
+    would be too large and every draw is computed with scipy instead.
+    """
+    if len(gold) > max_items:
+        return kendall_per_draw(gold, metrics, counts)
+
+    sign_gold = np.sign(gold[:, None] - gold[None, :])
+    corr = np.empty((len(counts), len(metrics)))
+    for start in range(0, len(counts), chunk_size):
+        chunk = counts[start:start + chunk_size]
+        untied_gold = np.einsum("bi,bi->b", chunk @ np.abs(sign_gold), chunk)
+        for m, scores in enumerate(metrics):
+            sign_metric = np.sign(scores[:, None] - scores[None, :])
+            concordance = np.einsum("bi,bi->b", chunk @ (sign_gold * sign_metric), chunk)
+            untied_metric = np.einsum("bi,bi->b", chunk @ np.abs(sign_metric), chunk)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                corr[start:start + chunk_size, m] = concordance / np.sqrt(untied_gold * untied_metric)
+    return np.clip(corr, -1, 1)
+
+
+def kendall_per_draw(gold, metrics, counts):
+    items = np.arange(len(gold))
+    corr = np.empty((len(counts), len(metrics)))
+    for b, draw in enumerate(counts):
+        indices = np.repeat(items, draw.astype(np.int64))
+        for m, scores in enumerate(metrics):
+            corr[b, m] = scipy.stats.kendalltau(gold[indices], scores[indices])[0]
+    return corr
+
+
+corr_functions = {"pearson": pearson, "kendall": kendall}
+scipy_functions = {"pearson": scipy.stats.pearsonr, "kendall": scipy.stats.kendalltau}
+
+
+def sig_matrix(draws):
+    """p-values of the paired bootstrap: sig[i, j] for i < j is the fraction of draws in which metric i is not better than j.
+
+    Columns of draws must be ordered from the best metric, draws with an undefined correlation count as not better.
+    """
+    count = draws.shape[1]
+    sig = np.zeros((count, count))
+    for i in range(count - 1):
+        not_better = ~(draws[:, i:i + 1] - draws[:, i + 1:] > 0)
+        sig[i, i + 1:] = not_better.mean(axis=0)
+    return sig
+
+
+def assign_ranks(sig, pval):
+    """Metrics get a new rank when they are significantly worse than every metric with the current rank."""
+    ranks = [1]
+    start = 0
+    for i in range(1, len(sig)):
+        if all(sig[j, i] < pval for j in range(start, i)):
+            ranks.append(ranks[-1] + 1)
+            start = i
+        else:
+            ranks.append(ranks[-1])
+    return ranks
+
+
+def compare_metrics(gold, metric_scores, corr="pearson", k=1000, pval=0.05, seed=None):
+    """Correlations, ranks and bootstrap significance of metrics against the same gold scores.
+
+    metric_scores maps metric names to scores aligned with gold. All k resamples are drawn at once and the correlations of
+    all metrics over all of them are computed as matrix products. A fixed seed makes the draws reproducible.
+    Returns ({metric: (corr, rank)} ordered from the best metric, sig_matrix), as reformat() in gemba.mtme_tools expects.
+    """
+    names = list(metric_scores)
+    gold = np.asarray(gold, dtype=np.float64)
+    metrics = np.array([metric_scores[name] for name in names], dtype=np.float64).reshape(len(names), len(gold))
+
+    observed = np.array([scipy_functions[corr](gold, scores)[0] for scores in metrics])
+    # best first, undefined correlations last
+    order = sorted(range(len(names)), key=lambda m: (np.isnan(observed[m]), -np.nan_to_num(observed[m])))
+
+    # without draws every difference counts as significant
+    sig = np.zeros((len(names), len(names)))
+    if k > 0:
+        counts = resample_counts(len(gold), k, np.random.default_rng(seed))
+        sig = sig_matrix(corr_functions[corr](gold, metrics[order], counts))
+
+    ranks = assign_ranks(sig, pval)
+    return {names[m]: (observed[m], rank) for m, rank in zip(order, ranks)}, sig
@@ -0,0 +1,52 @@
+import json
+import hashlib
+import diskcache as dc
+
+
+# API responses keyed by a hash of the canonical request, shared by all methods and entry points
+class ResponseCache:
+    def __init__(self, path="cache/responses"):
+        self.cache = dc.Cache(path, expire=None, size_limit=int(10e10), cull_limit=0, eviction_policy='none')
+
+    # n is the number of samples requested in one call
+    @staticmethod
+    def canonical_request(model, temperature, prompt, n=1):
+        # plain string prompt is sent as a single user message, so both forms are the same request
+        if isinstance(prompt, str):
+            prompt = [{"role": "user", "content": prompt}]
+        messages = [{"role": p["role"], "content": p["content"]} for p in prompt]
+        request = {"model": model, "temperature": temperature, "messages": messages}
+        # n is left out for single sample requests
+        if n != 1:
+            request["n"] = n
+        return json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+
+    @staticmethod
+    def key(model, temperature, prompt, n=1):
+        return hashlib.sha256(ResponseCache.canonical_request(model, temperature, prompt, n).encode("utf-8")).digest()
+
+    # returns None for requests that were not answered yet
+    def get(self, model, temperature, prompt, n=1):
+        value = self.cache.get(self.key(model, temperature, prompt, n))
+        if value is None:
+            return None
+        answers = json.loads(value)
+        if len(answers) == 0:
+            return None
+        return answers
+
+    def set(self, model, temperature, prompt, answers, n=1):
+        self.cache[self.key(model, temperature, prompt, n)] = json.dumps(answers, ensure_ascii=False, separators=(",", ":"))
+
+    def import_legacy(self, path):
+        """Copy answers from the old per-method cache (`cache/{model}_{method}`) into this cache."""
+        legacy = dc.Cache(path)
+        imported = 0
+        for request in legacy.iterkeys():
+            answers = legacy.get(request)
+            if answers is None or len(answers) == 0:
+                continue
+            self.set(request["model"], request["temperature"], request["prompt"], answers)
+            imported += 1
+        legacy.close()
+        return imported
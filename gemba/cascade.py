@@ -0,0 +1,153 @@
+import json
+from collections import Counter, defaultdict
+
+USAGE_FIELDS = ["api_calls", "api_seconds", "prompt_tokens", "completion_tokens"]
+
+
+# why the answer of the cheaper model is not final, None when it is
+def escalation_reason(parsed_answer, uncertainty_band=None):
+    answer = parsed_answer["answer"]
+    if answer is None:
+        return "parse_failure"
+    if parsed_answer["temperature"] > 0:
+        return "temperature"
+    numerical = isinstance(answer, (int, float)) and not isinstance(answer, bool)
+    if uncertainty_band is not None and numerical and uncertainty_band[0] <= answer <= uncertainty_band[1]:
+        return "uncertain"
+    return None
+
+
+# API usage of a model recorded so far in gemba.telemetry.Telemetry, the difference of two snapshots is the usage in between
+def usage(telemetry, model):
+    counters = telemetry.counters.get(model, {})
+    histograms = telemetry.histograms.get(model)
+    return {
+        "api_calls": counters.get("api_calls", 0),
+        "api_seconds": 0 if histograms is None else histograms["api_latency_seconds"].sum,
+        "prompt_tokens": counters.get("prompt_tokens", 0),
+        "completion_tokens": counters.get("completion_tokens", 0),
+    }
+
+
+def usage_difference(after, before):
+    return {name: after[name] - before[name] for name in USAGE_FIELDS}
+
+
+def add_usage(total, part):
+    for name in USAGE_FIELDS:
+        total[name] += part[name]
+
+
+def parse_prices(values):
+    """Prices given as model:input:output in USD per million prompt and completion tokens."""
+    prices = {}
+    for value in values or []:
+        model, prompt_price, completion_price = value.rsplit(":", 2)
+        prices[model] = (float(prompt_price), float(completion_price))
+    return prices
+
+
+# escalation rates and API usage of cascades over one or more calls of get_gemba_scores_cascade;
+# the usage without the cascade is estimated by scaling the usage of the stronger model on the escalated rows to all rows,
+# escalated rows tend to be the harder ones, so the estimate is rather low
+class CascadeReport:
+    def __init__(self, prices=None):
+        # model -> (USD per million prompt tokens, USD per million completion tokens)
+        self.prices = {} if prices is None else prices
+        self.runs = {}
+        self.cascade_usage = defaultdict(lambda: dict.fromkeys(USAGE_FIELDS, 0))
+
+    def run(self, method, model, cascade_model):
+        name = f"{method}:{model}"
+        if name not in self.runs:
+            self.runs[name] = {"model": model, "cascade_model": cascade_model, "rows": 0, "reasons": Counter(), "usage": dict.fromkeys(USAGE_FIELDS, 0)}
+        return self.runs[name]
+
+    def add_rows(self, method, model, cascade_model, rows, reasons):
+        run = self.run(method, model, cascade_model)
+        run["rows"] += rows
+        run["reasons"].update(reasons)
+
+    def add_escalated_usage(self, method, model, cascade_model, part):
+        add_usage(self.run(method, model, cascade_model)["usage"], part)
+
+    def add_cascade_usage(self, cascade_model, part):
+        add_usage(self.cascade_usage[cascade_model], part)
+
+    # None without prices of all models
+    def cost(self, model, part):
+        if model not in self.prices:
+            return None
+        prompt_price, completion_price = self.prices[model]
+        return (part["prompt_tokens"] * prompt_price + part["completion_tokens"] * completion_price) / 1e6
+
+    def summary(self):
+        runs = {}
+        actual = {"api_seconds": sum(u["api_seconds"] for u in self.cascade_usage.values()), "cost": 0}
+        without = {"api_seconds": 0, "cost": 0}
+        for model, part in self.cascade_usage.items():
+            actual["cost"] = none_or_sum(actual["cost"], self.cost(model, part))
+
+        for name, run in self.runs.items():
+            escalated = sum(run["reasons"].values())
+            estimate = None
+            if escalated > 0:
+                estimate = {field: value * run["rows"] / escalated for field, value in run["usage"].items()}
+            runs[name] = {
+                "model": run["model"],
+                "cascade_model": run["cascade_model"],
+                "rows": run["rows"],
+                "escalated": escalated,
+                "escalation_rate": escalated / run["rows"] if run["rows"] > 0 else None,
+                "reasons": dict(run["reasons"]),
+                "usage": run["usage"],
+                "estimated_usage_without_cascade": estimate,
+            }
+            actual["api_seconds"] += run["usage"]["api_seconds"]
+            actual["cost"] = none_or_sum(actual["cost"], self.cost(run["model"], run["usage"]))
+            without["api_seconds"] = none_or_sum(without["api_seconds"], None if estimate is None else estimate["api_seconds"])
+            without["cost"] = none_or_sum(without["cost"], None if estimate is None else self.cost(run["model"], estimate))
+
+        rows = sum(run["rows"] for run in runs.values())
+        escalated = sum(run["escalated"] for run in runs.values())
+        return {
+            "rows": rows,
+            "escalated": escalated,
+            "escalation_rate": escalated / rows if rows > 0 else None,
+            "runs": runs,
+            "cascade_models": dict(self.cascade_usage),
+            "api_seconds": actual["api_seconds"],
+            "estimated_api_seconds_without_cascade": without["api_seconds"],
+            "api_seconds_saved": none_or_difference(without["api_seconds"], actual["api_seconds"]),
+            "cost": actual["cost"],
+            "estimated_cost_without_cascade": without["cost"],
+            "cost_saved": none_or_difference(without["cost"], actual["cost"]),
+        }
+
+    def to_text(self):
+        summary = self.summary()
+        lines = []
+        for name, run in summary["runs"].items():
+            rate = "n/a" if run["escalation_rate"] is None else f"{run['escalation_rate']:.1%}"
+            reasons = ", ".join(f"{reason} {count}" for reason, count in sorted(run["reasons"].items())) or "none"
+            lines.append(f"{name}: {run['escalated']}/{run['rows']} rows escalated from {run['cascade_model']} ({rate}; {reasons})")
+        lines.append(f"API seconds {summary['api_seconds']:.1f}, without cascade ~{format_optional(summary['estimated_api_seconds_without_cascade'], '.1f')}, saved ~{format_optional(summary['api_seconds_saved'], '.1f')}")
+        if summary["cost"] is not None:
+            lines.append(f"Cost ${summary['cost']:.4f}, without cascade ~${format_optional(summary['estimated_cost_without_cascade'], '.4f')}, saved ~${format_optional(summary['cost_saved'], '.4f')}")
+        return "\n".join(lines)
+
+    def write(self, json_path):
+        with open(json_path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+def none_or_sum(a, b):
+    return None if a is None or b is None else a + b
+
+
+def none_or_difference(a, b):
+    return None if a is None or b is None else a - b
+
+
+def format_optional(value, spec):
+    return "n/a" if value is None else format(value, spec)
@@ -3,16 +3,49 @@ import sys
 
 from absl import app, flags
 
-from gemba.utils import get_gemba_scores
+from gemba.utils import get_gemba_scores, get_gemba_scores_multi, stream_gemba_scores, stream_gemba_scores_multi
+from gemba.rate_limiter import set_rate_limit
+from gemba.dedup import DEDUP_MODES
+from gemba.telemetry import Telemetry
+from gemba.tracing import add_sink, close_sinks, ChromeTraceSink, ProfileSink
+from gemba.sharding import merge_jsonl
+from gemba.cascade import CascadeReport, parse_prices
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string('method', "GEMBA-MQM", 'Which method to use?')
 flags.DEFINE_string('model', "gpt-4", 'OpenAI model')
+flags.DEFINE_list('runs', None, 'Score with several method:model pairs at once (e.g. GEMBA-DA:gpt-4,GEMBA-MQM:gpt-4) instead of --method and --model.')
 flags.DEFINE_string('source', None, 'Filepath to the source file.')
 flags.DEFINE_string('hypothesis', None, 'Filepath to the translation file.')
 flags.DEFINE_string('source_lang', None, 'Source language name.')
 flags.DEFINE_string('target_lang', None, 'Target language name.')
 flags.DEFINE_boolean('list_mqm_errors', False, 'List MQM errors.')
+flags.DEFINE_integer('concurrency', None, 'Number of parallel API requests, enables asynchronous scoring.')
+flags.DEFINE_integer('rpm', None, 'Requests per minute quota of the model deployment.')
+flags.DEFINE_integer('tpm', None, 'Tokens per minute quota of the model deployment.')
+flags.DEFINE_integer('breaker_threshold', 10, 'Consecutive failures (other than 429) after which requests to the model pause for --breaker_cooldown seconds.')
+flags.DEFINE_float('breaker_cooldown', 60, 'Seconds requests wait after --breaker_threshold consecutive failures before they are retried.')
+flags.DEFINE_integer('breaker_max_opens', 3, 'Number of times in a row the circuit breaker may open without a successful request before the run stops, 0 never stops.')
+flags.DEFINE_integer('retry_budget', None, 'Maximum number of retries for the whole run.')
+flags.DEFINE_boolean('batch', False, 'Submit requests through the Batch API and wait for the results.')
+flags.DEFINE_integer('samples', 1, 'Number of answers requested in one call when an answer cannot be parsed.')
+flags.DEFINE_boolean('aggregate_samples', False, 'Average all valid numerical answers instead of taking the first one.')
+flags.DEFINE_boolean('adaptive_max_tokens', True, 'Pick max_tokens from lengths of previous answers.')
+flags.DEFINE_string('output', None, 'JSONL file to which scores are appended as they finish. Segments already in the file are skipped.')
+flags.DEFINE_integer('chunk_size', 1000, 'Number of segments read at once when writing to --output.')
+flags.DEFINE_string('telemetry_json', None, 'Write a JSON summary of latencies, tokens, retries and cache hits to this file.')
+flags.DEFINE_string('telemetry_prometheus', None, 'Write the same metrics in Prometheus text format to this file.')
+flags.DEFINE_string('trace', None, 'Write spans of template building, cache lookups, API calls and parsing to this Chrome trace JSON file.')
+flags.DEFINE_string('profile', None, 'Write cProfile stats of the run to this file.')
+flags.DEFINE_list('profile_spans', None, 'Profile only inside spans with these names (e.g. parse,build_prompts) instead of the whole run.')
+flags.DEFINE_integer('shard', 0, 'Score only the segments of this shard (from 0 to --num_shards - 1), needs --output.')
+flags.DEFINE_integer('num_shards', 1, 'Number of shards run as independent processes or on different machines.')
+flags.DEFINE_list('merge_shards', None, 'Merge --output files (or directories with --runs) of all shards, in shard order, into --output instead of scoring.')
+flags.DEFINE_string('cascade_model', None, 'Score all segments with this cheaper model first and only uncertain ones with --model (or the models of --runs).')
+flags.DEFINE_list('uncertainty_band', None, 'Escalate segments whose score from --cascade_model lies within low,high (inclusive), besides unparsable answers and answers needing a higher temperature.')
+flags.DEFINE_string('cascade_report', None, 'Write escalation rates and the API time and cost saved by --cascade_model to this JSON file.')
+flags.DEFINE_list('model_prices', None, 'Prices as model:input:output in USD per million prompt and completion tokens, used for the cost in the cascade report.')
+flags.DEFINE_enum('dedup', "exact", DEDUP_MODES + ["none"], 'Send identical prompts only once, optionally ignoring whitespace and Unicode normalization differences.')
 
 def main(argv):
     assert FLAGS.source is not None, "Source file must be provided."
@@ -28,6 +61,57 @@ def main(argv):
     assert FLAGS.source_lang is not None, "Source language name must be provided."
     assert FLAGS.target_lang is not None, "Target language name must be provided."
 
+    runs = [(FLAGS.method, FLAGS.model)]
+    if FLAGS.runs is not None:
+        runs = [tuple(run.rsplit(":", 1)) for run in FLAGS.runs]
+        assert all(len(run) == 2 for run in runs), "Runs must be given as method:model."
+
+    assert 0 <= FLAGS.shard < FLAGS.num_shards, "Shard must be between 0 and num_shards - 1."
+    if FLAGS.merge_shards is not None:
+        assert FLAGS.output is not None, "Merged shards are written to --output."
+        merge(runs)
+        return
+    if FLAGS.num_shards > 1:
+        assert FLAGS.output is not None, "Shards must write to --output to be merged."
+
+    for model in set(model for _, model in runs):
+        set_rate_limit(model, rpm=FLAGS.rpm, tpm=FLAGS.tpm, breaker_threshold=FLAGS.breaker_threshold, breaker_cooldown=FLAGS.breaker_cooldown, breaker_max_opens=FLAGS.breaker_max_opens or None)
+    dedup = None if FLAGS.dedup == "none" else FLAGS.dedup
+    options = {"list_mqm_errors": FLAGS.list_mqm_errors, "concurrency": FLAGS.concurrency, "retry_budget": FLAGS.retry_budget, "batch": FLAGS.batch, "dedup": dedup,
+               "samples": FLAGS.samples, "aggregate_samples": FLAGS.aggregate_samples, "adaptive_max_tokens": FLAGS.adaptive_max_tokens,
+               "telemetry": Telemetry()}
+    if FLAGS.cascade_model is not None:
+        assert all(model != FLAGS.cascade_model for _, model in runs), "The cascade model must differ from the models it escalates to."
+        assert FLAGS.uncertainty_band is None or len(FLAGS.uncertainty_band) == 2, "Uncertainty band must be given as low,high."
+        set_rate_limit(FLAGS.cascade_model, rpm=FLAGS.rpm, tpm=FLAGS.tpm, breaker_threshold=FLAGS.breaker_threshold, breaker_cooldown=FLAGS.breaker_cooldown, breaker_max_opens=FLAGS.breaker_max_opens or None)
+        options["cascade_model"] = FLAGS.cascade_model
+        options["uncertainty_band"] = None if FLAGS.uncertainty_band is None else [float(x) for x in FLAGS.uncertainty_band]
+        options["cascade_report"] = CascadeReport(parse_prices(FLAGS.model_prices))
+    if FLAGS.trace is not None:
+        add_sink(ChromeTraceSink(FLAGS.trace))
+    if FLAGS.profile is not None:
+        add_sink(ProfileSink(FLAGS.profile, FLAGS.profile_spans))
+    try:
+        score(runs, options)
+    finally:
+        # also for interrupted runs, to see where the time went
+        options["telemetry"].write(FLAGS.telemetry_json, FLAGS.telemetry_prometheus)
+        if FLAGS.cascade_model is not None:
+            print(options["cascade_report"].to_text(), file=sys.stderr)
+            if FLAGS.cascade_report is not None:
+                options["cascade_report"].write(FLAGS.cascade_report)
+        close_sinks()
+
+
+def score(runs, options):
+    if FLAGS.output is not None:
+        if FLAGS.runs is not None:
+            # output is a directory with a file for every run
+            stream_gemba_scores_multi(FLAGS.source, FLAGS.hypothesis, FLAGS.output, FLAGS.source_lang, FLAGS.target_lang, runs, chunk_size=FLAGS.chunk_size, shard=FLAGS.shard, num_shards=FLAGS.num_shards, **options)
+        else:
+            stream_gemba_scores(FLAGS.source, FLAGS.hypothesis, FLAGS.output, FLAGS.source_lang, FLAGS.target_lang, FLAGS.method, FLAGS.model, chunk_size=FLAGS.chunk_size, shard=FLAGS.shard, num_shards=FLAGS.num_shards, **options)
+        return
+
     with open(FLAGS.source, 'r') as f:
         source = f.readlines()
     source = [x.strip() for x in source]
@@ -37,12 +121,34 @@ def main(argv):
 
     assert len(source) == len(hypothesis), "Source and hypothesis files must have the same number of lines."
 
-    answers = get_gemba_scores(source, hypothesis, FLAGS.source_lang, FLAGS.target_lang, FLAGS.method, FLAGS.model, FLAGS.list_mqm_errors)
+    if FLAGS.runs is not None:
+        # one column for every run
+        scores = get_gemba_scores_multi(source, hypothesis, FLAGS.source_lang, FLAGS.target_lang, runs, **options)
+        print("\t".join(f"{method}:{model}" for method, model in scores))
+        for row in zip(*scores.values()):
+            print("\t".join(str(answer) for answer in row))
+        return
+
+    answers = get_gemba_scores(source, hypothesis, FLAGS.source_lang, FLAGS.target_lang, FLAGS.method, FLAGS.model, **options)
 
     for answer in answers:
         print(answer)
 
 
+def merge(runs):
+    with open(FLAGS.source, 'r') as f:
+        segment_count = sum(1 for _ in f)
+
+    if FLAGS.runs is None:
+        merge_jsonl(FLAGS.merge_shards, FLAGS.output, segment_count)
+        return
+
+    os.makedirs(FLAGS.output, exist_ok=True)
+    for method, model in runs:
+        name = f"{method}_{model}.jsonl"
+        merge_jsonl([os.path.join(path, name) for path in FLAGS.merge_shards], os.path.join(FLAGS.output, name), segment_count)
+
+
 def run():
     """Entry point used by console_scripts and `python -m gemba`."""
     app.run(main)
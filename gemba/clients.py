@@ -0,0 +1,64 @@
+import os
+import asyncio
+import weakref
+import openai
+
+# connection pool of the shared clients, change it with set_pool_options() before the first request;
+# http2 needs the h2 package (pip install httpx[http2])
+pool_options = {
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 30.0,
+    "http2": False,
+    "timeout": 600.0,
+    "connect_timeout": 10.0,
+}
+
+clients = {}
+# async clients can be used only in the event loop that created them
+async_clients = weakref.WeakKeyDictionary()
+
+
+def set_pool_options(**options):
+    for name in options:
+        assert name in pool_options, f"Unknown connection pool option {name}"
+    pool_options.update(options)
+
+
+def http_client_args():
+    # Limits class of the httpx the openai package is built on
+    limits = type(openai.DEFAULT_CONNECTION_LIMITS)(
+        max_connections=pool_options["max_connections"],
+        max_keepalive_connections=pool_options["max_keepalive_connections"],
+        keepalive_expiry=pool_options["keepalive_expiry"],
+    )
+    timeout = openai.Timeout(pool_options["timeout"], connect=pool_options["connect_timeout"])
+    return {"limits": limits, "http2": pool_options["http2"], "timeout": timeout}
+
+
+def client_key(client_class, client_args):
+    # the client reads the endpoint from the environment when it is not given
+    return (client_class.__name__, os.environ.get("OPENAI_BASE_URL"), tuple(sorted((name, str(value)) for name, value in client_args.items())))
+
+
+def get_client(client_class, client_args):
+    """Return the process-wide client for the endpoint and credentials in client_args, it is created on first use."""
+    key = client_key(client_class, client_args)
+    if key not in clients:
+        clients[key] = client_class(**client_args, http_client=openai.DefaultHttpxClient(**http_client_args()))
+    return clients[key]
+
+
+def get_async_client(client_class, client_args):
+    """Like get_client for async clients, there is one for each running event loop."""
+    loop_clients = async_clients.setdefault(asyncio.get_running_loop(), {})
+    key = client_key(client_class, client_args)
+    if key not in loop_clients:
+        loop_clients[key] = client_class(**client_args, http_client=openai.DefaultAsyncHttpxClient(**http_client_args()))
+    return loop_clients[key]
+
+
+async def close_async_clients():
+    """Close the async clients of the running event loop, to be awaited before the loop finishes."""
+    for client in async_clients.pop(asyncio.get_running_loop(), {}).values():
+        await client.close()
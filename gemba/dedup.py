@@ -0,0 +1,42 @@
+import re
+import json
+import hashlib
+import unicodedata
+
+# exact: byte-identical prompts, whitespace: ignore differences in whitespace, unicode: also NFKC normalization
+DEDUP_MODES = ["exact", "whitespace", "unicode"]
+
+whitespace_re = re.compile(r"\s+")
+
+
+def normalize_text(text, mode="exact"):
+    if mode == "unicode":
+        text = unicodedata.normalize("NFKC", text)
+    if mode in ["whitespace", "unicode"]:
+        text = whitespace_re.sub(" ", text).strip()
+    return text
+
+
+def prompt_key(prompt, mode="exact"):
+    if isinstance(prompt, str):
+        prompt = [{"role": "user", "content": prompt}]
+    messages = [[p["role"], normalize_text(p["content"], mode)] for p in prompt]
+    return hashlib.blake2b(json.dumps(messages, ensure_ascii=False).encode("utf-8"), digest_size=16).digest()
+
+
+def deduplicate_prompts(prompts, mode="exact"):
+    """Collapse identical prompts.
+
+    Returns the unique prompts (first occurrence of each) and for every input prompt the index of its unique prompt.
+    """
+    assert mode in DEDUP_MODES, f"Unknown deduplication mode {mode}"
+    unique = []
+    positions = {}
+    inverse = []
+    for prompt in prompts:
+        key = prompt_key(prompt, mode)
+        if key not in positions:
+            positions[key] = len(unique)
+            unique.append(prompt)
+        inverse.append(positions[key])
+    return unique, inverse
@@ -0,0 +1,356 @@
+"""Local stand-in for the OpenAI chat completions and batch endpoints used for benchmarks and offline runs.
+
+Start it with `python -m gemba.fake_openai --port=8000` and point the client to it:
+
+    export OPENAI_API_KEY=fake
+    export OPENAI_BASE_URL=http://127.0.0.1:8000/v1
+"""
+import re
+import json
+import math
+import time
+import zlib
+import random
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from absl import app, flags
+
+
+# answers are picked by a hash of the prompt so that identical prompts get identical answers
+default_answers = {
+    "GEMBA-DA": ["95", "85", "70", "60", "35"],
+    "GEMBA-stars": ["5 stars", "4 stars", "3 stars", "2 stars"],
+    "GEMBA-classes": ["Perfect translation", "Most meaning preserved, minor issues", "Some meaning preserved and understandable"],
+    "GEMBA-MQM": [
+        "Critical:\nno-error\nMajor:\nno-error\nMinor:\nno-error",
+        "Critical:\nno-error\nMajor:\naccuracy/mistranslation - \"bank\"\nMinor:\nfluency/punctuation - \",\"",
+        "Critical:\naccuracy/omission - \"not\"\nMajor:\nno-error\nMinor:\nstyle/awkward - \"in order to\"",
+    ],
+    "GEMBA-ESA": [
+        "Major:\nno-error\nMinor:\nno-error",
+        "Major:\naccuracy/mistranslation - \"bank\"\nMinor:\nfluency/grammar - \"was\"",
+    ],
+    "GEMBA-ESA_ranking": ["90", "75", "50"],
+}
+
+invalid_answer = "I am not able to score this translation."
+
+
+def detect_method(messages):
+    text = "\n".join(m["content"] for m in messages)
+    if "annotated error spans" in text:
+        return "GEMBA-ESA_ranking"
+    if "three categories: critical, major, and minor" in text:
+        return "GEMBA-MQM"
+    if "two categories: major or minor" in text:
+        return "GEMBA-ESA"
+    if "Stars: " in text:
+        return "GEMBA-stars"
+    if "Class: " in text:
+        return "GEMBA-classes"
+    return "GEMBA-DA"
+
+
+class FakeOpenAI:
+    def __init__(self, latency="constant", latency_mean=0.05, latency_sigma=0.5, rate_limit_rate=0, server_error_rate=0,
+                 truncation_rate=0, invalid_rate=0, retry_after=None, answers=None, seed=None, batch_latency=0):
+        assert latency in ["constant", "uniform", "lognormal"], f"Unknown latency distribution {latency}"
+        self.latency = latency
+        self.latency_mean = latency_mean
+        self.latency_sigma = latency_sigma
+        self.rate_limit_rate = rate_limit_rate
+        self.server_error_rate = server_error_rate
+        self.truncation_rate = truncation_rate
+        self.invalid_rate = invalid_rate
+        self.retry_after = retry_after
+        self.batch_latency = batch_latency
+        self.answers = dict(default_answers)
+        if answers is not None:
+            self.answers.update(answers)
+
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"connections": 0, "requests": 0, "completions": 0, "rate_limited": 0, "server_errors": 0, "truncated": 0, "invalid": 0}
+        self.latencies = []
+        self.files = {}
+        self.batches = {}
+        self.prefixes = set()
+
+        self.httpd = None
+        self.thread = None
+
+    def sample_latency(self):
+        with self.lock:
+            if self.latency == "constant":
+                return self.latency_mean
+            if self.latency == "uniform":
+                return self.random.uniform(0, 2 * self.latency_mean)
+            # lognormal with the requested mean
+            mu = math.log(self.latency_mean) - self.latency_sigma ** 2 / 2
+            return self.random.lognormvariate(mu, self.latency_sigma)
+
+    def draw(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    # returns status code, headers and json body
+    def chat_completion(self, body, simulate_latency=True):
+        self.count("requests")
+        latency = self.sample_latency() if simulate_latency else 0
+        time.sleep(latency)
+
+        if self.draw(self.rate_limit_rate):
+            self.count("rate_limited")
+            headers = {}
+            if self.retry_after is not None:
+                headers["retry-after"] = str(self.retry_after)
+            return 429, headers, {"error": {"message": "Rate limit reached.", "type": "rate_limit_error", "code": "rate_limit_exceeded"}}
+        if self.draw(self.server_error_rate):
+            self.count("server_errors")
+            return 500, {}, {"error": {"message": "The server had an error.", "type": "server_error", "code": None}}
+
+        messages = body["messages"]
+        method = detect_method(messages)
+        candidates = self.answers[method]
+        prompt = json.dumps(messages, ensure_ascii=False)
+        prompt_tokens = len(prompt) // 4
+        cached_tokens = self.cached_tokens(messages)
+
+        choices = []
+        completion_tokens = 0
+        for i in range(body.get("n") or 1):
+            finish_reason = "stop"
+            # the first sample is deterministic, the following ones vary
+            answer = candidates[(zlib.crc32(prompt.encode("utf-8")) + i) % len(candidates)]
+            if self.draw(self.invalid_rate):
+                self.count("invalid")
+                answer = invalid_answer
+            if self.draw(self.truncation_rate):
+                self.count("truncated")
+                answer = answer[:len(answer) // 2]
+                finish_reason = "length"
+            completion_tokens += max(1, len(answer) // 4)
+            choices.append({"index": i, "message": {"role": "assistant", "content": answer}, "finish_reason": finish_reason, "logprobs": None})
+
+        self.count("completions")
+        with self.lock:
+            self.latencies.append(latency)
+
+        return 200, {}, {
+            "id": f"chatcmpl-fake-{self.stats['requests']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": choices,
+            "usage": {
+                "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            },
+        }
+
+    # prompt caching as done by the provider: prefixes of at least 1024 tokens are cached in 128 token increments
+    def cached_tokens(self, messages):
+        prefix = json.dumps(messages[:-1], ensure_ascii=False)
+        prefix_tokens = len(prefix) // 4
+        if prefix_tokens < 1024:
+            return 0
+        key = zlib.crc32(prefix.encode("utf-8"))
+        with self.lock:
+            if key not in self.prefixes:
+                self.prefixes.add(key)
+                return 0
+        return prefix_tokens // 128 * 128
+
+    def upload_file(self, content_type, body):
+        message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + body)
+        fields = {}
+        for part in message.iter_parts():
+            fields[part.get_param("name", header="content-disposition")] = (part.get_filename(), part.get_payload(decode=True))
+
+        filename, data = fields["file"]
+        purpose = fields["purpose"][1].decode("utf-8")
+        return 200, {}, self.store_file(filename, data, purpose)
+
+    def store_file(self, filename, data, purpose):
+        with self.lock:
+            file_id = f"file-fake-{len(self.files)}"
+            self.files[file_id] = {
+                "id": file_id, "object": "file", "bytes": len(data), "created_at": int(time.time()),
+                "filename": filename, "purpose": purpose, "status": "processed", "data": data,
+            }
+        return self.file_object(file_id)
+
+    def file_object(self, file_id):
+        return {k: v for k, v in self.files[file_id].items() if k != "data"}
+
+    def create_batch(self, body):
+        if body.get("input_file_id") not in self.files:
+            return 404, {}, {"error": {"message": "Input file not found.", "type": "invalid_request_error", "code": None}}
+
+        with self.lock:
+            batch_id = f"batch-fake-{len(self.batches)}"
+            self.batches[batch_id] = {
+                "id": batch_id, "object": "batch", "endpoint": body["endpoint"], "input_file_id": body["input_file_id"],
+                "completion_window": body["completion_window"], "created_at": int(time.time()), "status": "in_progress",
+                "output_file_id": None, "error_file_id": None, "request_counts": {"total": 0, "completed": 0, "failed": 0},
+            }
+        threading.Thread(target=self.run_batch, args=(batch_id,), daemon=True).start()
+        return 200, {}, self.batches[batch_id]
+
+    # batch lines go through the same answer generation and error injection as interactive requests
+    def run_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        lines = self.files[batch["input_file_id"]]["data"].decode("utf-8").splitlines()
+        lines = [json.loads(line) for line in lines if line.strip() != ""]
+        batch["request_counts"]["total"] = len(lines)
+        time.sleep(self.batch_latency)
+
+        output = []
+        for i, line in enumerate(lines):
+            status, headers, response = self.chat_completion(line["body"], simulate_latency=False)
+            output.append(json.dumps({
+                "id": f"batch_req_{i}", "custom_id": line["custom_id"],
+                "response": {"status_code": status, "request_id": f"req_{i}", "body": response}, "error": None,
+            }))
+            batch["request_counts"]["completed" if status == 200 else "failed"] += 1
+
+        output_file = self.store_file(f"{batch_id}_output.jsonl", ("\n".join(output) + "\n").encode("utf-8"), "batch_output")
+        batch["output_file_id"] = output_file["id"]
+        batch["completed_at"] = int(time.time())
+        batch["status"] = "completed"
+
+    def start(self, host="127.0.0.1", port=0):
+        self.httpd = FakeOpenAIServer((host, port), FakeOpenAIHandler)
+        self.httpd.fake = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self.base_url
+
+    def stop(self):
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 drops connections of concurrent clients which then wait a second for the SYN retry
+    request_queue_size = 1024
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    # keep-alive connections as the real endpoint does
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, without this every response waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        self.server.fake.count("connections")
+        super().setup()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        fake = self.server.fake
+
+        # both OpenAI (/v1/chat/completions) and Azure (/openai/deployments/{name}/chat/completions) paths
+        path = self.path.split("?")[0]
+        if path.endswith("/chat/completions"):
+            self.respond(*fake.chat_completion(json.loads(body)))
+        elif path.endswith("/files"):
+            self.respond(*fake.upload_file(self.headers["Content-Type"], body))
+        elif path.endswith("/batches"):
+            self.respond(*fake.create_batch(json.loads(body)))
+        else:
+            self.not_found(path)
+
+    def do_GET(self):
+        fake = self.server.fake
+        path = self.path.split("?")[0]
+
+        match = re.search(r"/batches/([^/]+)$", path)
+        if match is not None and match.group(1) in fake.batches:
+            self.respond(200, {}, fake.batches[match.group(1)])
+            return
+        match = re.search(r"/files/([^/]+)(/content)?$", path)
+        if match is not None and match.group(1) in fake.files:
+            if match.group(2) is None:
+                self.respond(200, {}, fake.file_object(match.group(1)))
+            else:
+                self.respond_bytes(200, fake.files[match.group(1)]["data"], "application/octet-stream")
+            return
+        self.not_found(path)
+
+    def not_found(self, path):
+        self.respond(404, {}, {"error": {"message": f"Unknown path {path}", "type": "invalid_request_error", "code": None}})
+
+    def respond(self, status, headers, response):
+        self.respond_bytes(status, json.dumps(response).encode("utf-8"), "application/json", headers)
+
+    def respond_bytes(self, status, data, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string('host', "127.0.0.1", 'Host to listen on.')
+flags.DEFINE_integer('port', 8000, 'Port to listen on.')
+flags.DEFINE_enum('latency', "constant", ["constant", "uniform", "lognormal"], 'Latency distribution of responses.')
+flags.DEFINE_float('latency_mean', 0.05, 'Mean latency in seconds.')
+flags.DEFINE_float('latency_sigma', 0.5, 'Sigma of the lognormal latency distribution.')
+flags.DEFINE_float('rate_limit_rate', 0, 'Fraction of requests answered with 429.')
+flags.DEFINE_float('server_error_rate', 0, 'Fraction of requests answered with 500.')
+flags.DEFINE_float('truncation_rate', 0, 'Fraction of answers cut with finish_reason="length".')
+flags.DEFINE_float('invalid_rate', 0, 'Fraction of answers that cannot be parsed.')
+flags.DEFINE_float('retry_after', None, 'Retry-After header sent with 429 responses.')
+flags.DEFINE_string('answers', None, 'JSON file mapping method names to lists of canned answers.')
+flags.DEFINE_integer('seed', None, 'Random seed.')
+flags.DEFINE_float('batch_latency', 0, 'Seconds before a submitted batch completes.')
+
+
+def main(argv):
+    answers = None
+    if FLAGS.answers is not None:
+        with open(FLAGS.answers, 'r') as f:
+            answers = json.load(f)
+
+    fake = FakeOpenAI(FLAGS.latency, FLAGS.latency_mean, FLAGS.latency_sigma, FLAGS.rate_limit_rate, FLAGS.server_error_rate,
+                      FLAGS.truncation_rate, FLAGS.invalid_rate, FLAGS.retry_after, answers, FLAGS.seed, FLAGS.batch_latency)
+    fake.start(FLAGS.host, FLAGS.port)
+    print(f"Serving fake OpenAI API on {fake.base_url}")
+    try:
+        fake.thread.join()
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -1,27 +1,46 @@
-import diskcache as dc
+from absl import app, flags
 from gemba.prompt import prompts, language_codes
 from gemba.gpt_api import GptApi
+from gemba.cache import ResponseCache
+from gemba.dedup import prompt_key
 from gemba.testset import Testset
-from gemba.scores import Scores
+from gemba.scores import Scores, merge_scores
+from gemba.parsing import get_parser
+from gemba.adaptive import AdaptiveSampler
 
+FLAGS = flags.FLAGS
+flags.DEFINE_integer('shard', 0, 'Score only the segments of this shard, from 0 to --num_shards - 1.')
+flags.DEFINE_integer('num_shards', 1, 'Number of shards run as independent processes or on different machines.')
+flags.DEFINE_list('systems', None, 'Score only these systems, the files of other systems are never read.')
+flags.DEFINE_boolean('columnar', False, 'Also write the scores with domains, temperatures and raw answers to a Parquet file (needs pyarrow).')
+flags.DEFINE_boolean('merge', False, 'Merge the scores of all --num_shards shards into the standard score files instead of scoring.')
+flags.DEFINE_integer('samples', 1, 'Number of answers requested in one call when an answer cannot be parsed.')
+flags.DEFINE_boolean('aggregate_samples', False, 'Average all valid numerical answers instead of taking the first one.')
+flags.DEFINE_boolean('adaptive', False, 'Score randomized batches of segments stratified by domain until all pairwise system orderings are significant, for system-level rankings only.')
+flags.DEFINE_integer('adaptive_batch', 100, 'Number of segments of every system scored between two significance checks of --adaptive.')
+flags.DEFINE_integer('adaptive_budget', None, 'Maximum number of segments of every system scored with --adaptive.')
+flags.DEFINE_float('adaptive_pval', 0.05, 'p-value below which a pairwise system ordering is significant with --adaptive.')
+flags.DEFINE_integer('adaptive_seed', 0, 'Seed of the segment order and of the bootstrap draws of --adaptive.')
 
-def main():
+
+def main(argv):
+    assert 0 <= FLAGS.shard < FLAGS.num_shards, "Shard must be between 0 and num_shards - 1."
+    assert not FLAGS.adaptive or FLAGS.num_shards == 1, "Adaptive sampling decides which segments to score from all scores so far, it cannot be sharded."
     scenarios = [
         ["text-davinci-003", "GEMBA-DA", [["wmt22", "en-de"], ["wmt22", "zh-en"], ["wmt22", "en-ru"]], ],
         ["text-davinci-003", "GEMBA-DA_ref", [["wmt22", "en-de"], ["wmt22", "zh-en"], ["wmt22", "en-ru"]], ],
     ]
 
-    gptapi = GptApi()
+    # merging needs no API access
+    if not FLAGS.merge:
+        gptapi = GptApi(samples=FLAGS.samples, aggregate_samples=FLAGS.aggregate_samples)
+        cache = ResponseCache()
     for scenario in scenarios:
         use_model = scenario[0]
         annotation = scenario[1]
-        cache = dc.Cache(f'cache/{use_model}_{annotation}', expire=None, size_limit=int(10e10), cull_limit=0, eviction_policy='none')
 
         scoring_name = f"{annotation}_{use_model}"
-
-        if use_model not in credentials["deployments"].keys():
-            print(f"Model {use_model} not supported by credentials")
-            continue
+        assert not FLAGS.aggregate_samples or not prompts[annotation].get("categorical"), f"Categorical answers of {annotation} cannot be averaged with --aggregate_samples."
 
         for dataset, lp in scenario[2]:
             testset = Testset("mt-metrics-eval-v2", dataset, lp)
@@ -30,17 +49,20 @@ def main():
             else:
                 refname = None
 
-            scores = Scores(scoring_name, testset, refname)
+            if FLAGS.merge:
+                merge_scores(scoring_name, testset, refname, FLAGS.num_shards, columnar=FLAGS.columnar)
+                continue
 
-            # starts with -1 as it is incremented before the first request
-            hypothesis_index = -1
-            total = testset.segments_count()
-            for src, hyp, ref, system in testset.iterate_over_all(refname):
-                hypothesis_index += 1
+            scores = Scores(scoring_name, testset, refname, shard=FLAGS.shard, num_shards=FLAGS.num_shards, columnar=FLAGS.columnar)
+            parse_answer = get_parser(annotation)
 
-                if scores.get_score(system, hypothesis_index) != 'None':
-                    continue
+            # identical hypotheses of different systems are requested only once
+            answered = {}
+            saved = 0
+            total = testset.segments_count()
 
+            def score_segment(src, hyp, ref, system, hypothesis_index):
+                nonlocal saved
                 print(f"Processing hypothesis {hypothesis_index}/{total} for {scoring_name} on {dataset}/{lp}")
 
                 data = {
@@ -51,12 +73,39 @@ def main():
                     "target_lang": language_codes[lp.split("-")[1]],
                 }
                 prompt = prompts[annotation]["prompt"].format(**data)
-                parsed_answers = gptapi.request(prompt, use_model, prompts[annotation]["validate_answer"], cache=cache)
+                key = prompt_key(prompt)
+                if key in answered:
+                    saved += 1
+                else:
+                    answered[key] = gptapi.request(prompt, use_model, parse_answer, cache=cache)
+                parsed_answers = answered[key]
+
+                scores.assign_score(system, hypothesis_index, parsed_answers[0]['answer'], parsed_answers[0]['temperature'], parsed_answers[0].get('raw_answer'),
+                                    parsed_answers[0].get('sample'), parsed_answers[0].get('valid_samples'))
+
+            if FLAGS.adaptive:
+                sampler = AdaptiveSampler(scores, systems=FLAGS.systems, batch_size=FLAGS.adaptive_batch, budget=FLAGS.adaptive_budget, pval=FLAGS.adaptive_pval, seed=FLAGS.adaptive_seed)
+                for batch in sampler.batches():
+                    for system in sampler.systems:
+                        for index in batch:
+                            if not scores.has_score(system, index):
+                                ref = None if refname is None else testset.references[refname][index]
+                                score_segment(testset.sources[index], testset.systems[system][index], ref, system, index)
+                sampler.save()
+                print(f"Adaptive sampling stopped ({sampler.stop_reason}) after {len(sampler.sampled)}/{scores.segment_count} segments for {scoring_name} on {dataset}/{lp}")
+            else:
+                # starts with -1 as it is incremented before the first request
+                hypothesis_index = -1
+                for src, hyp, ref, system in testset.iterate_over_all(refname, systems=FLAGS.systems):
+                    hypothesis_index += 1
 
-                scores.assign_score(system, hypothesis_index, parsed_answers[0]['answer'], parsed_answers[0]['temperature'])
+                    if not scores.in_shard(system, hypothesis_index) or scores.has_score(system, hypothesis_index):
+                        continue
+                    score_segment(src, hyp, ref, system, hypothesis_index)
 
+            print(f"Deduplication saved {saved} requests for {scoring_name} on {dataset}/{lp}")
             scores.save()
 
 
 if __name__ == '__main__':
-    main()
+    app.run(main)
@@ -1,48 +1,129 @@
 import os
 import sys
+import json
 import time
+import asyncio
+import itertools
 import ipdb
 import logging
 from termcolor import colored
 from datetime import datetime
 import openai
+from openai.types.chat import ChatCompletion
 import tqdm
+from gemba.dedup import deduplicate_prompts
+from gemba.clients import get_client, get_async_client, close_async_clients
+from gemba.telemetry import Telemetry
+from gemba.tracing import span
+from gemba.rate_limiter import get_rate_limiter, estimate_tokens, RetryBudgetExceeded
 
 
 # class for calling OpenAI API and handling cache
 class GptApi:
-    def __init__(self, verbose=False):
+    # retry_budget limits the total number of retries over the lifetime of the instance, None means unlimited
+    # samples > 1 asks for that many answers in one call when the temperature is increased instead of a single one,
+    # the first valid answer is used or the average of all valid numerical answers with aggregate_samples,
+    # aggregate_samples must not be used for categorical answers (see prompts[method]["categorical"])
+    # telemetry (gemba.telemetry.Telemetry) collects latencies, tokens, retries and cache hits, a new one is created if not given
+    def __init__(self, verbose=False, retry_budget=None, samples=1, aggregate_samples=False, telemetry=None):
         self.verbose = verbose
+        self.retry_budget = retry_budget
+        self.samples = samples
+        self.aggregate_samples = aggregate_samples
+        self.retries = 0
+        # number of requests saved by deduplication
+        self.deduplicated = 0
+        # token usage of all API calls, cached_tokens are prompt tokens served from the provider's prompt cache
+        self.usage = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+        self.telemetry = Telemetry() if telemetry is None else telemetry
 
         if "OPENAI_AZURE_ENDPOINT" in os.environ:
             assert "OPENAI_AZURE_KEY" in os.environ, "OPENAI_AZURE_KEY not found in environment"
 
             # Azure API access
-            self.client = openai.AzureOpenAI(
-                api_key=os.environ["OPENAI_AZURE_KEY"],
-                azure_endpoint=os.environ["OPENAI_AZURE_ENDPOINT"],
-                api_version="2023-07-01-preview"
-            )
+            client_args = {
+                "api_key": os.environ["OPENAI_AZURE_KEY"],
+                "azure_endpoint": os.environ["OPENAI_AZURE_ENDPOINT"],
+                "api_version": "2023-07-01-preview",
+                # retries are handled by the rate limiter
+                "max_retries": 0,
+            }
+            self.client = get_client(openai.AzureOpenAI, client_args)
+            self.async_client_class = openai.AsyncAzureOpenAI
+            # Azure Batch API needs a Global-Batch deployment
+            self.batch_endpoint = "/chat/completions"
         elif "OPENAI_API_KEY" in os.environ:
             # OpenAI API access
-            self.client = openai.OpenAI(
-                api_key=os.environ["OPENAI_API_KEY"]
-            )
+            client_args = {
+                "api_key": os.environ["OPENAI_API_KEY"],
+                # retries are handled by the rate limiter
+                "max_retries": 0,
+            }
+            self.client = get_client(openai.OpenAI, client_args)
+            self.async_client_class = openai.AsyncOpenAI
+            self.batch_endpoint = "/v1/chat/completions"
         else:
             raise Exception("OPENAI_API_KEY or OPENAI_AZURE_KEY not found in environment")
+        self.client_args = client_args
 
         logging.getLogger().setLevel(logging.CRITICAL)  # in order to suppress all these HTTP INFO log messages
 
     # answer_id is used for determining if it was the top answer or how deep in the list it was
-    def request(self, prompt, model, parse_response, temperature=0, answer_id=-1, cache=None, max_tokens=None):
-        request = {"model": model, "temperature": temperature, "prompt": prompt}
+    # token_estimator (MaxTokensEstimator) picks max_tokens from lengths of previous answers, max_tokens is its default
+    def request(self, prompt, model, parse_response, temperature=0, answer_id=-1, cache=None, max_tokens=None, token_estimator=None):
+        return run_sync(self.request_with(SyncTransport(self), prompt, model, parse_response, temperature, answer_id, cache, max_tokens, token_estimator))
+
+    async def request_async(self, prompt, model, parse_response, temperature=0, answer_id=-1, cache=None, max_tokens=None, token_estimator=None):
+        return await self.request_with(AsyncTransport(self), prompt, model, parse_response, temperature, answer_id, cache, max_tokens, token_estimator)
 
-        if request in cache and cache[request] is not None and len(cache[request]) > 0:
-            answers = cache[request]
+    # shared by request and request_async, transport sends the API calls and sleeps
+    async def request_with(self, transport, prompt, model, parse_response, temperature=0, answer_id=-1, cache=None, max_tokens=None, token_estimator=None):
+        n = self.samples if temperature > 0 else 1
+        with span("cache_get", model=model, temperature=temperature):
+            answers = cache.get(model, temperature, prompt, n)
+        if answers is None:
+            self.telemetry.count(model, "cache_misses")
+            if token_estimator is not None:
+                max_tokens = token_estimator.max_tokens(max_tokens)
+            with span("request_api", model=model, temperature=temperature, max_tokens=max_tokens, n=n):
+                answers = await self.request_api_with(transport, prompt, model, temperature, max_tokens, n=n, token_estimator=token_estimator)
+            with span("cache_set", model=model, temperature=temperature):
+                cache.set(model, temperature, prompt, answers, n)
+            if token_estimator is not None:
+                token_estimator.observe_answers(answers)
         else:
-            answers = self.request_api(prompt, model, temperature, max_tokens)
-            cache[request] = answers
+            self.telemetry.count(model, "cache_hits")
+            if token_estimator is not None and token_estimator.observations() < token_estimator.min_observations:
+                # cached answers are used to warm up the estimator, afterwards they would only repeat what it already knows
+                token_estimator.observe_answers(answers)
+
+        with span("parse", model=model, temperature=temperature, answers=len(answers)):
+            parsed_answers, answer_id = self.parse_answers(answers, prompt, model, parse_response, temperature, answer_id)
+
+        # there was no valid answer, increase temperature and try again
+        if parsed_answers is None:
+            self.telemetry.count(model, "escalations")
+            return await self.request_with(transport, prompt, model, parse_response, temperature=temperature + 1, answer_id=answer_id, cache=cache, token_estimator=token_estimator)
 
+        self.telemetry.count(model, "requests")
+        self.telemetry.observe(model, "temperature", temperature)
+        if self.samples > 1:
+            return self.select_sample(parsed_answers)
+        return parsed_answers
+
+    # "sample" is the index of the chosen answer among the samples or None when they were averaged,
+    # "valid_samples" the number of samples that could be parsed
+    def select_sample(self, parsed_answers):
+        chosen = dict(parsed_answers[0])
+        chosen["valid_samples"] = len(parsed_answers)
+        numerical = all(isinstance(a["answer"], (int, float)) and not isinstance(a["answer"], bool) for a in parsed_answers)
+        if self.aggregate_samples and numerical and len(parsed_answers) > 1:
+            chosen["answer"] = sum(a["answer"] for a in parsed_answers) / len(parsed_answers)
+            chosen["sample"] = None
+        return [chosen]
+
+    # returns None when none of the answers could be parsed and the temperature should be increased
+    def parse_answers(self, answers, prompt, model, parse_response, temperature, answer_id):
         # there is no valid answer
         if len(answers) == 0:
             return [{
@@ -52,10 +133,10 @@ class GptApi:
                     "prompt": prompt,
                     "finish_reason": None,
                     "model": model,
-                    }]
+                    }], answer_id
 
         parsed_answers = []
-        for full_answer in answers:
+        for sample, full_answer in enumerate(answers):
             finish_reason = full_answer["finish_reason"]
             full_answer = full_answer["answer"]
             answer_id += 1
@@ -63,6 +144,7 @@ class GptApi:
             if self.verbose or temperature > 0:
                 print(f"Answer (t={temperature}): " + colored(answer, "yellow") + " (" + colored(full_answer, "blue") + ")", file=sys.stderr)
             if answer is None:
+                self.telemetry.count(model, "parse_failures")
                 continue
             parsed_answers.append(
                 {
@@ -72,71 +154,191 @@ class GptApi:
                     "prompt": prompt,
                     "finish_reason": finish_reason,
                     "model": model,
+                    "sample": sample,
+                    "raw_answer": full_answer,
                 }
             )
 
-        # there was no valid answer, increase temperature and try again
         if len(parsed_answers) == 0:
-            return self.request(prompt, model, parse_response, temperature=temperature + 1, answer_id=answer_id, cache=cache)
+            return None, answer_id
 
-        return parsed_answers
+        return parsed_answers, answer_id
 
-    def request_api(self, prompt, model, temperature=0, max_tokens=None):
+    def request_api(self, prompt, model, temperature=0, max_tokens=None, n=1, token_estimator=None):
+        return run_sync(self.request_api_with(SyncTransport(self), prompt, model, temperature, max_tokens, n, token_estimator))
+
+    async def request_api_async(self, prompt, model, temperature=0, max_tokens=None, n=1, token_estimator=None):
+        return await self.request_api_with(AsyncTransport(self), prompt, model, temperature, max_tokens, n, token_estimator)
+
+    async def request_api_with(self, transport, prompt, model, temperature=0, max_tokens=None, n=1, token_estimator=None):
         if temperature > 10:
             return []
 
+        limiter = get_rate_limiter(model)
+        estimated_tokens = estimate_tokens(prompt, max_tokens)
+        attempt = 0
         while True:
+            queue_wait = limiter.acquire(estimated_tokens)
+            await transport.sleep(queue_wait)
+            start = time.perf_counter()
             try:
-                response = self.call_api(prompt, model, temperature, max_tokens)
-                break
+                with span("api_call", model=model, attempt=attempt, queue_wait=queue_wait):
+                    response = await transport.call_api(prompt, model, temperature, max_tokens, n)
             except Exception as e:
-                # response was filtered
-                if hasattr(e, 'code'):
-                    if e.code == 'content_filter':
-                        return []
-                    print(e.code, file=sys.stderr)
-                if hasattr(e, 'error') and e.error['code'] == 'invalid_model_output':
+                self.record_attempt(model, queue_wait, start, e)
+                if self.handle_api_error(e):
                     return []
+                await transport.sleep(self.retry_delay(limiter, e, attempt, model, estimated_tokens))
+                attempt += 1
+                continue
+            self.record_attempt(model, queue_wait, start)
+            break
+        self.telemetry.observe(model, "attempts", attempt + 1)
+        limiter.record_success(estimated_tokens, self.record_usage(response, model))
+
+        answers, truncated = self.extract_answers(response, max_tokens)
+        if truncated:
+            self.telemetry.count(model, "truncation_retries")
+            return await self.request_api_with(transport, prompt, model, temperature=temperature, max_tokens=self.escalate_max_tokens(max_tokens, token_estimator), n=n, token_estimator=token_estimator)
+        return answers
+
+    # returns True when the request cannot succeed and should not be retried
+    def handle_api_error(self, e):
+        # response was filtered
+        if hasattr(e, 'code'):
+            if e.code == 'content_filter':
+                return True
+            print(e.code, file=sys.stderr)
+        if hasattr(e, 'error') and e.error['code'] == 'invalid_model_output':
+            return True
 
-                # frequent error is reaching the API limit
-                print(colored("Error, retrying...", "red"), file=sys.stderr)
-                print(e, file=sys.stderr)
-                time.sleep(1)
+        # frequent error is reaching the API limit
+        print(colored("Error, retrying...", "red"), file=sys.stderr)
+        print(e, file=sys.stderr)
+        return False
+
+    def escalate_max_tokens(self, max_tokens, token_estimator):
+        if token_estimator is None:
+            return max_tokens + 200
+        return token_estimator.escalate(max_tokens)
+
+    # returns number of seconds to wait before the next attempt
+    def retry_delay(self, limiter, e, attempt, model=None, estimated_tokens=0):
+        self.retries += 1
+        if self.retry_budget is not None and self.retries > self.retry_budget:
+            raise RetryBudgetExceeded(f"Retry budget of {self.retry_budget} retries exhausted.") from e
+        delay = limiter.record_failure(e, attempt, estimated_tokens)
+        self.telemetry.count(model, "retries")
+        self.telemetry.count(model, "retry_wait_seconds", delay)
+        return delay
+
+    # error is the exception of a failed attempt
+    def record_attempt(self, model, queue_wait, start, error=None):
+        self.telemetry.observe(model, "api_latency_seconds", time.perf_counter() - start)
+        self.telemetry.observe(model, "queue_wait_seconds", queue_wait)
+        if error is None:
+            return
+
+        status_code = getattr(error, "status_code", None)
+        if status_code == 429:
+            self.telemetry.count(model, "rate_limit_errors")
+        elif status_code is not None and status_code >= 500:
+            self.telemetry.count(model, "server_errors")
+        elif isinstance(error, openai.APIConnectionError):
+            # timeouts are connection errors too
+            self.telemetry.count(model, "timeout_errors")
+        else:
+            self.telemetry.count(model, "other_errors")
+
+    # returns total number of tokens used by the response
+    def record_usage(self, response, model=None):
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return None
+
+        self.usage["requests"] += 1
+        self.usage["prompt_tokens"] += usage.prompt_tokens or 0
+        self.usage["cached_tokens"] += self.cached_tokens(usage)
+        self.usage["completion_tokens"] += usage.completion_tokens or 0
+
+        self.telemetry.count(model, "api_calls")
+        self.telemetry.count(model, "prompt_tokens", usage.prompt_tokens or 0)
+        self.telemetry.count(model, "cached_tokens", self.cached_tokens(usage))
+        self.telemetry.count(model, "completion_tokens", usage.completion_tokens or 0)
+        self.telemetry.observe(model, "prompt_tokens", usage.prompt_tokens or 0)
+        self.telemetry.observe(model, "completion_tokens", usage.completion_tokens or 0)
+        return usage.total_tokens
+
+    def cached_tokens(self, usage):
+        details = getattr(usage, "prompt_tokens_details", None)
+        return getattr(details, "cached_tokens", None) or 0
+
+    def print_usage(self):
+        if self.usage["requests"] == 0:
+            return
+        prompt_tokens = self.usage["prompt_tokens"]
+        cached = self.usage["cached_tokens"] / prompt_tokens if prompt_tokens > 0 else 0
+        print(f"Used {prompt_tokens} prompt tokens ({self.usage['cached_tokens']} cached, {cached:.1%}) and {self.usage['completion_tokens']} completion tokens in {self.usage['requests']} requests", file=sys.stderr)
+
+    # returns answers and a flag whether the request should be repeated with more tokens
+    def extract_answers(self, response, max_tokens):
+        # usage is reported for the whole response
+        completion_tokens = None
+        prompt_tokens = None
+        cached_tokens = None
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            if usage.completion_tokens is not None:
+                completion_tokens = usage.completion_tokens // max(1, len(response.choices))
+            prompt_tokens = usage.prompt_tokens
+            cached_tokens = self.cached_tokens(usage)
 
         answers = []
+        truncated = False
         for choice in response.choices:
             if choice.message.content is None:
-                return []
+                return [], False
             if hasattr(choice, "message"):
                 answer = choice.message.content.strip()
             else:
                 answer = choice.text.strip()
-                
-            # one of the responses didn't finish, we need to request more tokens
+
+            # the response didn't finish, we need to request more tokens
             if choice.finish_reason != "stop":
                 if self.verbose:
                     print(colored(f"Increasing max tokens to fit answers.", "red") + colored(answer, "blue"), file=sys.stderr)
                 print(f"Finish reason: {choice.finish_reason}", file=sys.stderr)
-                if max_tokens is None:
-                    return []
-                return self.request_api(prompt, model, temperature=temperature, max_tokens=max_tokens + 200)
+                truncated = True
+                continue
 
             answers.append({
                 "answer": answer,
                 "finish_reason": choice.finish_reason,
+                "completion_tokens": completion_tokens,
+                "prompt_tokens": prompt_tokens,
+                "cached_tokens": cached_tokens,
             })
 
-        if len(answers) > 1:
-            # remove duplicate answers
-            answers = [dict(t) for t in {tuple(d.items()) for d in answers}]
+        # with multiple samples the finished ones are used, identical samples are kept so that they count when averaged
+        if truncated and len(answers) == 0:
+            return [], max_tokens is not None
 
-        return answers
+        return answers, False
 
-    def call_api(self, prompt, model, temperature, max_tokens):
+    def call_api(self, prompt, model, temperature, max_tokens, n=1):
+        parameters = self.api_parameters(prompt, model, temperature, max_tokens, n)
+        return self.client.chat.completions.create(**parameters)
+
+    async def call_api_async(self, prompt, model, temperature, max_tokens, n=1):
+        parameters = self.api_parameters(prompt, model, temperature, max_tokens, n)
+        client = get_async_client(self.async_client_class, self.client_args)
+        return await client.chat.completions.create(**parameters)
+
+    def api_parameters(self, prompt, model, temperature, max_tokens, n=1):
         parameters = {
             "temperature": temperature/10,
             "top_p": 1,
-            "n": 1,
+            "n": n,
             "frequency_penalty": 0,
             "presence_penalty": 0,
             "stop": None,
@@ -151,19 +353,277 @@ class GptApi:
             assert all(isinstance(p, dict) for p in prompt), "Prompts must be a list of dictionaries."
             assert all("role" in p and "content" in p for p in prompt), "Prompts must be a list of dictionaries with role and content."
 
-            parameters["messages"] = prompt
+            # fixed keys and their order keep the serialized prefix byte-stable for the provider's prompt caching
+            parameters["messages"] = [{"role": p["role"], "content": p["content"]} for p in prompt]
         else:
             parameters["messages"] = [{
                 "role": "user",
                 "content": prompt,
             }]
 
-        return self.client.chat.completions.create(**parameters)
-    
-    def bulk_request(self, df, model, parse_mqm_answer, cache, max_tokens=None):
-        answers = []
-        for i, row in tqdm.tqdm(df.iterrows(), total=len(df), file=sys.stderr):
-            prompt = row["prompt"]
-            parsed_answers = self.request(prompt, model, parse_mqm_answer, cache=cache, max_tokens=max_tokens)
-            answers += parsed_answers
-        return answers
+        return parameters
+
+    # concurrency enables the asynchronous engine with at most that many requests in flight
+    # batch sends cache misses through the Batch API first, whatever it doesn't answer validly is requested interactively
+    # dedup sends identical prompts only once (see gemba.dedup for the modes), None disables it
+    # callback(row, parsed_answers) is called for every row as soon as its answers are available
+    def bulk_request(self, df, model, parse_mqm_answer, cache, max_tokens=None, concurrency=None, batch=False, poll_interval=60, dedup="exact", callback=None, token_estimator=None):
+        stage = {"parse": parse_mqm_answer, "max_tokens": max_tokens, "token_estimator": token_estimator}
+        return self.pipeline_request(df, model, [stage], cache, concurrency=concurrency, batch=batch, poll_interval=poll_interval, dedup=dedup, callback=callback)
+
+    # every prompt goes through the stages one after another, the request of the next stage is sent as soon as the answer
+    # of the previous stage arrives and all stages share the concurrency
+    # stage is a dict with "parse" and optional "max_tokens" and "token_estimator", the stages after the first one build
+    # their prompt with stage["prompt"](row, parsed_answers) from the answers of the previous stage
+    # callback gets answers of the last stage
+    def pipeline_request(self, df, model, stages, cache, concurrency=None, batch=False, poll_interval=60, dedup="exact", callback=None):
+        job = {"df": df, "model": model, "stages": stages, "callback": callback}
+        return self.run_jobs([job], cache, concurrency=concurrency, batch=batch, poll_interval=poll_interval, dedup=dedup)[0]
+
+    # job is a dict with "df" (with a "prompt" column), "model", "stages" and optional "callback" as in pipeline_request,
+    # requests of all jobs are interleaved through one pool of workers so that several methods or models keep the endpoint
+    # busy together; returns the flattened answers of every job
+    def run_jobs(self, jobs, cache, concurrency=None, batch=False, poll_interval=60, dedup="exact"):
+        with span("run_jobs", jobs=len(jobs), concurrency=concurrency, batch=batch, dedup=dedup):
+            for job in jobs:
+                with span("prepare_job", model=job["model"], rows=len(job["df"])):
+                    self.prepare_job(job, dedup)
+
+            if batch:
+                # the Batch API answers a whole stage at once, so a stage is submitted only after all answers of the previous one
+                prompts = [job["prompts"] for job in jobs]
+                for k in range(max(len(job["stages"]) for job in jobs)):
+                    active = [j for j, job in enumerate(jobs) if len(job["stages"]) > k]
+                    for j in active:
+                        stage = jobs[j]["stages"][k]
+                        if k > 0:
+                            prompts[j] = [stage["prompt"](jobs[j]["first_rows"][i], jobs[j]["results"][i]) for i in range(len(prompts[j]))]
+                        batch_max_tokens = stage.get("max_tokens") if stage.get("token_estimator") is None else stage["token_estimator"].max_tokens(stage.get("max_tokens"))
+                        with span("request_batch", model=jobs[j]["model"], stage=k, prompts=len(prompts[j])):
+                            self.request_batch(prompts[j], jobs[j]["model"], cache, max_tokens=batch_max_tokens, poll_interval=poll_interval)
+                    self.run_items(interleave([[(jobs[j], i, prompts[j][i], k, k + 1) for i in range(len(prompts[j]))] for j in active]), cache, concurrency)
+            else:
+                self.run_items(job_items(jobs), cache, concurrency)
+
+            for job in jobs:
+                for stage in job["stages"]:
+                    if stage.get("token_estimator") is not None:
+                        stage["token_estimator"].save()
+            self.print_usage()
+
+            answers = []
+            for job in jobs:
+                results = job["results"]
+                # fan the answers out to all rows
+                if dedup is not None:
+                    results = [results[i] for i in job["inverse"]]
+                answers.append([answer for parsed_answers in results for answer in parsed_answers])
+            return answers
+
+    # like run_jobs for lists of jobs that arrive one after another, e.g. from the chunks of a file, the next list is
+    # prepared while the workers still answer the previous one so that the requests do not drain between them;
+    # answers are passed only to the callbacks of the jobs
+    def stream_jobs(self, job_lists, cache, concurrency=None, dedup="exact"):
+        # only the token estimators are kept, the jobs of a list are released once it is answered
+        estimators = {}
+
+        def items():
+            for jobs in job_lists:
+                for job in jobs:
+                    with span("prepare_job", model=job["model"], rows=len(job["df"])):
+                        self.prepare_job(job, dedup)
+                    for stage in job["stages"]:
+                        if stage.get("token_estimator") is not None:
+                            estimators[id(stage["token_estimator"])] = stage["token_estimator"]
+                yield from job_items(jobs)
+
+        with span("stream_jobs", concurrency=concurrency, dedup=dedup):
+            self.run_items(items(), cache, concurrency)
+            for estimator in estimators.values():
+                estimator.save()
+            self.print_usage()
+
+    def prepare_job(self, job, dedup):
+        prompts = list(job["df"]["prompt"])
+        rows = [[i] for i in range(len(prompts))]
+        if dedup is not None:
+            prompts, inverse = deduplicate_prompts(prompts, dedup)
+            self.deduplicated += len(inverse) - len(prompts)
+            if len(inverse) > len(prompts):
+                print(f"Deduplication saved {len(inverse) - len(prompts)} of {len(inverse)} requests", file=sys.stderr)
+            rows = [[] for _ in prompts]
+            for row, i in enumerate(inverse):
+                rows[i].append(row)
+            job["inverse"] = inverse
+
+        job["prompts"] = prompts
+        job["rows"] = rows
+        # the first row of a deduplicated prompt builds the prompts of the following stages
+        job["first_rows"] = [r[0] for r in rows]
+        job["results"] = [None] * len(prompts)
+
+    # items are (job, prompt index, prompt, first stage, end stage), a list or a lazy iterable
+    def run_items(self, items, cache, concurrency=None):
+        def finish(item, parsed_answers):
+            job, i, prompt, first, end = item
+            job["results"][i] = parsed_answers
+            if end == len(job["stages"]) and job.get("callback") is not None:
+                with span("callback", model=job["model"], rows=len(job["rows"][i])):
+                    for row in job["rows"][i]:
+                        job["callback"](row, parsed_answers)
+
+        if concurrency is not None:
+            asyncio.run(self.run_items_async(items, cache, concurrency=concurrency, on_result=finish))
+        else:
+            for item in tqdm.tqdm(items, file=sys.stderr):
+                job, i, prompt, first, end = item
+                finish(item, self.request_stages(prompt, job["first_rows"][i], job["model"], job["stages"][first:end], cache))
+
+    async def run_items_async(self, items, cache, concurrency=8, on_result=None):
+        assert concurrency > 0, "Concurrency must be a positive number."
+        pending = iter(items)
+        total = len(items) if hasattr(items, "__len__") else None
+        progress = tqdm.tqdm(total=total, file=sys.stderr)
+
+        # fixed pool of workers pulling from a shared iterator keeps the number of in-flight requests bounded,
+        # a worker takes the next prompt only after all stages of the previous one are answered
+        async def worker():
+            for item in pending:
+                job, i, prompt, first, end = item
+                parsed_answers = await self.request_stages_async(prompt, job["first_rows"][i], job["model"], job["stages"][first:end], cache)
+                if on_result is not None:
+                    on_result(item, parsed_answers)
+                progress.update(1)
+
+        try:
+            await asyncio.gather(*[worker() for _ in range(concurrency if total is None else min(concurrency, total))])
+        finally:
+            # the event loop is finished by asyncio.run after this
+            await close_async_clients()
+        progress.close()
+
+    def request_stages(self, prompt, row, model, stages, cache):
+        return run_sync(self.request_stages_with(SyncTransport(self), prompt, row, model, stages, cache))
+
+    async def request_stages_async(self, prompt, row, model, stages, cache):
+        return await self.request_stages_with(AsyncTransport(self), prompt, row, model, stages, cache)
+
+    async def request_stages_with(self, transport, prompt, row, model, stages, cache):
+        parsed_answers = None
+        for k, stage in enumerate(stages):
+            if parsed_answers is not None:
+                with span("build_prompt", model=model, row=row):
+                    prompt = stage["prompt"](row, parsed_answers)
+            with span("request", model=model, row=row, stage=k):
+                parsed_answers = await self.request_with(transport, prompt, model, stage["parse"], cache=cache, max_tokens=stage.get("max_tokens"), token_estimator=stage.get("token_estimator"))
+        return parsed_answers
+
+    # answers of the Batch API are stored in the cache under the same key as interactive requests with temperature 0
+    def request_batch(self, prompts, model, cache, max_tokens=None, poll_interval=60, batch_size=50000):
+        pending = []
+        seen = set()
+        for prompt in prompts:
+            if cache.get(model, 0, prompt) is not None:
+                continue
+            key = cache.key(model, 0, prompt)
+            if key in seen:
+                continue
+            seen.add(key)
+            pending.append(prompt)
+
+        if len(pending) == 0:
+            return
+
+        # the Batch API limits number of requests per file
+        for start in range(0, len(pending), batch_size):
+            chunk = pending[start:start + batch_size]
+            batch = self.submit_batch(chunk, model, max_tokens)
+            print(f"Submitted batch {batch.id} with {len(chunk)} requests", file=sys.stderr)
+            batch = self.wait_for_batch(batch.id, poll_interval)
+
+            if batch.status != "completed":
+                print(colored(f"Batch {batch.id} finished with status {batch.status}, missing answers will be requested interactively.", "red"), file=sys.stderr)
+            # expired or cancelled batches still contain the finished requests
+            if batch.output_file_id is None:
+                continue
+
+            answered = 0
+            for line in self.client.files.content(batch.output_file_id).text.splitlines():
+                if line.strip() == "":
+                    continue
+                result = json.loads(line)
+                if result.get("response") is None or result["response"]["status_code"] != 200:
+                    continue
+                response = ChatCompletion.model_validate(result["response"]["body"])
+                self.record_usage(response, model)
+                answers, truncated = self.extract_answers(response, max_tokens)
+                if len(answers) == 0:
+                    continue
+                cache.set(model, 0, chunk[int(result["custom_id"])], answers)
+                answered += 1
+            print(f"Batch {batch.id} answered {answered}/{len(chunk)} requests", file=sys.stderr)
+
+    def submit_batch(self, prompts, model, max_tokens=None):
+        lines = []
+        for i, prompt in enumerate(prompts):
+            lines.append(json.dumps({
+                "custom_id": str(i),
+                "method": "POST",
+                "url": self.batch_endpoint,
+                "body": self.api_parameters(prompt, model, 0, max_tokens),
+            }, ensure_ascii=False))
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+
+        input_file = self.client.files.create(file=("gemba_batch.jsonl", data), purpose="batch")
+        return self.client.batches.create(input_file_id=input_file.id, endpoint=self.batch_endpoint, completion_window="24h")
+
+    def wait_for_batch(self, batch_id, poll_interval=60):
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status in ["completed", "failed", "expired", "cancelled"]:
+                return batch
+            if self.verbose and batch.request_counts is not None:
+                print(f"Batch {batch_id} is {batch.status}: {batch.request_counts.completed}/{batch.request_counts.total} requests done", file=sys.stderr)
+            time.sleep(poll_interval)
+
+
+# the blocking client and time.sleep behind awaits that never suspend, so that run_sync can drive the shared coroutines
+class SyncTransport:
+    def __init__(self, api):
+        self.api = api
+
+    async def sleep(self, seconds):
+        time.sleep(seconds)
+
+    async def call_api(self, prompt, model, temperature, max_tokens, n=1):
+        return self.api.call_api(prompt, model, temperature, max_tokens, n)
+
+
+class AsyncTransport:
+    def __init__(self, api):
+        self.api = api
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    async def call_api(self, prompt, model, temperature, max_tokens, n=1):
+        return await self.api.call_api_async(prompt, model, temperature, max_tokens, n)
+
+
+# runs a coroutine that awaits only SyncTransport to its end without an event loop
+def run_sync(coroutine):
+    try:
+        coroutine.send(None)
+    except StopIteration as result:
+        return result.value
+    coroutine.close()
+    raise RuntimeError("Coroutine awaited an asynchronous operation in a synchronous request.")
+
+
+# items of every job, the jobs take turns
+def job_items(jobs):
+    return interleave([[(job, i, job["prompts"][i], 0, len(job["stages"])) for i in range(len(job["prompts"]))] for job in jobs])
+
+
+def interleave(items_per_job):
+    return [item for turn in itertools.zip_longest(*items_per_job) for item in turn if item is not None]
@@ -1,4 +1,11 @@
+import zlib
+import random
+import contextlib
+import multiprocessing
+import concurrent.futures
+import numpy as np
 from mt_metrics_eval import data
+from gemba import bootstrap
 import scipy
 
 ######
@@ -8,7 +15,7 @@ import scipy
 
 def eval_metrics(eval_sets, langs, levels, primary_only, k, gold_name='std',
                  include_domains=True, seg_level_no_avg=False,
-                 include_human_with_acc=False):
+                 include_human_with_acc=False, workers=None, engine='mtme'):
     """Evaluate all metrics for eval sets, across multiple task settings.
 
     Args:
@@ -25,11 +32,16 @@ def eval_metrics(eval_sets, langs, levels, primary_only, k, gold_name='std',
       seg_level_no_avg: If True, use only the average_by=None setting for segment-
         level correlations
       include_human_with_acc: If True, include human outputs in accuracy tasks.
+      workers: Number of processes the tasks are spread over, None runs them
+        serially in this process. Results are identical either way.
+      engine: 'numpy' computes the bootstrap significance of pearson and kendall
+        tasks without averaging with gemba.bootstrap, all k draws at once;
+        'mtme' uses data.CompareMetrics for every task.
 
     Returns:
       Map from task names to metric -> (rank, corr, sig_string) stats.
     """
-    results = {}
+    tasks = []
 
     # First task is global accuracy, iff more than one language is given.
     if len(langs) > 0:
@@ -45,13 +57,9 @@ def eval_metrics(eval_sets, langs, levels, primary_only, k, gold_name='std',
             taskname = data.MakeTaskName(
                 'wmt22', langs, None, 'sys', human, 'none', 'accuracy', k, gold,
                 main_refs, close_refs, False, primary_only)
-            print(taskname)
-            res = data.CompareMetricsWithGlobalAccuracy(
-                evs_list, main_refs, close_refs, include_human=human,
-                include_outliers=False, gold_name=gold,
-                primary_metrics=primary_only,
-                domain=None, k=k, pval=0.05)
-            results[taskname] = reformat(res)
+            tasks.append({'taskname': taskname, 'corr': 'accuracy', 'langs': langs,
+                          'main_refs': main_refs, 'close_refs': close_refs,
+                          'human': human, 'gold': gold, 'primary_only': primary_only, 'k': k})
 
     # Remaining tasks are specific to language, domain, etc.
     for lp in langs:
@@ -68,26 +76,124 @@ def eval_metrics(eval_sets, langs, levels, primary_only, k, gold_name='std',
                         if human == True and len(evs.ref_names) == 1:
                             continue  # Single ref
                         for corr in 'pearson', 'kendall':
-                            corr_fcn = {'pearson': scipy.stats.pearsonr,
-                                        'kendall': scipy.stats.kendalltau}[corr]
                             taskname = data.MakeTaskName(
                                 'wmt22', lp, domain, level, human, avg, corr, k, gold,
                                 main_refs, close_refs, False, primary=primary_only)
-                            print(taskname)
-                            corrs = data.GetCorrelations(
-                                evs=evs, level=level, main_refs={evs.std_ref},
-                                close_refs=close_refs, include_human=human,
-                                include_outliers=False, gold_name=gold_name,
-                                primary_metrics=primary_only, domain=domain)
-                            metrics, sig_matrix = data.CompareMetrics(
-                                corrs, corr_fcn, average_by=avg, k=k, pval=0.05)
-                            # Make compatible with accuracy results.
-                            metrics = {evs.DisplayName(m): v for m, v in metrics.items()}
-                            results[taskname] = reformat((metrics, sig_matrix))
+                            tasks.append({'taskname': taskname, 'corr': corr, 'lp': lp,
+                                          'domain': domain, 'level': level, 'avg': avg,
+                                          'close_refs': close_refs, 'human': human,
+                                          'gold_name': gold_name, 'primary_only': primary_only, 'k': k,
+                                          'engine': engine})
+
+    # tasks sharing a correlation key run as one unit, so every correlation is computed once
+    units = {}
+    for index, task in enumerate(tasks):
+        units.setdefault(correlation_key(task) or index, []).append(index)
+    units = [[tasks[index] for index in unit] for unit in units.values()]
+
+    if workers is None:
+        outputs = [run_unit(unit, eval_sets) for unit in units]
+    else:
+        # forked workers share the eval sets with this process instead of unpickling a copy
+        context = multiprocessing.get_context('fork') if 'fork' in multiprocessing.get_all_start_methods() else None
+        with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context, initializer=init_worker, initargs=(eval_sets,)) as executor:
+            outputs = list(executor.map(run_worker_unit, units))
 
+    by_name = {task['taskname']: output for unit, unit_outputs in zip(units, outputs) for task, output in zip(unit, unit_outputs)}
+    return collect(tasks, (by_name[task['taskname']] for task in tasks))
+
+
+def collect(tasks, outputs):
+    results = {}
+    for task, output in zip(tasks, outputs):
+        print(task['taskname'])
+        results[task['taskname']] = output
     return results
 
 
+# eval sets of a worker process
+worker_eval_sets = None
+
+
+def init_worker(eval_sets):
+    global worker_eval_sets
+    worker_eval_sets = eval_sets
+
+
+def run_worker_unit(unit):
+    return run_unit(unit, worker_eval_sets)
+
+
+def run_unit(unit, eval_sets):
+    correlations = {}
+    return [run_task(task, eval_sets, correlations) for task in unit]
+
+
+def correlation_key(task):
+    """Tasks with the same key share their GetCorrelations inputs, None for accuracy tasks."""
+    if task['corr'] == 'accuracy':
+        return None
+    return (task['lp'], task['domain'], task['level'], task['human'])
+
+
+@contextlib.contextmanager
+def seeded_global_rngs(seed):
+    """Seeds the global random and numpy generators, which mt-metrics-eval draws its resamples from, and restores them afterwards."""
+    random_state, numpy_state = random.getstate(), np.random.get_state()
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        yield
+    finally:
+        random.setstate(random_state)
+        np.random.set_state(numpy_state)
+
+
+def run_task(task, eval_sets, correlations):
+    """Compute the results of one task, correlation inputs are memoized in correlations across tasks."""
+    # bootstrap resampling draws depend only on the task, not on the tasks run before it in the same process
+    seed = zlib.crc32(task['taskname'].encode('utf-8'))
+
+    if task['corr'] == 'accuracy':
+        with seeded_global_rngs(seed):
+            res = data.CompareMetricsWithGlobalAccuracy(
+                [eval_sets[lp] for lp in task['langs']], task['main_refs'], task['close_refs'],
+                include_human=task['human'], include_outliers=False, gold_name=task['gold'],
+                primary_metrics=task['primary_only'], domain=None, k=task['k'], pval=0.05)
+        return reformat(res)
+
+    evs = eval_sets[task['lp']]
+    # the same for every averaging and correlation function
+    key = correlation_key(task)
+    if key not in correlations:
+        correlations[key] = data.GetCorrelations(
+            evs=evs, level=task['level'], main_refs={evs.std_ref},
+            close_refs=task['close_refs'], include_human=task['human'],
+            include_outliers=False, gold_name=task['gold_name'],
+            primary_metrics=task['primary_only'], domain=task['domain'])
+    if task['engine'] == 'numpy' and task['avg'] == 'none' and same_gold(correlations[key]):
+        corrs = correlations[key]
+        gold = next(iter(corrs.values())).gold_scores
+        metrics, sig_matrix = bootstrap.compare_metrics(
+            gold, {m: c.metric_scores for m, c in corrs.items()}, corr=task['corr'],
+            k=task['k'], pval=0.05, seed=seed)
+    else:
+        corr_fcn = {'pearson': scipy.stats.pearsonr,
+                    'kendall': scipy.stats.kendalltau}[task['corr']]
+        with seeded_global_rngs(seed):
+            metrics, sig_matrix = data.CompareMetrics(
+                correlations[key], corr_fcn, average_by=task['avg'], k=task['k'], pval=0.05)
+    # Make compatible with accuracy results.
+    metrics = {evs.DisplayName(m): v for m, v in metrics.items()}
+    return reformat((metrics, sig_matrix))
+
+
+def same_gold(corrs):
+    """Whether all metrics are correlated with the same gold scores, which the paired resampling needs."""
+    golds = [list(c.gold_scores) for c in corrs.values()]
+    return len(golds) > 0 and all(gold == golds[0] for gold in golds)
+
+
 def reformat(results):
     """Reformat CompareMetrics() results to match mtme's format."""
     metrics, sig_matrix = results
@@ -0,0 +1,204 @@
+import re
+import functools
+from collections import defaultdict
+import numpy as np
+from termcolor import colored
+
+from gemba.prompt import quality_classes
+from gemba.gemba_mqm_utils import parse_mqm_answer
+
+# fast equivalents of the validators in gemba.prompt and gemba.gemba_mqm_utils, they must return
+# exactly the same values (benchmarks/parsing.py compares them on a corpus of answers)
+
+number_re = re.compile(r'\d+')
+bracketed_number_re = re.compile(r"^\[['\"][0-9]*['\"]\]$")
+fraction_res = {}
+
+star_words = [(" one ", "1 star", 1), (" two ", "2 star", 2), (" three ", "3 star", 3), (" four ", "4 star", 4), (" five ", "5 star", 5)]
+
+severities = ['critical', 'major', 'minor']
+severity_weights = {'critical': 25, 'major': 5, 'minor': 1}
+severity_headers = {"critical:": "critical", "major:": "major", "minor:": "minor"}
+error_categories = ('accuracy', 'fluency', 'locale convention', 'style', 'terminology', 'non-translation', 'other')
+
+# categories in the priority of parse_error_class, the last subclass found wins
+error_subclasses = {
+    "accuracy": ["addition", "mistranslation", "omission", "untranslated text"],
+    "fluency": ["character encoding", "grammar", "inconsistency", "punctuation", "register", "spelling"],
+    "locale convention": ["currency", "date", "name", "telephone", "time"],
+    "style": [],
+    "terminology": ["inappropriate", "inconsistent"],
+    "non-translation": [],
+    "other": [],
+}
+error_class_table = [(category, [(subclass, f"{category}-{subclass}") for subclass in reversed(subclasses)]) for category, subclasses in error_subclasses.items()]
+
+
+def parse_number(answer, max=None):
+    # most answers are just the number
+    if answer.isdecimal():
+        return int(answer)
+
+    numbers = number_re.findall(answer)
+    if len(numbers) == 1:
+        return int(numbers[0])
+
+    if bracketed_number_re.match(answer) is not None:
+        return int(answer[2:-2])
+
+    if max is not None:
+        fraction_re = fraction_res.get(max)
+        if fraction_re is None:
+            fraction_re = fraction_res[max] = re.compile(rf"^[0-9]*/{max}$")
+        if fraction_re.match(answer) is not None:
+            return int(answer.split("/")[0])
+
+    return None
+
+
+def parse_number_in_range(answer, min=0, max=100):
+    number = parse_number(answer, max)
+    if number is None or number < min or number > max:
+        return None
+    return number
+
+
+def parse_stars(answer):
+    x = answer.lower()
+    possible_answers = set()
+    if "*" in x:
+        possible_answers.add(x.count("*"))
+    if "★" in x:
+        possible_answers.add(x.count("★"))
+
+    x = f" {x} ".replace("\n", " ")
+    for word, digits, stars in star_words:
+        if word in x or digits in x:
+            possible_answers.add(stars)
+    # more than one candidate is invalid whatever the number says
+    if len(possible_answers) > 1:
+        return None
+
+    numerical = parse_number(x)
+    if numerical is not None:
+        possible_answers.add(numerical)
+
+    if len(possible_answers) == 1:
+        stars = possible_answers.pop()
+        if 1 <= stars <= 5:
+            return stars
+    return None
+
+
+def parse_class(answer, classes=quality_classes):
+    lowered = answer.lower()
+    final_class = None
+    for i, name in enumerate(classes):
+        if name.lower() in lowered:
+            if final_class is not None:
+                print(colored(f"Two classes found in answer {answer}", "red"))
+                return None
+            final_class = i
+    return final_class
+
+
+def classify_error(error):
+    for category, subclasses in error_class_table:
+        if category in error:
+            for subclass, class_name in subclasses:
+                if subclass in error:
+                    return class_name
+            return category
+    return "unknown"
+
+
+def parse_mqm(x, list_mqm_errors=False, full_desc=True):
+    if x is None:
+        return None
+
+    x = str(x)
+    # answers in JSON are rare, they are left to the original parser
+    if x.startswith('{"improved translation"'):
+        return parse_mqm_answer(x, list_mqm_errors=list_mqm_errors, full_desc=full_desc)
+
+    errors = {'critical': [], 'major': [], 'minor': []}
+    error_level = None
+    for line in x.lower().split('\n'):
+        line = line.strip()
+        if line == "" or "no-error" in line or "no error" in line:
+            continue
+        header = severity_headers.get(line)
+        if header is not None:
+            error_level = header
+            continue
+
+        if "critical" in line or "major" in line or "minor" in line:
+            if not line.startswith(error_categories):
+                print(line)
+
+        if error_level is None:
+            print(f"No error level for {line}")
+            continue
+
+        if "non-translation" in line:
+            errors["critical"].append(line)
+        else:
+            errors[error_level].append(line)
+
+    if list_mqm_errors:
+        error_classes = defaultdict(list)
+        for error_level in severities:
+            for error in errors[error_level]:
+                error_classes[error_level].append(error if full_desc else classify_error(error))
+        return error_classes
+
+    # only the first five errors count
+    final_score = 0
+    counted = 0
+    for error_level in severities:
+        count = min(len(errors[error_level]), 5 - counted)
+        final_score += count * severity_weights[error_level]
+        counted += count
+    return -min(final_score, 25)
+
+
+def get_parser(method, list_mqm_errors=False, full_desc=True, memoize=True):
+    """Return the parser of single answers for a method (see gemba.prompt and GEMBA-MQM/GEMBA-ESA).
+
+    With memoize, the score of every distinct answer is parsed only once per parser, e.g. when GptApi replays a cached run
+    whose answers repeat a lot; diagnostics of malformed answers are then printed only for their first occurrence.
+    Lists of MQM errors are mutable and are never memoized.
+    """
+    if method == "GEMBA-MQM":
+        parse = lambda x: parse_mqm(x, list_mqm_errors=list_mqm_errors, full_desc=full_desc)
+    elif method in ["GEMBA-DA", "GEMBA-DA_ref", "GEMBA-SQM", "GEMBA-SQM_ref", "GEMBA-ESA"]:
+        parse = parse_number_in_range
+    elif method in ["GEMBA-stars", "GEMBA-stars_ref"]:
+        parse = parse_stars
+    elif method in ["GEMBA-classes", "GEMBA-classes_ref"]:
+        parse = parse_class
+    else:
+        raise Exception(f"Method {method} not supported.")
+
+    if memoize and not list_mqm_errors:
+        parse = functools.lru_cache(maxsize=1 << 16)(parse)
+    return parse
+
+
+def parse_batch(method, answers, list_mqm_errors=False, full_desc=True):
+    """Parse raw answers of a method, every distinct answer is parsed only once.
+
+    Returns a float64 array of scores with NaN for answers that can't be parsed,
+    or a list of error dictionaries when list_mqm_errors is set.
+    """
+    parse = get_parser(method, list_mqm_errors=list_mqm_errors, full_desc=full_desc, memoize=False)
+    parsed = {}
+    for answer in answers:
+        if answer not in parsed:
+            parsed[answer] = parse(answer)
+
+    if list_mqm_errors:
+        return [parsed[answer] for answer in answers]
+
+    values = {answer: np.nan if value is None else value for answer, value in parsed.items()}
+    return np.fromiter((values[answer] for answer in answers), dtype=np.float64, count=len(answers))
@@ -94,6 +94,8 @@ language_codes = {
     "ru": "Russian",
 }
 
+quality_classes = ["No meaning preserved", "Some meaning preserved, but not understandable", "Some meaning preserved and understandable", "Most meaning preserved, minor issues", "Perfect translation"]
+
 prompts = {
     "GEMBA-DA": {
         "prompt": 'Score the following translation from {source_lang} to {target_lang} on a continuous scale from 0 to 100, where a score of zero means "no meaning preserved" and score of one hundred means "perfect meaning and grammar".\n\n{source_lang} source: "{source_seg}"\n{target_lang} translation: "{target_seg}"\nScore: ',
@@ -128,12 +130,16 @@ prompts = {
     "GEMBA-classes": {
         "prompt": 'Classify the quality of machine translation from {source_lang} to {target_lang} into one of following classes: "No meaning preserved", "Some meaning preserved, but not understandable", "Some meaning preserved and understandable", "Most meaning preserved, minor issues", "Perfect translation".\n\n{source_lang} source: "{source_seg}"\n{target_lang} machine translation: "{target_seg}"\nClass: ',
         "use_ref": False,
-        "validate_answer": lambda x, classes=["No meaning preserved", "Some meaning preserved, but not understandable", "Some meaning preserved and understandable", "Most meaning preserved, minor issues", "Perfect translation"]: parse_classes(x, classes),
+        "validate_answer": lambda x, classes=quality_classes: parse_classes(x, classes),
+        # answers are class indices that cannot be averaged
+        "categorical": True,
         "max_tokens": 100},
 
     "GEMBA-classes_ref": {
         "prompt": 'Classify the quality of machine translation from {source_lang} to {target_lang} with respect to the human reference into one of following classes: "No meaning preserved", "Some meaning preserved, but not understandable", "Some meaning preserved and understandable", "Most meaning preserved, minor issues", "Perfect translation".\n\n{source_lang} source: "{source_seg}"\n{target_lang} human reference: "{reference_seg}"\n{target_lang} machine translation: "{target_seg}"\nClass: ',
         "use_ref": True,
-        "validate_answer": lambda x, classes=["No meaning preserved", "Some meaning preserved, but not understandable", "Some meaning preserved and understandable", "Most meaning preserved, minor issues", "Perfect translation"]: parse_classes(x, classes),
+        "validate_answer": lambda x, classes=quality_classes: parse_classes(x, classes),
+        # answers are class indices that cannot be averaged
+        "categorical": True,
         "max_tokens": 100},
 }
@@ -0,0 +1,161 @@
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+
+
+class RetryBudgetExceeded(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# token bucket refilled continuously, reservations may go into debt which is paid by waiting
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def reserve(self, amount):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def refund(self, amount):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+# limiter shared by all requests to one model or deployment, it is safe to use from threads and asyncio tasks
+# as it only computes delays and leaves the sleeping to the caller
+class RateLimiter:
+    # breaker_max_opens is the number of times the circuit may open in a row without a successful request
+    # before the endpoint is considered down and CircuitOpenError is raised, None waits forever
+    def __init__(self, rpm=None, tpm=None, backoff_base=1, backoff_max=60, breaker_threshold=10, breaker_cooldown=60, breaker_max_opens=3):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.breaker_max_opens = breaker_max_opens
+
+        self.lock = threading.Lock()
+        self.blocked_until = 0
+        self.open_until = 0
+        self.consecutive_failures = 0
+        self.consecutive_opens = 0
+
+    # returns number of seconds to wait before sending a request with the estimated number of tokens,
+    # while the circuit is open after breaker_threshold consecutive failures requests wait out the cooldown
+    def acquire(self, tokens=0):
+        with self.lock:
+            self.check_breaker()
+            now = time.monotonic()
+            delay = max(0, self.blocked_until - now, self.open_until - now)
+            if self.requests is not None:
+                delay = max(delay, self.requests.reserve(1))
+            if self.tokens is not None:
+                delay = max(delay, self.tokens.reserve(tokens))
+            return delay
+
+    # the estimate is corrected with the real usage reported by the API
+    def record_success(self, estimated_tokens=0, used_tokens=None):
+        with self.lock:
+            self.consecutive_failures = 0
+            self.consecutive_opens = 0
+            if self.tokens is not None and used_tokens is not None:
+                self.tokens.refund(estimated_tokens - used_tokens)
+
+    # returns number of seconds to wait before retrying, the tokens reserved for the failed request are given back
+    def record_failure(self, error, attempt, estimated_tokens=0):
+        retry_after = get_retry_after(error)
+        status = getattr(error, "status_code", None)
+
+        with self.lock:
+            now = time.monotonic()
+            if self.tokens is not None:
+                self.tokens.refund(estimated_tokens)
+            # hitting the quota doesn't mean the endpoint is down
+            if status != 429:
+                self.consecutive_failures += 1
+                if self.breaker_threshold is not None and self.consecutive_failures >= self.breaker_threshold:
+                    # failures of requests sent before the circuit opened don't count as another opening
+                    if now >= self.open_until:
+                        self.consecutive_opens += 1
+                    self.open_until = max(self.open_until, now + self.breaker_cooldown)
+                    self.check_breaker()
+
+            if retry_after is not None:
+                # the server told us when the quota frees up, all other requests have to wait as well
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+                return retry_after + random.uniform(0, self.backoff_base)
+
+            # exponential backoff with full jitter
+            return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    # must be called with the lock held
+    def check_breaker(self):
+        if self.breaker_max_opens is not None and self.consecutive_opens >= self.breaker_max_opens:
+            raise CircuitOpenError(f"Circuit opened {self.consecutive_opens} times in a row after {self.consecutive_failures} consecutive failures, the endpoint seems to be down.")
+
+
+def get_retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers is None:
+        return None
+
+    if headers.get("retry-after-ms") is not None:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+
+    retry_after = headers.get("retry-after")
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    # retry-after may also be an HTTP date
+    try:
+        return max(0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# rough estimate used for the tokens per minute bucket before the real usage is known
+def estimate_tokens(prompt, max_tokens=None):
+    if isinstance(prompt, list):
+        chars = sum(len(p["content"]) for p in prompt)
+    else:
+        chars = len(prompt)
+    return chars // 4 + (max_tokens or 0)
+
+
+rate_limits = {}
+limiters = {}
+limiters_lock = threading.Lock()
+
+
+def set_rate_limit(model, rpm=None, tpm=None, **kwargs):
+    """Configure quota for a model or Azure deployment. Must be called before the first request to it."""
+    with limiters_lock:
+        rate_limits[model] = dict(rpm=rpm, tpm=tpm, **kwargs)
+        limiters.pop(model, None)
+
+
+def get_rate_limiter(model):
+    with limiters_lock:
+        if model not in limiters:
+            limiters[model] = RateLimiter(**rate_limits.get(model, {}))
+        return limiters[model]
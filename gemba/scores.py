@@ -1,20 +1,47 @@
 from pathlib import Path
 import os
+import json
+import numpy as np
 import pandas as pd
+from gemba.tracing import span
+from gemba.sharding import shard_of, in_shard, shard_suffix, ShardMergeError
 
 
+def format_score(value):
+    if np.isnan(value):
+        return "None"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+# scores, temperatures and sample metadata are kept in arrays indexed by system offset + segment index,
+# every assignment is appended to a journal that is replayed on load until the next save()
+# with num_shards > 1 the scores of one shard are kept in a shards/ subfolder, see merge_scores
+# columnar also writes all segments with their domain, document, temperature and raw answer to a single Parquet file
 class Scores:
-    def __init__(self, name, testset, refname, output_path=None):
+    def __init__(self, name, testset, refname, output_path=None, shard=0, num_shards=1, columnar=False):
         self.name = name
         self.testset = testset
         self.refname = refname
+        self.shard = shard
+        self.num_shards = num_shards
+        self.columnar = columnar
         if output_path is None:
             output_path = testset.basepath
 
         self.output_path = output_path
 
-        self.seg_scores = None
-        self.metadata = None
+        self.segment_count = len(testset.sources)
+        self.systems = []
+        self.offsets = {}
+        self.scores = None
+        self.temperatures = None
+        self.samples = None
+        self.valid_samples = None
+        self.raw_answers = None
+        self.domain_cache = None
+        self.journal = None
         self.prefix = None
         self.load()
 
@@ -22,37 +49,91 @@ class Scores:
         output_folder = f"{self.testset.basepath}/{self.testset.dataset}/metric-scores/{self.testset.lp}"
         Path(output_folder).mkdir(parents=True, exist_ok=True)
 
+        if self.num_shards > 1:
+            # outside of the folder read by mt-metrics-eval
+            output_folder = f"{output_folder}/shards"
+            Path(output_folder).mkdir(parents=True, exist_ok=True)
+
         if self.refname is not None:
             self.prefix = f"{output_folder}/{self.name}-{self.refname}"
         else:
             self.prefix = f"{output_folder}/{self.name}-src"
+        if self.num_shards > 1:
+            self.prefix = f"{self.prefix}.{shard_suffix(self.shard, self.num_shards)}"
 
-        seg_scores_file = self.get_seg_path()
-        if os.path.isfile(f"{seg_scores_file}"):
-            self.seg_scores = pd.read_csv(seg_scores_file, sep="\t", names=["system", "score"], index_col=False)
-        else:
-            self.seg_scores = pd.DataFrame(columns=["system", "score"])
-
-        if os.path.isfile(f"{self.get_meta_path()}"):
-            self.metadata = pd.read_csv(self.get_meta_path(), sep="\t", names=["system", "temperature"], index_col=False)
-        else:
-            self.metadata = pd.DataFrame(columns=["system", "temperature"])
+        seg_scores = self.read_tsv(self.get_seg_path(), "score")
+        metadata = self.read_tsv(self.get_meta_path(), "temperature", "sample", "valid_samples")
 
-        # generate placeholders for scores
-        segment_count = len(self.testset.sources)
+        # systems keep the order of existing files, new systems are appended in the testset order
+        self.systems = list(dict.fromkeys(seg_scores["system"]))
+        known = set(self.systems)
         for system in self.testset.systems.keys():
-            if system not in self.seg_scores["system"].values:
-                # generate placeholders for scores
-                placeholder = pd.DataFrame([{"system": system, 'score': 'None'}] * segment_count)
-                self.seg_scores = pd.concat([self.seg_scores, placeholder], ignore_index=True)
+            if system not in known:
+                self.systems.append(system)
+        self.offsets = {system: i * self.segment_count for i, system in enumerate(self.systems)}
+
+        self.scores = np.full(len(self.systems) * self.segment_count, np.nan, dtype=np.float64)
+        # -1 marks missing temperature
+        self.temperatures = np.full(len(self.systems) * self.segment_count, -1, dtype=np.int16)
+        # index of the chosen sample (-1 when averaged or unknown) and number of valid samples (0 unknown) of runs with samples > 1
+        self.samples = np.full(len(self.systems) * self.segment_count, -1, dtype=np.int16)
+        self.valid_samples = np.zeros(len(self.systems) * self.segment_count, dtype=np.int16)
+        # raw answers are kept only for the columnar output
+        if self.columnar:
+            self.raw_answers = np.full(len(self.systems) * self.segment_count, None, dtype=object)
+
+        for system, group in seg_scores.groupby("system", sort=False):
+            # check that all systems have correct number of scores
+            assert len(group) == self.segment_count
+            offset = self.offsets[system]
+            self.scores[offset:offset + self.segment_count] = group["score"].to_numpy(dtype=np.float64)
+        for system, group in metadata.groupby("system", sort=False):
+            assert len(group) == self.segment_count
+            offset = self.offsets[system]
+            self.temperatures[offset:offset + self.segment_count] = group["temperature"].fillna(-1).to_numpy(dtype=np.int16)
+            self.samples[offset:offset + self.segment_count] = group["sample"].fillna(-1).to_numpy(dtype=np.int16)
+            self.valid_samples[offset:offset + self.segment_count] = group["valid_samples"].fillna(0).to_numpy(dtype=np.int16)
+
+        if self.columnar and os.path.isfile(self.get_columnar_path()):
+            self.load_raw_answers()
+
+        self.replay_journal()
+        self.journal = open(self.get_journal_path(), "a")
+
+    # columns missing in the file are read as NaN, like "None"
+    def read_tsv(self, path, *columns):
+        if not os.path.isfile(path):
+            return pd.DataFrame({"system": pd.Series(dtype=str), **{column: pd.Series(dtype=float) for column in columns}})
+        return pd.read_csv(path, sep="\t", names=["system", *columns], index_col=False, keep_default_na=False, na_values={column: ["None", ""] for column in columns}, dtype={"system": str})
+
+    def load_raw_answers(self):
+        df = pd.read_parquet(self.get_columnar_path(), columns=["system", "segment", "raw_answer"])
+        for system, group in df.groupby("system", sort=False, observed=True):
+            if system in self.offsets:
+                self.raw_answers[self.offsets[system] + group["segment"].to_numpy()] = group["raw_answer"].to_numpy()
 
-            if system not in self.metadata["system"].values:
-                placeholder = pd.DataFrame([{"system": system, 'temperature': 'None'}] * segment_count)
-                self.metadata = pd.concat([self.metadata, placeholder], ignore_index=True)
+    def replay_journal(self):
+        if not os.path.isfile(self.get_journal_path()):
+            return
 
-            # check that all systems are present and have correct number of scores
-            assert len(self.seg_scores[self.seg_scores.system == system]) == segment_count
-            assert len(self.metadata[self.metadata.system == system]) == segment_count
+        with open(self.get_journal_path(), "r") as fh:
+            for line in fh:
+                # the last line may be cut by an interrupted run
+                if not line.endswith("\n"):
+                    continue
+                # the sample and the number of valid samples make 6 fields, the raw answer is the 5th or 7th
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) not in [4, 5, 6, 7]:
+                    continue
+                system, hypothesis_index, score, temperature = fields[:4]
+                index = self._remap_index(system, int(hypothesis_index))
+                self.scores[index] = np.nan if score == "None" else float(score)
+                self.temperatures[index] = -1 if temperature == "None" else int(temperature)
+                if len(fields) >= 6:
+                    self.samples[index] = -1 if fields[4] == "None" else int(fields[4])
+                    self.valid_samples[index] = int(fields[5])
+                if len(fields) in [5, 7] and self.columnar:
+                    self.raw_answers[index] = json.loads(fields[-1])
 
     def get_seg_path(self):
         return f"{self.prefix}.seg.score"
@@ -66,38 +147,241 @@ class Scores:
     def get_meta_path(self):
         return f"{self.prefix}.seg.meta"
 
+    def get_columnar_path(self):
+        return f"{self.prefix}.parquet"
+
+    # segments and rankings of gemba.adaptive.AdaptiveSampler
+    def get_sampling_path(self):
+        return f"{self.prefix}.sampling.json"
+
+    def get_journal_path(self):
+        return f"{self.prefix}.journal"
+
     def _remap_index(self, system, hypothesis_index):
         # the order of systems may be different
-        # get id of the first hypothesis of the system
-        index = (self.seg_scores["system"] == system).argmax()
-        h = hypothesis_index % len(self.testset.sources)
-        return index + h
+        return self.offsets[system] + hypothesis_index % self.segment_count
 
+    # whether the segment is scored by this shard
+    def in_shard(self, system, hypothesis_index):
+        return in_shard(system, hypothesis_index % self.segment_count, self.shard, self.num_shards)
+
+    def has_score(self, system, hypothesis_index):
+        return not np.isnan(self.scores[self._remap_index(system, hypothesis_index)])
+
+    # returns None for segments that are not scored yet
     def get_score(self, system, hypothesis_index):
-        index = self._remap_index(system, hypothesis_index)
-        return self.seg_scores.iloc[index]['score']
+        score = self.scores[self._remap_index(system, hypothesis_index)]
+        if np.isnan(score):
+            return None
+        return score
+
+    # raw_answer is the unparsed answer of the model, it is journaled and kept only for the columnar output;
+    # sample and valid_samples are given for runs with samples > 1, sample is None when the samples were averaged
+    def assign_score(self, system, hypothesis_index, answer, temperature=None, raw_answer=None, sample=None, valid_samples=None):
+        with span("assign_score", system=system, index=hypothesis_index):
+            index = self._remap_index(system, hypothesis_index)
+            self.scores[index] = np.nan if answer is None else answer
+            self.temperatures[index] = -1 if temperature is None else temperature
+            self.samples[index] = -1 if sample is None else sample
+            self.valid_samples[index] = 0 if valid_samples is None else valid_samples
+            if self.columnar:
+                self.raw_answers[index] = raw_answer
 
-    def assign_score(self, system, hypothesis_index, answer, temperature=None):
-        index = self._remap_index(system, hypothesis_index)
-        self.seg_scores.iloc[index]['score'] = answer
-        self.metadata.iloc[index]['temperature'] = temperature
+            line = f"{system}\t{hypothesis_index}\t{format_score(self.scores[index])}\t{'None' if temperature is None else temperature}"
+            if valid_samples is not None:
+                line += f"\t{'None' if sample is None else sample}\t{valid_samples}"
+            if self.columnar and raw_answer is not None:
+                line += "\t" + json.dumps(raw_answer)
+            self.journal.write(line + "\n")
+            self.journal.flush()
 
     def save(self):
-        # segment level scores
-        self.seg_scores.to_csv(self.get_seg_path(), sep="\t", index=False, header=False, na_rep="None")
-
-        # system scores
-        self.seg_scores.score = self.seg_scores.score.replace("None", None).astype(float)
-        sys_scores_df = self.seg_scores.groupby(['system'], as_index=False, dropna=True).mean()
-        sys_scores_df.to_csv(self.get_sys_path(), sep="\t", index=False, header=False, na_rep="None")
-
-        # domain scores
-        df = self.seg_scores.copy()
-        documents = self.testset.documents
-        total_systems = len(self.testset.systems)
-        df["domains"] = pd.DataFrame([x.split("\t")[0] for x in documents] * total_systems)[0]
-        df = df.groupby(["domains", 'system'], as_index=False, dropna=True).mean()
-        df.to_csv(self.get_domain_path(), sep="\t", index=False, header=False, na_rep="None")
-
-        # metadata
-        self.metadata.to_csv(self.get_meta_path(), sep="\t", index=False, header=False, na_rep="None")
+        with span("scores_save", name=self.name, systems=len(self.systems), segments=self.segment_count):
+            systems = np.array(self.systems, dtype=object)
+            scores = self.scores.reshape(len(self.systems), self.segment_count)
+            temperatures = self.temperatures.reshape(len(self.systems), self.segment_count)
+
+            # segment level scores
+            with open(self.get_seg_path(), "w") as fh:
+                for system, formatted in zip(self.systems, format_scores(scores)):
+                    fh.write(join_lines(system, formatted))
+
+            # system scores, means of all scored segments in the order of sorted system names
+            order = sorted(range(len(self.systems)), key=lambda i: self.systems[i])
+            system_ids = np.repeat(np.arange(len(self.systems)), self.segment_count)
+            means = group_means(self.scores, system_ids, len(self.systems))
+            with open(self.get_sys_path(), "w") as fh:
+                for i in order:
+                    fh.write(f"{systems[i]}\t{format_mean(means[i])}\n")
+
+            # domain scores, group codes combine the domain of the segment and the system
+            domains, domain_codes = self.domain_codes()
+            domain_ids = (np.tile(domain_codes, len(self.systems)) * len(self.systems) + system_ids)
+            means = group_means(self.scores, domain_ids, len(domains) * len(self.systems))
+            with open(self.get_domain_path(), "w") as fh:
+                for d, domain in enumerate(domains):
+                    for i in order:
+                        fh.write(f"{domain}\t{systems[i]}\t{format_mean(means[d * len(self.systems) + i])}\n")
+
+            # metadata, the sample columns only for runs with samples > 1
+            metadata = format_temperatures(temperatures)
+            if np.any(self.valid_samples > 0):
+                samples = format_temperatures(self.samples.reshape(metadata.shape))
+                valid_samples = format_temperatures(np.where(self.valid_samples > 0, self.valid_samples, -1).reshape(metadata.shape))
+                metadata = metadata + "\t" + samples + "\t" + valid_samples
+            with open(self.get_meta_path(), "w") as fh:
+                for system, formatted in zip(self.systems, metadata):
+                    fh.write(join_lines(system, formatted))
+
+            if self.columnar:
+                self.save_columnar(domains, domain_codes)
+
+            # everything in the journal is persisted now
+            self.journal.truncate(0)
+            self.journal.flush()
+
+    # sorted domain names and the code of every segment into them, computed once
+    def domain_codes(self):
+        if self.domain_cache is None:
+            domains = [x.split("\t")[0] for x in self.testset.documents]
+            names = sorted(set(domains))
+            lookup = {name: code for code, name in enumerate(names)}
+            self.domain_cache = (names, np.array([lookup[domain] for domain in domains], dtype=np.int64))
+        return self.domain_cache
+
+    # one Parquet file with a row for every segment of every system, needs pyarrow
+    def save_columnar(self, domains, domain_codes):
+        documents = [x.split("\t", 1)[-1] for x in self.testset.documents]
+        df = pd.DataFrame({
+            "system": pd.Categorical(np.repeat(np.array(self.systems, dtype=object), self.segment_count), categories=self.systems),
+            "segment": np.tile(np.arange(self.segment_count, dtype=np.int32), len(self.systems)),
+            "domain": pd.Categorical.from_codes(np.tile(domain_codes, len(self.systems)), categories=domains),
+            "document": np.tile(np.array(documents, dtype=object), len(self.systems)),
+            "score": self.scores,
+            "temperature": pd.Series(self.temperatures).astype("Int16").mask(self.temperatures < 0),
+            "sample": pd.Series(self.samples).astype("Int16").mask(self.samples < 0),
+            "valid_samples": pd.Series(self.valid_samples).astype("Int16").mask(self.valid_samples <= 0),
+            "raw_answer": self.raw_answers,
+        })
+        df.to_parquet(self.get_columnar_path(), index=False)
+
+
+# format_score of a whole array
+def format_scores(values):
+    formatted = np.full(values.shape, "None", dtype=object)
+    integer = np.isfinite(values) & (values == np.trunc(values))
+    small = integer & (np.abs(values) < 2 ** 62)
+    formatted[small] = values[small].astype(np.int64).astype(str)
+    other = ~np.isnan(values) & ~small
+    formatted[other] = [format_score(value) for value in values[other].tolist()]
+    return formatted
+
+
+def format_temperatures(temperatures):
+    formatted = temperatures.astype(str).astype(object)
+    formatted[temperatures < 0] = "None"
+    return formatted
+
+
+# the same as pandas writes the float column of a groupby mean
+def format_mean(value):
+    if np.isnan(value):
+        return "None"
+    return repr(float(value))
+
+
+def join_lines(system, formatted):
+    if len(formatted) == 0:
+        return ""
+    prefix = f"{system}\t"
+    return prefix + f"\n{prefix}".join(formatted) + "\n"
+
+
+def group_means(values, groups, count):
+    """Means of the non-NaN values of every group, NaN for groups with no values.
+
+    Sums are the same compensated (Kahan) sums in row order as those of pandas groupby mean, integer scores are summed exactly by bincount.
+    """
+    valid = ~np.isnan(values)
+    values = values[valid]
+    groups = groups[valid]
+    counts = np.bincount(groups, minlength=count)
+    if np.all(values == np.trunc(values)) and np.abs(values).sum() < 2 ** 53 or not np.all(np.isfinite(values)):
+        sums = np.bincount(groups, weights=values, minlength=count)
+    else:
+        sums = kahan_sums(values, groups, counts)
+    means = np.full(count, np.nan)
+    np.divide(sums, counts, out=means, where=counts > 0)
+    return means
+
+
+# one step of the Kahan summation for the r-th value of all groups at once, groups are ordered by decreasing size
+# so that the groups with more than r values are a prefix
+def kahan_sums(values, groups, counts):
+    values = values[np.argsort(groups, kind="stable")]
+    by_size = np.argsort(-counts, kind="stable")
+    sizes = counts[by_size]
+    starts = (np.cumsum(counts) - counts)[by_size]
+    sums = np.zeros(len(counts))
+    compensation = np.zeros(len(counts))
+    for r in range(sizes[0] if len(sizes) > 0 else 0):
+        n = np.searchsorted(-sizes, -r, side="left")
+        y = values[starts[:n] + r] - compensation[:n]
+        t = sums[:n] + y
+        compensation[:n] = (t - sums[:n]) - y
+        sums[:n] = t
+    result = np.zeros(len(counts))
+    result[by_size] = sums
+    return result
+
+
+def merge_scores(name, testset, refname, num_shards, columnar=False):
+    """Combine the Scores of all shards into the standard score files of name.
+
+    Every segment must be scored by exactly the shard it belongs to, otherwise ShardMergeError is raised and nothing is written.
+    """
+    merged = Scores(name, testset, refname, columnar=columnar)
+    count = merged.segment_count
+    owner = {system: np.array([shard_of(system, i, num_shards) for i in range(count)]) for system in merged.systems}
+    scores = merged.scores.copy()
+    temperatures = merged.temperatures.copy()
+    samples = merged.samples.copy()
+    valid_samples = merged.valid_samples.copy()
+    raw_answers = merged.raw_answers.copy() if columnar else None
+
+    problems = []
+    for shard in range(num_shards):
+        part = Scores(name, testset, refname, shard=shard, num_shards=num_shards, columnar=columnar)
+        for system in merged.systems:
+            owned = owner[system] == shard
+            source = slice(part.offsets[system], part.offsets[system] + count)
+            target = slice(merged.offsets[system], merged.offsets[system] + count)
+            # None answers (filtered or never valid) are scored too, they have a temperature but no score
+            scored = part.temperatures[source] >= 0
+
+            missing = np.flatnonzero(owned & ~scored)
+            if len(missing) > 0:
+                problems.append(f"{shard_suffix(shard, num_shards)} is missing {len(missing)} segments of {system}, e.g. {missing[:5].tolist()}")
+            duplicated = np.flatnonzero(~owned & scored)
+            if len(duplicated) > 0:
+                problems.append(f"{shard_suffix(shard, num_shards)} scored {len(duplicated)} segments of {system} that belong to other shards, e.g. {duplicated[:5].tolist()}")
+
+            scores[target][owned] = part.scores[source][owned]
+            temperatures[target][owned] = part.temperatures[source][owned]
+            samples[target][owned] = part.samples[source][owned]
+            valid_samples[target][owned] = part.valid_samples[source][owned]
+            if columnar:
+                raw_answers[target][owned] = part.raw_answers[source][owned]
+        part.journal.close()
+
+    if problems:
+        merged.journal.close()
+        raise ShardMergeError("Cannot merge shards of {}:\n{}".format(name, "\n".join(problems)))
+
+    merged.scores = scores
+    merged.temperatures = temperatures
+    merged.samples = samples
+    merged.valid_samples = valid_samples
+    merged.raw_answers = raw_answers
+    merged.save()
+    return merged
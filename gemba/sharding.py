@@ -0,0 +1,51 @@
+import json
+import hashlib
+
+
+class ShardMergeError(Exception):
+    pass
+
+
+# stable across processes and machines, unlike hash() which is salted per process
+def shard_of(system, index, num_shards):
+    key = f"{'' if system is None else system}\t{index}".encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") % num_shards
+
+
+def in_shard(system, index, shard, num_shards):
+    return num_shards == 1 or shard_of(system, index, num_shards) == shard
+
+
+def shard_suffix(shard, num_shards):
+    return f"shard-{shard}-of-{num_shards}"
+
+
+def merge_jsonl(shard_paths, output_path, segment_count):
+    """Combine JSONL outputs of the CLI shards, given in shard order, into one file ordered by segment index."""
+    num_shards = len(shard_paths)
+    records = [None] * segment_count
+    problems = []
+    for shard, path in enumerate(shard_paths):
+        with open(path, "r") as f:
+            for line in f:
+                # a line torn by an interrupted run
+                if not line.endswith("\n"):
+                    continue
+                record = json.loads(line)
+                index = record["index"]
+                if index >= segment_count or shard_of(None, index, num_shards) != shard:
+                    problems.append(f"{path} contains segment {index} of another shard")
+                elif records[index] is not None:
+                    problems.append(f"{path} contains segment {index} more than once")
+                else:
+                    records[index] = line
+
+    problems = problems[:20]
+    missing = [index for index, line in enumerate(records) if line is None]
+    if len(missing) > 0:
+        problems.append(f"{len(missing)} segments are missing, e.g. {missing[:5]}")
+    if problems:
+        raise ShardMergeError("Cannot merge {}:\n{}".format(", ".join(shard_paths), "\n".join(problems)))
+
+    with open(output_path, "w") as f:
+        f.writelines(records)
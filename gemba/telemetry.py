@@ -0,0 +1,143 @@
+import json
+import time
+import bisect
+from collections import defaultdict
+
+SECONDS_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+TOKENS_BUCKETS = [16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768]
+
+counters = {
+    "requests": "Requests answered, including cache hits.",
+    "cache_hits": "Requests answered from the response cache.",
+    "cache_misses": "Requests sent to the API.",
+    "api_calls": "Successful API calls.",
+    "retries": "Failed API calls that were retried.",
+    "rate_limit_errors": "API calls rejected with 429.",
+    "server_errors": "API calls failed with 5xx.",
+    "timeout_errors": "API calls that timed out or could not connect.",
+    "other_errors": "API calls failed for other reasons.",
+    "truncation_retries": "API calls repeated with larger max_tokens after a truncated answer.",
+    "escalations": "Requests repeated with higher temperature after no answer could be parsed.",
+    "parse_failures": "Answers that could not be parsed.",
+    "prompt_tokens": "Prompt tokens of API calls.",
+    "cached_tokens": "Prompt tokens served from the provider's prompt cache.",
+    "completion_tokens": "Completion tokens of API calls.",
+    "retry_wait_seconds": "Time spent waiting before retries.",
+}
+
+histograms = {
+    "queue_wait_seconds": (SECONDS_BUCKETS, "Rate limiter wait before an API call."),
+    "api_latency_seconds": (SECONDS_BUCKETS, "Duration of an API call attempt."),
+    "prompt_tokens": (TOKENS_BUCKETS, "Prompt tokens of an API call."),
+    "completion_tokens": (TOKENS_BUCKETS, "Completion tokens of an API call."),
+    "attempts": ([1, 2, 3, 5, 10, 20], "Attempts needed for a successful API call."),
+    "temperature": (list(range(11)), "Temperature at which a request was answered."),
+}
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last count is for values above the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # upper bound of the bucket containing the quantile
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bucket, count in zip(self.buckets + [float("inf")], self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bucket
+        return float("inf")
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count > 0 else None,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": {str(bucket): count for bucket, count in zip(self.buckets + ["+Inf"], self.counts)},
+        }
+
+
+# counters and histograms of a run for every model, exported as a JSON summary or in Prometheus text format
+class Telemetry:
+    def __init__(self):
+        self.started = time.time()
+        self.counters = defaultdict(lambda: dict.fromkeys(counters, 0))
+        self.histograms = defaultdict(lambda: {name: Histogram(buckets) for name, (buckets, _) in histograms.items()})
+
+    def count(self, model, name, value=1):
+        self.counters[model][name] += value
+
+    def observe(self, model, name, value):
+        self.histograms[model][name].observe(value)
+
+    def totals(self):
+        totals = dict.fromkeys(counters, 0)
+        for model_counters in self.counters.values():
+            for name, value in model_counters.items():
+                totals[name] += value
+        return totals
+
+    def summary(self):
+        return {
+            "wall_seconds": time.time() - self.started,
+            "totals": self.totals(),
+            "models": {
+                model: {
+                    "counters": dict(self.counters[model]),
+                    "histograms": {name: histogram.summary() for name, histogram in self.histograms[model].items()},
+                }
+                for model in self.counters
+            },
+        }
+
+    def to_json(self):
+        return json.dumps(self.summary(), indent=2)
+
+    def to_prometheus(self, prefix="gemba"):
+        lines = []
+        for name, description in counters.items():
+            lines.append(f"# HELP {prefix}_{name}_total {description}")
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            for model, model_counters in self.counters.items():
+                lines.append(f'{prefix}_{name}_total{{model="{escape_label(model)}"}} {model_counters[name]}')
+
+        for name, (buckets, description) in histograms.items():
+            lines.append(f"# HELP {prefix}_{name} {description}")
+            lines.append(f"# TYPE {prefix}_{name} histogram")
+            for model, model_histograms in self.histograms.items():
+                histogram = model_histograms[name]
+                label = escape_label(model)
+                cumulative = 0
+                for bucket, count in zip(buckets + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f'{prefix}_{name}_bucket{{model="{label}",le="{bucket}"}} {cumulative}')
+                lines.append(f'{prefix}_{name}_sum{{model="{label}"}} {histogram.sum}')
+                lines.append(f'{prefix}_{name}_count{{model="{label}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_path=None, prometheus_path=None):
+        if json_path is not None:
+            with open(json_path, "w") as f:
+                f.write(self.to_json())
+        if prometheus_path is not None:
+            with open(prometheus_path, "w") as f:
+                f.write(self.to_prometheus())
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
@@ -0,0 +1,96 @@
+import re
+import itertools
+from string import Formatter
+
+field_root_re = re.compile(r"^([^.\[]*)(.*)$")
+
+
+# template compiled once into a positional format string, conversation templates keep their
+# static turns (system message and few-shot examples) shared by reference between all prompts
+class CompiledTemplate:
+    def __init__(self, template):
+        if isinstance(template, str):
+            self.prefix = None
+            self.role = None
+            content = template
+        elif isinstance(template, list):
+            self.prefix = [self.compile_static(turn) for turn in template[:-1]]
+            self.role = template[-1]['role']
+            content = template[-1]['content']
+        else:
+            raise ValueError(f"Unknown template type {type(template)}")
+
+        self.fields = []
+        self.format_string = self.compile(content)
+
+    # only the last turn is filled in, escaped braces of the others are resolved like str.format does
+    def compile_static(self, turn):
+        fields = [field_name for _, field_name, _, _ in Formatter().parse(turn['content']) if field_name is not None]
+        if len(fields) > 0:
+            raise ValueError(f"Only the last turn of a template can have fields, {turn['role']} turn has {fields}")
+        return dict(turn, content=turn['content'].format())
+
+    def compile(self, content):
+        parts = []
+        for literal, field_name, format_spec, conversion in Formatter().parse(content):
+            parts.append(literal.replace("{", "{{").replace("}", "}}"))
+            if field_name is None:
+                continue
+            root, rest = field_root_re.match(field_name).groups()
+            if root not in self.fields:
+                self.fields.append(root)
+            parts.append("{" + str(self.fields.index(root)) + rest)
+            if conversion is not None:
+                parts.append("!" + conversion)
+            if format_spec:
+                parts.append(":" + format_spec)
+            parts.append("}")
+        return "".join(parts)
+
+    def wrap(self, content):
+        if self.prefix is None:
+            return content
+        return self.prefix + [{"role": self.role, "content": content}]
+
+    def render(self, data):
+        return self.wrap(self.format_string.format(*[data[field] for field in self.fields]))
+
+    def iter_render(self, columns):
+        """Lazily render prompts from columns.
+
+        Columns is a mapping (dict or DataFrame) from field names to sequences of values, a single value is used for all rows.
+        """
+        values = []
+        for field in self.fields:
+            column = columns[field]
+            if is_scalar(column):
+                values.append(itertools.repeat(column))
+            else:
+                values.append(column.tolist() if hasattr(column, "tolist") else column)
+        if all(is_scalar(columns[field]) for field in self.fields):
+            # without sequences among the fields the number of rows is taken from the other columns,
+            # the extra argument is ignored by format
+            values.append(range(row_count(columns)))
+
+        format_string = self.format_string
+        return (self.wrap(format_string.format(*row)) for row in zip(*values))
+
+    def render_columns(self, columns):
+        return list(self.iter_render(columns))
+
+
+def is_scalar(column):
+    return isinstance(column, str) or not hasattr(column, "__iter__")
+
+
+def row_count(columns):
+    if hasattr(columns, "columns"):
+        return len(columns)
+    lengths = [len(column) for column in columns.values() if not is_scalar(column)]
+    if len(lengths) == 0:
+        raise ValueError("Number of rows is unknown, no column is a sequence.")
+    return lengths[0]
+
+
+def compile_template(template):
+    return CompiledTemplate(template)
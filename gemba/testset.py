@@ -1,12 +1,96 @@
 import glob
 import os
+import mmap
+import hashlib
+import numpy as np
 
 
+# read-only sequence of the lines of a file, the file is memory-mapped on first access and a line is decoded only when it is read;
+# offsets of the lines are indexed once and cached in cache_dir, keyed by the path, size and modification time of the file
+class SegmentFile:
+    def __init__(self, path, cache_dir="cache/testset_index"):
+        self.path = path
+        self.cache_dir = cache_dir
+        self.mm = None
+        self.starts = None
+        self.ends = None
+
+    def open(self):
+        if self.starts is not None:
+            return
+        stat = os.stat(self.path)
+        if stat.st_size > 0:
+            with open(self.path, "rb") as fh:
+                self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.starts, self.ends = self.load_index(stat)
+
+    def load_index(self, stat):
+        key = hashlib.sha1(f"{os.path.abspath(self.path)}\t{stat.st_size}\t{stat.st_mtime_ns}".encode("utf-8")).hexdigest()
+        index_path = os.path.join(self.cache_dir, f"{key}.npy")
+        if os.path.isfile(index_path):
+            index = np.load(index_path)
+            return index[0], index[1]
+
+        index = self.build_index(stat.st_size)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # written under a temporary name so that concurrent processes never read a partial index
+        tmp_path = f"{index_path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, index)
+        os.replace(tmp_path, index_path)
+        return index[0], index[1]
+
+    # lines end with \n, \r\n or a lone \r, the same as iterating over a file opened in text mode
+    def build_index(self, size, block_size=1 << 26):
+        breaks = []
+        for offset in range(0, size, block_size):
+            # one more byte to see whether \r at the end of the block is followed by \n
+            block = np.frombuffer(self.mm, dtype=np.uint8, count=min(block_size + 1, size - offset), offset=offset)
+            newlines = np.flatnonzero(block[:block_size] == 10)
+            returns = np.flatnonzero(block[:block_size] == 13)
+            following = returns + 1
+            lone = returns[(following >= len(block)) | (block[np.minimum(following, len(block) - 1)] != 10)]
+            breaks.append(np.sort(np.concatenate([newlines, lone])) + offset)
+        ends = np.concatenate(breaks) if breaks else np.zeros(0, dtype=np.int64)
+        starts = np.concatenate([[0], ends + 1])
+        if len(starts) > 0 and starts[-1] >= size:
+            # no unterminated last line
+            starts = starts[:-1]
+        else:
+            ends = np.concatenate([ends, [size]])
+        return np.stack([starts, ends]).astype(np.int64)
+
+    def __len__(self):
+        self.open()
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        self.open()
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self.mm[self.starts[i]:self.ends[i]].decode("utf-8").rstrip()
+
+    def __iter__(self):
+        self.open()
+        mm = self.mm
+        for start, end in zip(self.starts.tolist(), self.ends.tolist()):
+            yield mm[start:end].decode("utf-8").rstrip()
+
+    # the memory map is reopened after unpickling, e.g. in worker processes
+    def __getstate__(self):
+        return {"path": self.path, "cache_dir": self.cache_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["cache_dir"])
+
+
+# segments of sources, references, systems and documents are SegmentFile sequences read on demand,
+# so only the files that are actually scored are ever read
 class Testset:
-    def __init__(self, basepath, dataset, lp):
+    def __init__(self, basepath, dataset, lp, cache_dir="cache/testset_index"):
         self.basepath = basepath
         self.dataset = dataset
         self.lp = lp
+        self.cache_dir = cache_dir
 
         self.sources = []
         self.references = {}
@@ -38,8 +122,11 @@ class Testset:
 
         self.documents = self.load_segment_files(f"{dataset}/documents/{self.lp}.docs")
 
-    def iterate_over_all(self, reference=None):
+    # systems limits the iteration to the given system names
+    def iterate_over_all(self, reference=None, systems=None):
         for system in self.systems.keys():
+            if systems is not None and system not in systems:
+                continue
             if reference is None:
                 for src, hyp in zip(self.sources, self.systems[system]):
                     yield src, hyp, None, system
@@ -48,11 +135,9 @@ class Testset:
                     yield src, hyp, ref, system
 
     def load_segment_files(self, path):
-        segments = []
-        with open(path, "r") as fh:
-            for line in fh:
-                segments.append(line.rstrip())
-        return segments
+        if not os.path.isfile(path):
+            raise FileNotFoundError(path)
+        return SegmentFile(path, self.cache_dir)
 
     def segments_count(self):
         return len(self.sources)*len(self.systems)
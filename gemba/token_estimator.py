@@ -0,0 +1,66 @@
+import math
+import numpy as np
+
+BIN_SIZE = 8
+BINS = 1024
+
+
+# histogram of completion lengths for one (model, method), stored next to the answers in the response cache
+class MaxTokensEstimator:
+    def __init__(self, cache, model, method, quantile=0.99, margin=1.25, min_observations=50, save_every=1000):
+        self.cache = cache
+        self.key = f"max_tokens/{model}/{method}"
+        self.quantile = quantile
+        self.margin = margin
+        self.min_observations = min_observations
+        self.save_every = save_every
+
+        # last bin collects everything longer
+        self.histogram = np.zeros(BINS, dtype=np.int64)
+        stored = cache.cache.get(self.key)
+        if stored is not None:
+            self.histogram += np.frombuffer(stored, dtype=np.int64)
+        self.unsaved = 0
+
+    def observe(self, completion_tokens):
+        self.histogram[min(completion_tokens // BIN_SIZE, BINS - 1)] += 1
+        self.unsaved += 1
+        if self.unsaved >= self.save_every:
+            self.save()
+
+    # observes answers of a cached or fresh response
+    def observe_answers(self, answers):
+        for answer in answers:
+            if answer.get("completion_tokens") is not None:
+                self.observe(answer["completion_tokens"])
+
+    def save(self):
+        if self.unsaved == 0:
+            return
+        self.cache.cache[self.key] = self.histogram.tobytes()
+        self.unsaved = 0
+
+    def observations(self):
+        return int(self.histogram.sum())
+
+    def longest(self):
+        return (int(np.flatnonzero(self.histogram)[-1]) + 1) * BIN_SIZE
+
+    # max_tokens for the first attempt, the default is used until there are enough observations
+    def max_tokens(self, default=None):
+        if self.observations() < self.min_observations:
+            return default
+        cumulative = np.cumsum(self.histogram)
+        upper = (int(np.searchsorted(cumulative, self.quantile * cumulative[-1])) + 1) * BIN_SIZE
+        return round_up(upper * self.margin)
+
+    # max_tokens for the repeated request after a truncated answer, large enough to not be truncated again
+    def escalate(self, max_tokens):
+        target = 2 * max_tokens
+        if self.observations() > 0:
+            target = max(target, self.longest() * self.margin)
+        return round_up(target)
+
+
+def round_up(tokens):
+    return int(math.ceil(tokens / 16) * 16)
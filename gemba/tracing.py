@@ -0,0 +1,150 @@
+import json
+import time
+import asyncio
+import cProfile
+import threading
+
+# sinks get on_start(span) and on_end(span) for every span, with no sinks span() returns a shared no-op span
+sinks = []
+
+
+class Span:
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.track = current_track()
+        self.start = None
+        self.end = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        for sink in sinks:
+            sink.on_start(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.perf_counter()
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        # in reverse so that sinks nest like the spans
+        for sink in reversed(sinks):
+            sink.on_end(self)
+        return False
+
+
+class NullSpan:
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+null_span = NullSpan()
+
+
+def span(name, /, **attributes):
+    """Context manager timing a block of the scoring pipeline, attributes are attached to its events."""
+    if not sinks:
+        return null_span
+    return Span(name, attributes)
+
+
+def add_sink(sink):
+    sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    sinks.remove(sink)
+    sink.close()
+
+
+def close_sinks():
+    while sinks:
+        remove_sink(sinks[-1])
+
+
+# spans of concurrent asyncio tasks overlap, so each task is drawn as its own track
+def current_track():
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is not None:
+        return f"task-{id(task):x}"
+    return threading.current_thread().name
+
+
+class Sink:
+    def on_start(self, span):
+        pass
+
+    def on_end(self, span):
+        pass
+
+    def close(self):
+        pass
+
+
+# writes complete events in the Chrome trace format, open the file in chrome://tracing or https://ui.perfetto.dev
+class ChromeTraceSink(Sink):
+    def __init__(self, path):
+        self.path = path
+        self.origin = time.perf_counter()
+        self.events = []
+        self.tracks = {}
+        self.lock = threading.Lock()
+
+    def on_end(self, span):
+        with self.lock:
+            if span.track not in self.tracks:
+                self.tracks[span.track] = len(self.tracks) + 1
+                self.events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": self.tracks[span.track], "args": {"name": span.track}})
+            self.events.append({
+                "name": span.name,
+                "ph": "X",
+                "ts": (span.start - self.origin) * 1e6,
+                "dur": (span.end - span.start) * 1e6,
+                "pid": 1,
+                "tid": self.tracks[span.track],
+                "args": {name: value if isinstance(value, (int, float, bool, type(None))) else str(value) for name, value in span.attributes.items()},
+            })
+
+    def close(self):
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+
+# cProfile of the whole run or only inside spans with the given names, stats are dumped for pstats or snakeviz
+class ProfileSink(Sink):
+    def __init__(self, path, span_names=None):
+        self.path = path
+        self.span_names = None if span_names is None else set(span_names)
+        self.profiler = cProfile.Profile()
+        # nested spans of the same name must not enable the profiler twice
+        self.depth = 0
+        if self.span_names is None:
+            self.profiler.enable()
+
+    def on_start(self, span):
+        if self.span_names is not None and span.name in self.span_names:
+            self.depth += 1
+            if self.depth == 1:
+                self.profiler.enable()
+
+    def on_end(self, span):
+        if self.span_names is not None and span.name in self.span_names:
+            self.depth -= 1
+            if self.depth == 0:
+                self.profiler.disable()
+
+    def close(self):
+        self.profiler.disable()
+        self.profiler.dump_stats(self.path)
@@ -1,38 +1,301 @@
+import os
+import sys
+import json
 import ipdb
+import itertools
+import functools
 import pandas as pd
-import diskcache as dc
 from gemba.gpt_api import GptApi
-from gemba.gemba_mqm_utils import TEMPLATE_GEMBA_MQM, apply_template, parse_mqm_answer
+from gemba.cache import ResponseCache
+from gemba.token_estimator import MaxTokensEstimator
+from gemba.gemba_mqm_utils import TEMPLATE_GEMBA_MQM
+from gemba.parsing import get_parser
+from gemba.template import compile_template
 from gemba.gemba_esa import TEMPLATE_GEMBA_ESA_ERROR_SPANS, TEMPLATE_GEMBA_ESA_RANKING
-from gemba.prompt import prompts, validate_number
+from gemba.prompt import prompts
+from gemba.tracing import span
+from gemba.sharding import in_shard
+from gemba.telemetry import Telemetry
+from gemba.cascade import escalation_reason, usage, usage_difference
 
 
-def get_gemba_scores(source, hypothesis, source_lang, target_lang, method, model, list_mqm_errors=False):
+def get_gemba_scores(source, hypothesis, source_lang, target_lang, method, model, list_mqm_errors=False, concurrency=None, retry_budget=None, batch=False, dedup="exact", callback=None, samples=1, aggregate_samples=False, adaptive_max_tokens=True, telemetry=None,
+                     cascade_model=None, uncertainty_band=None, cascade_report=None):
+    run_callback = None
+    if callback is not None:
+        run_callback = lambda method, model, row, parsed_answers: callback(row, parsed_answers)
+
+    scores = get_gemba_scores_multi(source, hypothesis, source_lang, target_lang, [(method, model)], list_mqm_errors=list_mqm_errors, concurrency=concurrency, retry_budget=retry_budget, batch=batch, dedup=dedup,
+                                    callback=run_callback, samples=samples, aggregate_samples=aggregate_samples, adaptive_max_tokens=adaptive_max_tokens, telemetry=telemetry,
+                                    cascade_model=cascade_model, uncertainty_band=uncertainty_band, cascade_report=cascade_report)
+    return scores[(method, model)]
+
+
+def get_gemba_scores_multi(source, hypothesis, source_lang, target_lang, runs, list_mqm_errors=False, concurrency=None, retry_budget=None, batch=False, dedup="exact", callback=None, samples=1, aggregate_samples=False, adaptive_max_tokens=True, telemetry=None,
+                           cascade_model=None, uncertainty_band=None, cascade_report=None):
+    """Score the same segments with several (method, model) pairs at once.
+
+    Requests of all runs are interleaved through one GptApi, so they share the connection pool, rate limits and concurrency.
+    Returns a dict from (method, model) to the list of answers, callback(method, model, row, parsed_answers) is called for every row as soon as it is scored.
+    Latencies, tokens, retries and cache hits are recorded into telemetry (gemba.telemetry.Telemetry) when it is given.
+    Spans of the run are reported to the sinks registered in gemba.tracing.
+    With cascade_model the rows are scored by it first and only uncertain rows by the models of the runs, see get_gemba_scores_cascade.
+    """
+    assert not aggregate_samples or not any(prompts.get(method, {}).get("categorical") for method, _ in runs), "Categorical answers cannot be averaged with aggregate_samples."
+    options = {"list_mqm_errors": list_mqm_errors, "concurrency": concurrency, "retry_budget": retry_budget, "batch": batch, "dedup": dedup,
+               "samples": samples, "aggregate_samples": aggregate_samples, "adaptive_max_tokens": adaptive_max_tokens}
+    if cascade_model is not None:
+        return get_gemba_scores_cascade(source, hypothesis, source_lang, target_lang, runs, cascade_model, uncertainty_band=uncertainty_band, callback=callback, report=cascade_report, telemetry=telemetry, **options)
+
+    with span("get_gemba_scores", segments=len(source), runs=len(runs)):
+        cache = ResponseCache()
+        gptapi = GptApi(retry_budget=retry_budget, samples=samples, aggregate_samples=aggregate_samples, telemetry=telemetry)
+
+        runs = list(dict.fromkeys((method, model) for method, model in runs))
+        jobs = build_jobs(segments_frame(source, hypothesis, source_lang, target_lang), runs, cache, list_mqm_errors=list_mqm_errors, adaptive_max_tokens=adaptive_max_tokens, callback=callback)
+        results = gptapi.run_jobs(jobs, cache, concurrency=concurrency, batch=batch, dedup=dedup)
+        return {run: list(pd.DataFrame(answers)['answer']) for run, answers in zip(runs, results)}
+
+
+def segments_frame(source, hypothesis, source_lang, target_lang):
     df = pd.DataFrame({'source_seg': source, 'target_seg': hypothesis})
     df['source_lang'] = source_lang
     df['target_lang'] = target_lang
+    return df
+
+
+def build_jobs(df, runs, cache, list_mqm_errors=False, adaptive_max_tokens=True, callback=None, estimators=None):
+    jobs = []
+    for method, model in runs:
+        run_callback = None
+        if callback is not None:
+            run_callback = functools.partial(callback, method, model)
+        with span("build_prompts", method=method, model=model, rows=len(df)):
+            jobs.append(method_job(df, method, model, cache, list_mqm_errors=list_mqm_errors, adaptive_max_tokens=adaptive_max_tokens, callback=run_callback, estimators=estimators))
+    return jobs
+
+
+def get_gemba_scores_cascade(source, hypothesis, source_lang, target_lang, runs, cascade_model, uncertainty_band=None, callback=None, report=None, telemetry=None, **kwargs):
+    """Score all rows with the cheaper cascade_model first and request only the uncertain rows from the model of every run.
+
+    A row is escalated when the answer of cascade_model could not be parsed, was parsed only at a higher temperature or lies
+    within uncertainty_band (low, high), see gemba.cascade.escalation_reason. Answers of both models are cached under their own model.
+    callback(method, model, row, parsed_answers) gets the final answers of every row, parsed_answers[0]["model"] is the model that
+    produced them and parsed_answers[0]["escalation"] the reason of the escalation (None for rows answered by cascade_model).
+    Rows, escalations, API time and tokens of both models are added to report (gemba.cascade.CascadeReport) when it is given.
+    Remaining keyword arguments are passed to get_gemba_scores_multi.
+    """
+    with span("cascade", segments=len(source), runs=len(runs), cascade_model=cascade_model):
+        telemetry = Telemetry() if telemetry is None else telemetry
+        runs = list(dict.fromkeys((method, model) for method, model in runs))
+        final = {run: [None] * len(source) for run in runs}
+        escalated = {run: {} for run in runs}
+
+        def finish(run, row, parsed_answers, reason):
+            final[run][row] = parsed_answers[0]["answer"]
+            if callback is not None:
+                callback(run[0], run[1], row, [dict(parsed_answers[0], escalation=reason)])
+
+        # rows answered confidently are final as soon as the cheaper model answers them
+        def first_callback(method, model, row, parsed_answers):
+            reason = escalation_reason(parsed_answers[0], uncertainty_band)
+            for run in runs:
+                if run[0] != method:
+                    continue
+                if reason is None:
+                    finish(run, row, parsed_answers, None)
+                else:
+                    escalated[run][row] = reason
+
+        before = usage(telemetry, cascade_model)
+        methods = list(dict.fromkeys(method for method, _ in runs))
+        get_gemba_scores_multi(source, hypothesis, source_lang, target_lang, [(method, cascade_model) for method in methods], callback=first_callback, telemetry=telemetry, **kwargs)
+        if report is not None:
+            report.add_cascade_usage(cascade_model, usage_difference(usage(telemetry, cascade_model), before))
+
+        for run in runs:
+            rows = sorted(escalated[run])
+            if report is not None:
+                report.add_rows(run[0], run[1], cascade_model, len(source), [escalated[run][row] for row in rows])
+            if len(rows) == 0:
+                continue
+
+            def second_callback(method, model, i, parsed_answers):
+                finish(run, rows[i], parsed_answers, escalated[run][rows[i]])
+
+            before = usage(telemetry, run[1])
+            get_gemba_scores_multi([source[row] for row in rows], [hypothesis[row] for row in rows], source_lang, target_lang, [run], callback=second_callback, telemetry=telemetry, **kwargs)
+            if report is not None:
+                report.add_escalated_usage(run[0], run[1], cascade_model, usage_difference(usage(telemetry, run[1]), before))
+
+        # the same conversion of the answers as without the cascade
+        return {run: list(pd.DataFrame({"answer": answers})["answer"]) for run, answers in final.items()}
+
+
+def method_job(df, method, model, cache, list_mqm_errors=False, adaptive_max_tokens=True, callback=None, estimators=None):
+    """Build the prompts and stages of a method for GptApi.run_jobs.
+
+    estimators keeps the token estimators of every model and method across jobs, e.g. of the chunks of a stream.
+    """
+    df = df.copy()
 
-    cache = dc.Cache(f'cache/{model}_{method}', expire=None, size_limit=int(10e10), cull_limit=0, eviction_policy='none')
-    gptapi = GptApi()
+    # max_tokens learned from the lengths of previous answers of the same model and method
+    def token_estimator(name):
+        if not adaptive_max_tokens:
+            return None
+        if estimators is None:
+            return MaxTokensEstimator(cache, model, name)
+        if (model, name) not in estimators:
+            estimators[(model, name)] = MaxTokensEstimator(cache, model, name)
+        return estimators[(model, name)]
 
     if method == "GEMBA-MQM":
-        df["prompt"] = df.apply(lambda x: apply_template(TEMPLATE_GEMBA_MQM, x), axis=1)
-        parse_answer = lambda x: parse_mqm_answer(x, list_mqm_errors=list_mqm_errors, full_desc=True)
-        answers = gptapi.bulk_request(df, model, parse_answer, cache=cache, max_tokens=500)
+        df["prompt"] = compile_template(TEMPLATE_GEMBA_MQM).render_columns(df)
+        stages = [{"parse": get_parser(method, list_mqm_errors=list_mqm_errors), "max_tokens": 500, "token_estimator": token_estimator(method)}]
     elif method in ["GEMBA-DA", "GEMBA-DA_ref", "GEMBA-SQM", "GEMBA-SQM_ref", "GEMBA-stars", "GEMBA-stars_ref", "GEMBA-classes", "GEMBA-classes_ref"]:
-        df["prompt"] = df.apply(lambda x: apply_template(prompts[method]['prompt'], x), axis=1)
-        parse_answer = prompts[method]["validate_answer"]
-        answers = gptapi.bulk_request(df, model, parse_answer, cache=cache, max_tokens=500)
+        df["prompt"] = compile_template(prompts[method]['prompt']).render_columns(df)
+        stages = [{"parse": get_parser(method), "max_tokens": 500, "token_estimator": token_estimator(method)}]
     elif method == "GEMBA-ESA":
-        df["prompt"] = df.apply(lambda x: apply_template(TEMPLATE_GEMBA_ESA_ERROR_SPANS, x), axis=1)
-        parse_answer = lambda x: x
-        error_spans = gptapi.bulk_request(df, model, parse_answer, cache=cache)
-        df['error_spans'] = pd.DataFrame(error_spans)['answer']
-
-        df["prompt"] = df.apply(lambda x: apply_template(TEMPLATE_GEMBA_ESA_RANKING, x), axis=1)
-        parse_answer = validate_number
-        answers = gptapi.bulk_request(df, model, parse_answer, cache=cache)
+        df["prompt"] = compile_template(TEMPLATE_GEMBA_ESA_ERROR_SPANS).render_columns(df)
+        ranking = compile_template(TEMPLATE_GEMBA_ESA_RANKING)
+        records = df.to_dict("records")
+        # ranking of a segment is requested as soon as its error spans arrive
+        stages = [
+            {"parse": lambda x: x, "token_estimator": token_estimator("GEMBA-ESA_spans")},
+            {"parse": get_parser(method), "token_estimator": token_estimator("GEMBA-ESA_ranking"),
+             "prompt": lambda row, parsed_answers: ranking.render({**records[row], "error_spans": parsed_answers[0]["answer"]})},
+        ]
     else:
         raise Exception(f"Method {method} not supported.")
 
-    return list(pd.DataFrame(answers)['answer'])
+    return {"df": df, "model": model, "stages": stages, "callback": callback}
+
+
+def completed_segments(output_path):
+    """Return bytearray marking indices of segments already written to a JSONL output file.
+
+    A line torn by a crash is removed so that appending continues on a fresh line.
+    """
+    done = bytearray()
+    if not os.path.isfile(output_path):
+        return done
+
+    valid_size = 0
+    with open(output_path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            valid_size += len(line)
+            try:
+                index = json.loads(line)["index"]
+            except (ValueError, KeyError):
+                continue
+            if index >= len(done):
+                done.extend(bytes(index + 1 - len(done)))
+            done[index] = 1
+
+    if valid_size < os.path.getsize(output_path):
+        with open(output_path, 'rb+') as f:
+            f.truncate(valid_size)
+    return done
+
+
+def stream_gemba_scores(source_path, hypothesis_path, output_path, source_lang, target_lang, method, model, chunk_size=1000, shard=0, num_shards=1, **kwargs):
+    """Score files chunk by chunk and append every segment to a JSONL file as soon as it is scored.
+
+    Segments already present in the output file are skipped, so an interrupted run can be restarted with the same arguments.
+    With num_shards > 1 only the segments of the given shard are scored (see gemba.sharding.merge_jsonl).
+    Remaining keyword arguments are passed to get_gemba_scores_multi.
+    """
+    stream_runs(source_path, hypothesis_path, {(method, model): output_path}, source_lang, target_lang, chunk_size=chunk_size, shard=shard, num_shards=num_shards, **kwargs)
+
+
+def stream_gemba_scores_multi(source_path, hypothesis_path, output_dir, source_lang, target_lang, runs, chunk_size=1000, shard=0, num_shards=1, **kwargs):
+    """Like stream_gemba_scores for several (method, model) pairs, each of them is written to `{output_dir}/{method}_{model}.jsonl`."""
+    os.makedirs(output_dir, exist_ok=True)
+    output_paths = {(method, model): os.path.join(output_dir, f"{method}_{model}.jsonl") for method, model in runs}
+    stream_runs(source_path, hypothesis_path, output_paths, source_lang, target_lang, chunk_size=chunk_size, shard=shard, num_shards=num_shards, **kwargs)
+
+
+def stream_runs(source_path, hypothesis_path, output_paths, source_lang, target_lang, chunk_size=1000, shard=0, num_shards=1, **kwargs):
+    done = {}
+    for run, output_path in output_paths.items():
+        done[run] = completed_segments(output_path)
+        print(f"Skipping {sum(done[run])} segments already in {output_path}", file=sys.stderr)
+
+    outputs = {run: open(output_path, 'a') for run, output_path in output_paths.items()}
+
+    # callback of a chunk, rows are indices into its todo list
+    def writer(todo):
+        def write(method, model, row, parsed_answers):
+            index = todo[row][0]
+            if index < len(done[(method, model)]) and done[(method, model)][index]:
+                return
+            out = outputs[(method, model)]
+            record = {
+                "index": index,
+                "answer": parsed_answers[0]["answer"],
+                "temperature": parsed_answers[0]["temperature"],
+                "model": parsed_answers[0]["model"],
+            }
+            # with samples > 1 the index of the chosen sample (None when averaged) and the number of valid samples
+            if "valid_samples" in parsed_answers[0]:
+                record["sample"] = parsed_answers[0]["sample"]
+                record["valid_samples"] = parsed_answers[0]["valid_samples"]
+            # reason why a cascade escalated the row to the model of the run
+            if "escalation" in parsed_answers[0]:
+                record["escalation"] = parsed_answers[0]["escalation"]
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+        return write
+
+    with open(source_path, 'r') as fs, open(hypothesis_path, 'r') as fh:
+        chunks = ((todo, writer(todo)) for todo in read_chunks(fs, fh, done, chunk_size, shard, num_shards))
+        if kwargs.get("batch") or kwargs.get("cascade_model") is not None:
+            # the Batch API and the cascade wait for all answers of a chunk anyway
+            for todo, write in chunks:
+                get_gemba_scores_multi([x[1] for x in todo], [x[2] for x in todo], source_lang, target_lang, list(output_paths), callback=write, **kwargs)
+        else:
+            kwargs = {name: value for name, value in kwargs.items() if name not in ["batch", "cascade_model", "uncertainty_band", "cascade_report"]}
+            stream_chunks((([x[1] for x in todo], [x[2] for x in todo], write) for todo, write in chunks), source_lang, target_lang, list(output_paths), **kwargs)
+
+    for out in outputs.values():
+        out.close()
+
+
+# lists of (index, source, hypothesis) of the segments of a chunk missing in any of the outputs,
+# runs that have them already are answered from the cache
+def read_chunks(fs, fh, done, chunk_size, shard, num_shards):
+    lines = enumerate(itertools.zip_longest(fs, fh))
+    while True:
+        chunk = list(itertools.islice(lines, chunk_size))
+        if len(chunk) == 0:
+            break
+
+        todo = []
+        for index, (src, hyp) in chunk:
+            assert src is not None and hyp is not None, "Source and hypothesis files must have the same number of lines."
+            if not in_shard(None, index, shard, num_shards):
+                continue
+            if all(index < len(d) and d[index] for d in done.values()):
+                continue
+            todo.append((index, src.strip(), hyp.strip()))
+        if len(todo) > 0:
+            yield todo
+
+
+def stream_chunks(chunks, source_lang, target_lang, runs, list_mqm_errors=False, concurrency=None, retry_budget=None, dedup="exact", samples=1, aggregate_samples=False, adaptive_max_tokens=True, telemetry=None):
+    """Score chunks of (source, hypothesis, callback) one after another with one GptApi, response cache and pool of workers.
+
+    The prompts of a chunk are built when the workers run out of requests of the previous one, so the requests do not drain
+    at chunk boundaries. callback(method, model, row, parsed_answers) gets the answers of every row of its chunk.
+    """
+    assert not aggregate_samples or not any(prompts.get(method, {}).get("categorical") for method, _ in runs), "Categorical answers cannot be averaged with aggregate_samples."
+    with span("stream_chunks", runs=len(runs)):
+        cache = ResponseCache()
+        gptapi = GptApi(retry_budget=retry_budget, samples=samples, aggregate_samples=aggregate_samples, telemetry=telemetry)
+        runs = list(dict.fromkeys((method, model) for method, model in runs))
+        estimators = {}
+        job_lists = (build_jobs(segments_frame(source, hypothesis, source_lang, target_lang), runs, cache, list_mqm_errors=list_mqm_errors, adaptive_max_tokens=adaptive_max_tokens, callback=callback, estimators=estimators)
+                     for source, hypothesis, callback in chunks)
+        gptapi.stream_jobs(job_lists, cache, concurrency=concurrency, dedup=dedup)
@@ -0,0 +1,31 @@
+import io
+import contextlib
+from types import SimpleNamespace
+
+import pytest
+
+from gemba.cache import ResponseCache
+from gemba.gpt_api import GptApi
+from gemba.prompt import prompts
+
+
+# the first call at temperature 0 gives an invalid answer, the sampled call at temperature 1 two identical ones
+def fake_call_api(prompt, model, temperature, max_tokens, n=1):
+    texts = ["I can't score this."] if n == 1 else ["80", "80", "90"]
+    choices = [SimpleNamespace(message=SimpleNamespace(content=text), finish_reason="stop") for text in texts]
+    return SimpleNamespace(choices=choices, usage=None)
+
+
+@pytest.mark.parametrize("aggregate_samples,answer,sample", [(True, 250 / 3, None), (False, 80, 0)])
+def test_identical_samples_are_kept(tmp_path, monkeypatch, aggregate_samples, answer, sample):
+    monkeypatch.setenv("OPENAI_API_KEY", "unused")
+    monkeypatch.delenv("OPENAI_AZURE_ENDPOINT", raising=False)
+    api = GptApi(samples=3, aggregate_samples=aggregate_samples)
+    api.call_api = fake_call_api
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        parsed = api.request("prompt", "model", prompts["GEMBA-DA"]["validate_answer"], cache=ResponseCache(str(tmp_path / "cache")))
+
+    assert len(parsed) == 1
+    assert parsed[0]["answer"] == pytest.approx(answer)
+    assert parsed[0]["sample"] == sample
+    assert parsed[0]["valid_samples"] == 3
@@ -0,0 +1,100 @@
+import io
+import random
+import contextlib
+
+import pytest
+
+from gemba.prompt import prompts, quality_classes
+from gemba.gemba_mqm_utils import few_shots, parse_mqm_answer, parse_error_class
+from gemba.parsing import get_parser, parse_batch, classify_error
+
+numeric_answers = [
+    "80", "100", "0", "105", "-5", "Score: 85", "85/100", "85/100.", "/100", "['90']", '["75"]', "['']", "[]",
+    "I would score this translation 70 out of 100.", "The score is 75. The translation preserves most meaning.",
+    "Score (0-100): 95", "95\n", " 95", "٣٥", "²", "3.5", "70-80", "I can't score this.", "", "90 90", "1e3", "NaN",
+]
+star_answers = [
+    "5", "5 stars", "4 stars", "Four stars: most meaning preserved", "three", "Three stars.", "★★★★", "★★★ (three stars)",
+    "**5**", "***", "1 star", "One star: Nonsense", "two stars mean some meaning", "Stars: 4\nfour", "I'd give it five.",
+    "6 stars", "0", "5 stars out of 5", "two or three stars", "FIVE", "*", "★★★★★★",
+]
+class_answers = quality_classes + [c.lower() for c in quality_classes] + [
+    "Class: Perfect translation", "Some meaning preserved", "Most meaning preserved, minor issues.\nPerfect translation",
+    "No meaning preserved - the output is empty", "Excellent", "perfect translation!",
+]
+mqm_lines = [
+    "Critical:", "Major:", "Minor:", "no-error", "No error", "", "  ",
+    'accuracy/mistranslation - "involvement"', 'accuracy/omission - "the account holder"', 'accuracy/addition - "ve Vídni"',
+    'accuracy/untranslated text - "Urumqi"', 'fluency/grammar - "wäre"', 'fluency/register - "dir"',
+    'fluency/punctuation - ","', 'fluency/spelling - "teh"', 'fluency/character encoding - "Ã¤"',
+    'style/awkward - "etc.,"', 'terminology/inappropriate for context - "partaje"', 'terminology/inconsistent use - "Konto"',
+    'locale convention/date format - "12/01"', 'locale convention/currency - "$"', 'non-translation - "the whole sentence"',
+    'other - "something else"', 'major error in accuracy', 'This is a minor issue', 'critical: accuracy/omission', "Major: ",
+]
+json_answers = [
+    '{"improved translation": "Das ist gut.", "errors": {"critical": [], "major": [{"class": "accuracy", "reason": "x"}], "minor": []}}',
+    '{"improved translation": "Das ist gut.", "errors": {"major": [{"class": "fluency", broken',
+    '{"improved translation": "Das ist gut", "errors": {"minor": [{"class": "style"}, {"class": "other"}]}}',
+    '{"improved translation": "x',
+]
+
+
+def corpus(size=3000, seed=1):
+    rng = random.Random(seed)
+    answers = numeric_answers + star_answers + class_answers + json_answers + [shot["answer"] for shot in few_shots.values()]
+    fragments = numeric_answers + star_answers + class_answers + mqm_lines
+    for _ in range(size // 2):
+        answers.append(" ".join(rng.choice(fragments) for _ in range(rng.randint(1, 4))))
+    for _ in range(size // 2):
+        answers.append("\n".join(rng.choice(mqm_lines) for _ in range(rng.randint(1, 10))))
+    return answers
+
+
+# value or exception of a parser together with everything it printed
+def outcome(function, answer):
+    printed = io.StringIO()
+    with contextlib.redirect_stdout(printed):
+        try:
+            result = ("value", function(answer))
+        except Exception as e:
+            result = ("error", type(e).__name__)
+    return result, printed.getvalue()
+
+
+def assert_same(reference, candidate, answers, compare_output=True):
+    for answer in answers:
+        expected = outcome(reference, answer)
+        actual = outcome(candidate, answer)
+        if not compare_output:
+            expected, actual = expected[0], actual[0]
+        assert actual == expected, f"answer {answer!r}"
+
+
+@pytest.mark.parametrize("method", ["GEMBA-DA", "GEMBA-DA_ref", "GEMBA-SQM", "GEMBA-SQM_ref", "GEMBA-stars", "GEMBA-stars_ref", "GEMBA-classes", "GEMBA-classes_ref"])
+def test_scores_match_validators(method):
+    answers = corpus()
+    assert_same(prompts[method]["validate_answer"], get_parser(method, memoize=False), answers)
+    # repeated answers print their diagnostics only once
+    assert_same(prompts[method]["validate_answer"], get_parser(method), answers + answers, compare_output=False)
+
+
+@pytest.mark.parametrize("list_mqm_errors", [False, True])
+@pytest.mark.parametrize("full_desc", [False, True])
+def test_mqm_matches_original_parser(list_mqm_errors, full_desc):
+    answers = corpus() + [None]
+    reference = lambda x: parse_mqm_answer(x, list_mqm_errors=list_mqm_errors, full_desc=full_desc)
+    assert_same(reference, get_parser("GEMBA-MQM", list_mqm_errors, full_desc, memoize=False), answers)
+    assert_same(reference, get_parser("GEMBA-MQM", list_mqm_errors, full_desc), answers + answers, compare_output=False)
+
+
+def test_error_classes_match():
+    assert_same(parse_error_class, classify_error, [line.lower() for line in mqm_lines + corpus(500)])
+
+
+def test_parse_batch_matches_validators():
+    # answers on which the validator raises are covered above
+    answers = [answer for answer in corpus(500) if outcome(prompts["GEMBA-DA"]["validate_answer"], answer)[0][0] == "value"]
+    with contextlib.redirect_stdout(io.StringIO()):
+        scores = parse_batch("GEMBA-DA", answers)
+        expected = [prompts["GEMBA-DA"]["validate_answer"](answer) for answer in answers]
+    assert [None if score != score else score for score in scores.tolist()] == expected
@@ -0,0 +1,40 @@
+from types import SimpleNamespace
+
+import pytest
+
+from gemba.rate_limiter import RateLimiter, CircuitOpenError
+
+server_error = SimpleNamespace(status_code=500)
+rate_limit_error = SimpleNamespace(status_code=429)
+
+
+def test_breaker_raises_after_max_opens():
+    limiter = RateLimiter(backoff_base=0, breaker_threshold=2, breaker_cooldown=0, breaker_max_opens=3)
+    for attempt in range(3):
+        limiter.record_failure(server_error, attempt)
+    assert limiter.consecutive_opens == 2
+    with pytest.raises(CircuitOpenError):
+        limiter.record_failure(server_error, 3)
+    with pytest.raises(CircuitOpenError):
+        limiter.acquire()
+
+
+def test_breaker_resets_on_success():
+    limiter = RateLimiter(backoff_base=0, breaker_threshold=2, breaker_cooldown=0, breaker_max_opens=3)
+    for _ in range(5):
+        for attempt in range(3):
+            limiter.record_failure(server_error, attempt)
+        limiter.record_success()
+    assert limiter.acquire() == 0
+
+
+def test_breaker_ignores_rate_limits_and_can_be_disabled():
+    limiter = RateLimiter(backoff_base=0, breaker_threshold=2, breaker_cooldown=0, breaker_max_opens=3)
+    for attempt in range(10):
+        limiter.record_failure(rate_limit_error, attempt)
+    assert limiter.consecutive_opens == 0
+
+    limiter = RateLimiter(backoff_base=0, breaker_threshold=2, breaker_cooldown=0, breaker_max_opens=None)
+    for attempt in range(10):
+        limiter.record_failure(server_error, attempt)
+    assert limiter.acquire() == 0
@@ -0,0 +1,81 @@
+import os
+
+import numpy as np
+import pytest
+
+from gemba import testset as testsets
+from gemba.scores import Scores, merge_scores
+from gemba.sharding import ShardMergeError
+
+SYSTEMS = ["sysA", "sysB"]
+SEGMENTS = 6
+
+
+@pytest.fixture
+def testset(tmp_path):
+    dataset = tmp_path / "data" / "wmt22"
+    for folder in ["sources", "documents", "system-outputs/en-de"]:
+        os.makedirs(dataset / folder)
+    (dataset / "sources" / "en-de.txt").write_text("".join(f"source {i}\n" for i in range(SEGMENTS)))
+    (dataset / "documents" / "en-de.docs").write_text("".join(f"domain{i % 2}\tdoc{i}\n" for i in range(SEGMENTS)))
+    for system in SYSTEMS:
+        (dataset / "system-outputs" / "en-de" / f"{system}.txt").write_text("".join(f"{system} {i}\n" for i in range(SEGMENTS)))
+    return testsets.Testset(str(tmp_path / "data"), "wmt22", "en-de", cache_dir=str(tmp_path / "index"))
+
+
+def test_reload_default_run(testset):
+    scores = Scores("run", testset, None)
+    scores.assign_score("sysA", 0, 42, 0)
+    scores.assign_score("sysB", 3, None, 10)
+    scores.save()
+    scores.journal.close()
+    with open(scores.get_meta_path()) as fh:
+        assert all(len(line.rstrip("\n").split("\t")) == 2 for line in fh)
+
+    reloaded = Scores("run", testset, None)
+    assert reloaded.get_score("sysA", 0) == 42
+    assert reloaded.get_score("sysB", 3) is None
+    assert reloaded.temperatures[reloaded.offsets["sysB"] + 3] == 10
+    assert np.all(reloaded.samples == -1) and np.all(reloaded.valid_samples == 0)
+
+
+def test_reload_sampled_run(testset):
+    scores = Scores("run", testset, None)
+    scores.assign_score("sysA", 0, 42, 0, sample=0, valid_samples=1)
+    scores.assign_score("sysA", 1, 83.5, 1, sample=None, valid_samples=3)
+    scores.save()
+    # journaled only
+    scores.assign_score("sysB", 2, 70, 1, sample=2, valid_samples=3)
+    scores.journal.close()
+
+    reloaded = Scores("run", testset, None)
+    offset = reloaded.offsets["sysA"]
+    assert reloaded.get_score("sysA", 1) == 83.5
+    assert reloaded.samples[offset:offset + 2].tolist() == [0, -1]
+    assert reloaded.valid_samples[offset:offset + 2].tolist() == [1, 3]
+    assert reloaded.samples[reloaded.offsets["sysB"] + 2] == 2
+    assert reloaded.valid_samples[reloaded.offsets["sysB"] + 2] == 3
+
+
+def test_merge_shards_with_none_answers(testset):
+    for shard in range(2):
+        part = Scores("run", testset, None, shard=shard, num_shards=2)
+        for system in SYSTEMS:
+            for index in range(SEGMENTS):
+                if part.in_shard(system, index):
+                    # an answer that was filtered or never valid
+                    part.assign_score(system, index, None if index == 3 else index, 0)
+        part.journal.close()
+
+    merged = merge_scores("run", testset, None, 2)
+    merged.journal.close()
+    for system in SYSTEMS:
+        assert [merged.get_score(system, index) for index in range(SEGMENTS)] == [0, 1, 2, None, 4, 5]
+
+
+def test_merge_reports_missing_segments(testset):
+    part = Scores("run", testset, None, shard=0, num_shards=2)
+    part.assign_score("sysA", next(i for i in range(SEGMENTS) if part.in_shard("sysA", i)), 50, 0)
+    part.journal.close()
+    with pytest.raises(ShardMergeError):
+        merge_scores("run", testset, None, 2)